@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""Tile cache persistence tests on a temporary directory."""
+
+import os
+import pathlib
+import random
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from twms import config, dedup, fetchers, inventory, janitor, tne, writer
+
+
+class TestInventoryScan(unittest.TestCase):
+    def test_keeps_tiles_written_while_scanning(self):
+        layer_dir = pathlib.Path(tempfile.mkdtemp())
+        (layer_dir / "3" / "1").mkdir(parents=True)
+        (layer_dir / "3" / "1" / "2.png").write_bytes(b"PNG")
+        tiles = inventory.Inventory(layer_dir, ".png", threads=1)
+        scan_dir = tiles._scan_dir
+
+        def write_while_scanning(z, x, path):
+            result = scan_dir(z, x, path)
+            tiles.set_tile(z, x, 5, time.time(), 3)
+            tiles.set_tne(z, x, 6, time.time())
+            return result
+
+        with mock.patch.object(tiles, "_scan_dir", write_while_scanning):
+            tiles.scan()
+        self.assertEqual(sorted(y for _, _, y, *_ in tiles.items()), [2, 5])
+        self.assertEqual([y for _, _, y, _ in tiles.tne_items()], [6])
+
+        tiles.save()
+        loaded = inventory.Inventory(layer_dir, ".png", threads=1)
+        loaded.load()
+        self.assertEqual(loaded.stat(3, 1, 2)[1], 3)
+        self.assertEqual(
+            sorted(p.name for p in layer_dir.iterdir()), ["3", inventory.INVENTORY_NAME]
+        )
+
+
+class TestTneIndexMerge(unittest.TestCase):
+    def test_matches_dict_during_background_merges(self):
+        """Readers see every change while arrays are merged meanwhile."""
+        rng = random.Random(0)
+        index = tne.TneIndex(merge_every=64)
+        expected = dict()
+        for _ in range(20000):
+            y = rng.randrange(5000)
+            if rng.random() < 0.3:
+                index.remove(14, 9000, y)
+                expected.pop(y, None)
+            else:
+                stamp = rng.randint(1, 2**31)
+                index.add(14, 9000, y, timestamp=stamp)
+                expected[y] = stamp
+            y = rng.randrange(5000)
+            self.assertEqual(index.get(14, 9000, y), expected.get(y))
+        self.assertEqual(len(index), len(expected))
+        self.assertEqual(
+            [(y, stamp) for _, _, y, stamp in index.items()], sorted(expected.items())
+        )
+
+
+class TestCoverageTreeSeed(unittest.TestCase):
+    def test_index_looked_up_in_place(self):
+        now = time.time()
+        index = tne.TneIndex()
+        index.add(8, 10, 20, timestamp=now)
+        index.add(8, 11, 20, timestamp=now - 7200)  # Stale
+        tree = tne.CoverageTree(reprobe=3600)
+        tree.seed(index)
+        self.assertEqual(tree._empty, {})
+        self.assertEqual(tree.empty_ancestor(10, 42, 81), (8, 10, 20))
+        self.assertIsNone(tree.empty_ancestor(10, 44, 81))
+        tree.mark_present(11, 84, 162)
+        self.assertIsNone(tree.empty_ancestor(10, 42, 81))
+
+
+class TestTneIndexSave(unittest.TestCase):
+    def setUp(self):
+        self.path = pathlib.Path(tempfile.mkdtemp()) / tne.INDEX_NAME
+
+    def test_concurrent_saves(self):
+        index = tne.TneIndex(self.path)
+        for y in range(1000):
+            index.add(12, 2360, y, timestamp=1700000000)
+        threads = [threading.Thread(target=index.save) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        loaded = tne.TneIndex(self.path)
+        loaded.load()
+        self.assertEqual(len(loaded), 1000)
+        self.assertEqual([p.name for p in self.path.parent.iterdir()], [self.path.name])
+
+    def test_failed_save_stays_dirty(self):
+        index = tne.TneIndex(self.path)
+        index.add(3, 1, 1)
+        with mock.patch.object(pathlib.Path, "write_bytes", side_effect=OSError):
+            with self.assertRaises(OSError):
+                index.save()
+        self.assertTrue(index.dirty)
+        index.save()
+        self.assertFalse(index.dirty)
+
+
+class TestTneIndexLoad(unittest.TestCase):
+    def setUp(self):
+        patches = (
+            mock.patch.object(config, "tiles_cache", tempfile.mkdtemp()),
+            mock.patch.dict(tne._indexes, clear=True),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.path = pathlib.Path(config.tiles_cache) / "layer" / tne.INDEX_NAME
+        index = tne.TneIndex(self.path)
+        for y in range(10):
+            index.add(12, 2360, y, timestamp=1700000000)
+        index.save()
+
+    def test_truncated(self):
+        data = self.path.read_bytes()
+        for size in (len(tne.MAGIC) + 3, len(data) - 5):
+            with self.subTest(size=size):
+                self.path.write_bytes(data[:size])
+                with self.assertRaises(ValueError):
+                    tne.TneIndex(self.path).load()
+
+    def test_broken_index_starts_anew(self):
+        self.path.write_bytes(self.path.read_bytes()[:-5])
+        with self.assertLogs("twms.tne", "ERROR"):
+            index = tne.get_index("layer")
+        self.assertEqual(len(index), 0)
+        self.assertIs(tne.get_index("layer"), index)
+
+
+class TestWriteBehindDiscard(unittest.TestCase):
+    def setUp(self):
+        self.writer = writer.WriteBehind(threads=1, max_pending=2)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.written = list()
+
+    def tile(self, y: int) -> fetchers.TileFile:
+        tile = fetchers.TileFile(
+            tempfile.mkdtemp(), "layer", "image/png", 3, 1, y, writer=self.writer
+        )
+        write = tile.write
+
+        def slow_write(blob, mkdir=True):
+            self.written.append(blob)
+            self.started.set()
+            self.release.wait(5)
+            write(blob, mkdir)
+
+        tile.write = slow_write
+        return tile
+
+    def race(self, blob: bytes | None) -> None:
+        """Delete tile while its write is on disk."""
+        tile = self.tile(1)
+        tile.set(blob)
+        self.assertTrue(self.started.wait(5))
+        deleter = threading.Thread(target=tile.delete)
+        deleter.start()
+        deleter.join(0.2)
+        self.assertTrue(deleter.is_alive(), "delete waits for write in progress")
+        self.release.set()
+        deleter.join(5)
+        self.assertFalse(tile.path.exists() or tile.path_tne.exists())
+        self.assertEqual(self.writer.pending(tile.path), (False, None))
+
+        # Writer survived and keeps queue moving
+        for y in range(2, 6):
+            self.tile(y).set(b"PNG")
+        self.assertTrue(self.writer.flush(5))
+        self.assertTrue(all(worker.is_alive() for worker in self.writer._workers))
+
+    def test_discard_tile_being_written(self):
+        self.race(b"PNG")
+
+    def test_discard_tne_being_written(self):
+        self.race(None)
+
+    def test_resubmit_discarded_tile_being_written(self):
+        tile = self.tile(1)
+        tile.set(b"PNG")
+        self.assertTrue(self.started.wait(5))
+        deleter = threading.Thread(target=self.writer.discard, args=(tile.path,))
+        deleter.start()
+        deleter.join(0.2)
+        tile.set(b"NEW")
+        self.release.set()
+        deleter.join(5)
+        self.assertTrue(self.writer.flush(5))
+        self.assertEqual(self.written, [b"PNG", b"NEW"])
+        self.assertFalse(self.writer._queue)
+        self.assertTrue(all(worker.is_alive() for worker in self.writer._workers))
+
+
+class TestDedupFreshness(unittest.TestCase):
+    def setUp(self):
+        self.layer = dict(
+            config.layer_defaults,
+            name="Dedup TTL",
+            prefix="dedup_ttl",
+            mimetype="image/png",
+            dedup=True,
+            cache_ttl=600,
+        )
+        patches = (
+            mock.patch.dict(config.layers, {"dedup_ttl": self.layer}),
+            mock.patch.object(config, "tiles_cache", tempfile.mkdtemp()),
+            mock.patch.object(config, "write_behind_threads", 0),
+            mock.patch.dict(tne._indexes, clear=True),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def stale_tile(self) -> fetchers.TileFile:
+        """Tile stored long ago, its blob shares the old mtime."""
+        tile = fetchers.tile_storage(self.layer, 5, 1, 1)
+        tile.set(b"sea")
+        stale = time.time() - 1000
+        os.utime(tile.path, (stale, stale))
+        dedup.for_layer(self.layer).stored(5, 1, 1, timestamp=stale)
+        return tile
+
+    def test_new_link_to_old_blob_is_fresh(self):
+        old = self.stale_tile()
+        self.assertTrue(old.needs_fetch())
+        new = fetchers.tile_storage(self.layer, 5, 1, 2)
+        new.set(b"sea")
+        self.assertTrue(os.path.samefile(old.path, new.path))
+        self.assertFalse(new.needs_fetch())
+        self.assertTrue(old.needs_fetch())
+
+    def test_janitor_expires_old_link_only(self):
+        self.stale_tile()
+        fetchers.tile_storage(self.layer, 5, 1, 2).set(b"sea")
+        usage = janitor.Janitor(config.layers).measure(self.layer, time.time())
+        self.assertEqual((usage.total, usage.expired), (2, 1))
@@ -3,9 +3,51 @@
 import doctest
 import unittest
 
-from twms import __main__, api, bbox, config, fetchers, projections, twms
+from twms import (
+    __main__,
+    admission,
+    api,
+    bbox,
+    config,
+    coverage,
+    dedup,
+    fetchers,
+    inventory,
+    janitor,
+    layouts,
+    mosaic,
+    pmtiles,
+    projections,
+    request,
+    sasplanet,
+    stream,
+    tne,
+    twms,
+    writer,
+)
 
-modules = (api, config, projections, twms, bbox, fetchers, __main__)
+modules = (
+    api,
+    config,
+    projections,
+    twms,
+    bbox,
+    fetchers,
+    request,
+    admission,
+    tne,
+    coverage,
+    inventory,
+    janitor,
+    writer,
+    dedup,
+    sasplanet,
+    layouts,
+    pmtiles,
+    stream,
+    mosaic,
+    __main__,
+)
 
 
 def load_tests(loader: unittest.TestLoader, tests, pattern) -> unittest.TestSuite:
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Fetcher tests against a local WMS stub server."""
+
+import concurrent.futures
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from PIL import Image
+
+from twms import config, fetchers
+
+
+class WmsStub(BaseHTTPRequestHandler):
+    """GetMap answering with image of requested size, slowly."""
+
+    requests: list[dict] = []
+    status = 200
+    content_length: str | None = None  # Malformed header to send
+
+    def do_GET(self):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        self.requests.append(query)
+        time.sleep(0.2)  # Let neighbour fetches queue up
+        if self.status != 200:
+            self.send_error(self.status)
+            return
+        buf = io.BytesIO()
+        size = int(query["WIDTH"]), int(query["HEIGHT"])
+        Image.linear_gradient("L").resize(size).save(buf, "PNG")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        if self.content_length is not None:
+            self.send_header("Content-Length", self.content_length)
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(buf.getvalue())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestMetatile(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), WmsStub)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        WmsStub.requests = []
+        WmsStub.status = 200
+        WmsStub.content_length = None
+        layer = dict(
+            config.layer_defaults,
+            name="WMS stub",
+            prefix="wms_stub",
+            mimetype="image/png",
+            metatile=4,
+            remote_url=f"http://127.0.0.1:{self.server.server_port}/wms?"
+            "WIDTH={width}&HEIGHT={height}&CRS={proj}&BBOX={bbox}",
+        )
+        patches = (
+            mock.patch.dict(config.layers, {"wms_stub": layer}),
+            mock.patch.object(config, "tiles_cache", tempfile.mkdtemp()),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.fetcher = fetchers.TileFetcher("wms_stub")
+        self.layer = layer
+
+    def png(self) -> bytes:
+        buf = io.BytesIO()
+        Image.new("RGB", (256, 256)).save(buf, "PNG")
+        return buf.getvalue()
+
+    def test_neighbours_share_request(self):
+        tiles = [(12, x, y) for x in range(2360, 2364) for y in range(1316, 1320)]
+        with concurrent.futures.ThreadPoolExecutor(len(tiles)) as pool:
+            images = list(pool.map(lambda t: self.fetcher.fetch(*t), tiles))
+        self.assertEqual(len(WmsStub.requests), 1)
+        self.assertEqual(WmsStub.requests[0]["WIDTH"], "1024")
+        self.assertTrue(all(im.image().size == (256, 256) for im in images))
+        # Gradient goes down, so tiles of a column differ
+        self.assertNotEqual(images[0].data, images[1].data)
+        self.assertFalse(
+            fetchers.tile_storage(self.layer, 12, 2363, 1319).needs_fetch()
+        )
+
+    def test_failed_block_not_refetched_by_neighbours(self):
+        WmsStub.status = 500
+        self.layer["cache_ttl"] = 60
+        expired = fetchers.tile_storage(self.layer, 12, 2361, 1317)
+        expired.write(self.png())
+        os.utime(expired.path, (time.time() - 3600,) * 2)
+        tiles = [(12, x, y) for x in range(2360, 2364) for y in range(1316, 1320)]
+        with concurrent.futures.ThreadPoolExecutor(len(tiles)) as pool:
+            images = dict(zip(tiles, pool.map(lambda t: self.fetcher.fetch(*t), tiles)))
+        self.assertEqual(len(WmsStub.requests), 1)
+        # Expired tile is served stale, the rest have nothing
+        self.assertIsNotNone(images.pop((12, 2361, 1317)))
+        self.assertTrue(all(image is None for image in images.values()))
+
+    def test_cached_and_missing_tiles_mixed(self):
+        """Cached tile neither stands for nor waits for neighbours fetch."""
+        cached = (12, 2360, 1316)
+        fetchers.tile_storage(self.layer, *cached).write(self.png())
+        first, fetching = self.fetcher.submit(*cached)
+        self.assertEqual(fetching, cached)
+        missing, fetching = self.fetcher.submit(12, 2361, 1317)
+        self.assertEqual(fetching, (12, 2361, 1317))
+        self.assertEqual(self.fetcher.submit(*cached)[1], cached)
+        self.assertEqual(first.result().data, self.png())
+        self.assertFalse(missing.done())
+
+        tiles = [(12, x, y) for x in range(2360, 2364) for y in range(1316, 1320)]
+        with concurrent.futures.ThreadPoolExecutor(len(tiles)) as pool:
+            images = list(pool.map(lambda t: self.fetcher.fetch(*t), tiles))
+        self.assertEqual(len(WmsStub.requests), 1)
+        self.assertTrue(all(im.image().size == (256, 256) for im in images))
+        self.assertFalse(
+            fetchers.tile_storage(self.layer, 12, 2363, 1319).needs_fetch()
+        )
+
+    def test_malformed_content_length(self):
+        WmsStub.content_length = "1,024"
+        tile = self.fetcher.fetch(12, 2360, 1316)
+        self.assertEqual(tile.image().size, (256, 256))
+
+    def test_cached_tile_of_other_size(self):
+        """Cache of other tools may hold 512 px tiles, served as is."""
+        buf = io.BytesIO()
+        Image.new("RGB", (512, 512)).save(buf, "PNG")
+        fetchers.tile_storage(self.layer, 12, 2360, 1316).write(buf.getvalue())
+        tile = self.fetcher.fetch(12, 2360, 1316)
+        self.assertEqual(tile.image().size, (512, 512))
+        self.assertEqual(WmsStub.requests, [])
+
+    def test_block_clipped_at_zoom_edge(self):
+        self.assertEqual(self.fetcher.metatile_tiles(1, 1, 1), (0, 0, 2, 2))
+        self.fetcher.fetch(1, 1, 1)
+        self.assertEqual(WmsStub.requests[0]["WIDTH"], "512")
+
+    def test_not_found_marks_whole_block(self):
+        WmsStub.status = 404
+        self.assertIsNone(self.fetcher.fetch(12, 2361, 1317))
+        neighbour = fetchers.tile_storage(self.layer, 12, 2363, 1319)
+        self.assertFalse(neighbour.needs_fetch())
+        self.assertFalse(neighbour.exists())
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""Projection tests and zoom selection micro-benchmark.
+
+Run benchmark with `python -m tests.test_projections`.
+"""
+
+import random
+import timeit
+import unittest
+from unittest import mock
+
+from twms import config, projections
+
+LAYERS = {
+    "test_3857": {"proj": "EPSG:3857"},
+    "test_3395": {"proj": "EPSG:3395"},
+    "test_4326": {"proj": "EPSG:4326"},
+}
+
+
+def zoom_for_bbox_scan(
+    bbox, size, layer_id, min_zoom=1, max_zoom=18, max_size=(10000, 10000)
+) -> int:
+    """Zoom selection by scanning zoom levels, as it was before closed form."""
+    h, w = size
+    for i in range(min_zoom, max_zoom):
+        cx1, cy1, cx2, cy2 = projections.tile_by_bbox(
+            bbox, i, config.layers[layer_id]["proj"]
+        )
+        if w != 0:
+            if (cx2 - cx1) * 256 >= w * 0.9:
+                return i
+        if h != 0:
+            if (cy1 - cy2) * 256 >= h * 0.9:
+                return i
+        if (cy1 - cy2) * 256 >= max_size[0] / 2:
+            return i
+        if (cx2 - cx1) * 256 >= max_size[1] / 2:
+            return i
+    return max_zoom
+
+
+def random_request(rng: random.Random) -> tuple:
+    """Random WMS GetMap geometry, from a city block to the whole world."""
+    width = 10 ** rng.uniform(-5, 2.5)
+    height = width * rng.uniform(0.2, 5)
+    lon = rng.uniform(-180, 180 - min(width, 359))
+    lat = rng.uniform(-84, 84 - min(height, 167))
+    bbox = (lon, lat, lon + min(width, 359), lat + min(height, 167))
+    size = rng.choice((0, rng.randint(1, 4096))), rng.choice((0, rng.randint(1, 4096)))
+    min_zoom = rng.randint(0, 5)
+    max_zoom = rng.randint(min_zoom, 24)
+    max_size = rng.choice(((10000, 10000), (2048, 2048), (0, 0), (512, 4096)))
+    return bbox, size, rng.choice(list(LAYERS)), min_zoom, max_zoom, max_size
+
+
+@mock.patch.dict(config.layers, LAYERS)
+class TestZoomForBbox(unittest.TestCase):
+    def test_matches_scan(self):
+        rng = random.Random(42)
+        for _ in range(20000):
+            request = random_request(rng)
+            with self.subTest(request=request):
+                self.assertEqual(
+                    projections.zoom_for_bbox(*request), zoom_for_bbox_scan(*request)
+                )
+
+    def test_exact_power_of_two_span(self):
+        """Tile aligned bbox hits the threshold exactly, ties go to lower zoom."""
+        for z in range(1, 16):
+            bbox = projections.bbox_by_tile(z, 2**z // 3, 2**z // 3)
+            for size in ((256, 256), (512, 0), (0, 1024), (284, 284)):
+                with self.subTest(z=z, size=size):
+                    self.assertEqual(
+                        projections.zoom_for_bbox(bbox, size, "test_3857", 0, 24),
+                        zoom_for_bbox_scan(bbox, size, "test_3857", 0, 24),
+                    )
+
+    def test_antimeridian_wrap(self):
+        bbox = (170.0, -10.0, -170.0, 10.0)
+        for size in ((256, 256), (0, 1024), (4096, 0)):
+            with self.subTest(size=size):
+                self.assertEqual(
+                    projections.zoom_for_bbox(bbox, size, "test_3857"),
+                    zoom_for_bbox_scan(bbox, size, "test_3857"),
+                )
+
+
+@unittest.skipIf(projections.pyproj is None, "pyproj is not installed")
+class TestPyprojTransform(unittest.TestCase):
+    def test_utm_round_trip(self):
+        points = [(27.6, 53.2), (30.0, 50.0)]
+        utm = projections.transform(points, "EPSG:4326", "EPSG:32635")
+        self.assertAlmostEqual(utm[0][0], 540079.6998, places=3)
+        for point, back in zip(points, projections.to4326(utm, "EPSG:32635")):
+            self.assertAlmostEqual(point[0], back[0], places=9)
+            self.assertAlmostEqual(point[1], back[1], places=9)
+
+    def test_flat_line_and_transformer_reuse(self):
+        projections.pyproj_transformer.cache_clear()
+        for _ in range(3):
+            line = projections.from4326([27.6, 53.2, 30.0, 50.0], "EPSG:32635")
+        self.assertEqual(len(line), 4)
+        self.assertEqual(projections.pyproj_transformer.cache_info().misses, 1)
+
+    def test_pure_python_pairs_stay(self):
+        projections.pyproj_transformer.cache_clear()
+        self.assertEqual(
+            projections.from4326((27.6, 53.2), "EPSG:3857"),
+            [3072417.9458943508, 7020078.532642099],
+        )
+        self.assertEqual(projections.pyproj_transformer.cache_info().currsize, 0)
+
+
+@unittest.skipIf(projections.np is None, "numpy is not installed")
+class TestNumpyTransform(unittest.TestCase):
+    def test_4326_to_3857(self):
+        np = projections.np
+        x, y = projections._a4326t3857(
+            0, 0, np.array([27.6, -180]), np.array([53.2, -90.0])
+        )
+        self.assertEqual(x.tolist(), [3072417.9458943508, -20037508.342789244])
+        self.assertEqual(y.tolist(), [7020078.532642099, -20037508.342789244])
+
+    def test_4326_to_3395(self):
+        np = projections.np
+        x, y = projections._a4326t3395(0, 0, np.array([27.6]), np.array([53.2]))
+        self.assertEqual(x.tolist(), [3072417.9458943508])
+        self.assertEqual(y.round(6).tolist(), [6985840.123948])
+
+    def test_round_trips(self):
+        np = projections.np
+        lon, lat = np.array([27.6, -100.0]), np.array([53.2, -60.0])
+        for forward, back in (
+            (projections._a4326t3857, projections._a3857t4326),
+            (projections._a4326t3395, projections._a3395t4326),
+        ):
+            with self.subTest(forward=forward.__name__):
+                x, y = back(0, 0, *forward(0, 0, lon, lat))
+                np.testing.assert_allclose(x, lon, atol=1e-9)
+                np.testing.assert_allclose(y, lat, atol=1e-7)
+
+    def test_array_matches_pure_python(self):
+        np = projections.np
+        points = [(27.6, 53.2), (0.0, 0.0), (-120.5, -33.3)]
+        for srs in ("EPSG:3857", "EPSG:3395"):
+            with self.subTest(srs=srs):
+                array = projections.transform(np.array(points), "EPSG:4326", srs)
+                self.assertIsInstance(array, np.ndarray)
+                np.testing.assert_allclose(
+                    array, projections.transform(points, "EPSG:4326", srs), rtol=1e-12
+                )
+
+
+@mock.patch.dict(config.layers, LAYERS)
+def benchmark(number: int = 2000) -> None:
+    """Print time per call of closed-form and scanning zoom selection."""
+    rng = random.Random(0)
+    requests = [random_request(rng) for _ in range(number)]
+    for name, func in (
+        ("closed form", projections.zoom_for_bbox),
+        ("scan", zoom_for_bbox_scan),
+    ):
+        elapsed = timeit.timeit(lambda: [func(*r) for r in requests], number=1)
+        print(f"{name}: {elapsed / number * 1e6:.1f} us per call")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""WMS rendering tests with synthetic tiles, no network access."""
+
+import functools
+import io
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image, ImageChops
+
+from twms import api, config, fetchers, janitor, twms, writer
+
+LAYERS = {
+    "test_3857": dict(
+        config.layer_defaults,
+        name="test_3857",
+        prefix="test_3857",
+        proj="EPSG:3857",
+        min_zoom=0,
+        max_zoom=19,
+        empty_color="#000",
+    ),
+    "test_3395": dict(
+        config.layer_defaults,
+        name="test_3395",
+        prefix="test_3395",
+        proj="EPSG:3395",
+        min_zoom=0,
+        max_zoom=19,
+        empty_color="#000",
+    ),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def noise_tile(self, layer_id, z, x, y, trybetter=True, real=False):
+    """Smooth random tile, unique for tile number."""
+    rng = random.Random(f"{z}/{x}/{y}")
+    im = Image.frombytes("RGB", (16, 16), rng.randbytes(16 * 16 * 3))
+    im = im.resize((256, 256), Image.BILINEAR).convert("RGBA")
+    return fetchers.TileImage(None, "image/png", im)
+
+
+def random_request(rng: random.Random) -> tuple:
+    span = 10 ** rng.uniform(-3, 0.5)
+    lon, lat = rng.uniform(-170, 160), rng.uniform(-70, 60)
+    bbox = (lon, lat, lon + span, lat + span * rng.uniform(0.5, 2))
+    size = rng.choice((0, rng.randint(100, 1500))), rng.randint(100, 1500)
+    srs = rng.choice(("EPSG:4326", "EPSG:3857"))
+    force = rng.choice(((), ("noresize",)))
+    return bbox, srs, size, rng.choice(list(LAYERS)), force
+
+
+def max_difference(im1: Image.Image, im2: Image.Image) -> int:
+    return max(high for _, high in ImageChops.difference(im1, im2).getextrema())
+
+
+@mock.patch.dict(config.layers, LAYERS)
+@mock.patch.object(twms.TWMSMain, "tile_image", noise_tile)
+class TestStripRender(unittest.TestCase):
+    def setUp(self):
+        self.twms = twms.TWMSMain()
+
+    def test_strips_match_whole_image(self):
+        """Strips differ from whole image by resampling rounding at most."""
+        rng = random.Random(1)
+        for _ in range(40):
+            bbox, srs, size, layer_id, force = random_request(rng)
+            plan = self.twms.layer_plan(bbox, srs, size, layer_id, force)
+            if 0 in plan.size:
+                continue
+            whole = self.twms.bbox_image(bbox, srs, size, layer_id, force)
+            for step in (rng.randint(1, 300), 256):
+                with self.subTest(plan=plan, step=step):
+                    joined = Image.new("RGBA", plan.size)
+                    with mock.patch.object(config, "wms_strip_height", step):
+                        top = 0
+                        for strip in self.twms.bbox_strips(layer_id, plan):
+                            joined.paste(strip, (0, top))
+                            top += strip.height
+                    self.assertEqual(top, plan.size[1])
+                    self.assertLessEqual(max_difference(whole, joined), 1)
+
+    def test_streamed_png(self):
+        request = {
+            "layers": "test_3857",
+            "format": "image/png",
+            "srs": "EPSG:4326",
+            "bbox": "27.5,53.85,27.6,53.95",
+            "width": "700",
+            "height": "600",
+        }
+        with mock.patch.object(config, "wms_strip_height", 256):
+            status, content_type, content = self.twms.wms_handler(request)
+        self.assertNotIsInstance(content, bytes)
+        streamed = Image.open(io.BytesIO(b"".join(content)))
+        # Image not taller than a strip is sent whole with Content-Length
+        status, content_type, content = self.twms.wms_handler(request)
+        whole = Image.open(io.BytesIO(content))
+        self.assertEqual(streamed.size, (700, 600))
+        self.assertLessEqual(max_difference(streamed, whole), 1)
+
+    def test_fast_quality_close_to_best(self):
+        """Reduced tiles resampled to output differ from Lanczos slightly."""
+        bbox, srs = (27.5, 53.85, 27.6, 53.95), "EPSG:4326"
+        for layer_id in LAYERS:
+            for size in ((150, 150), (60, 40)):
+                # Layer zoom range forces sources larger than output
+                with mock.patch.dict(config.layers[layer_id], min_zoom=13):
+                    plan = self.twms.layer_plan(bbox, srs, size, layer_id, ())
+                    best = self.twms.bbox_image(bbox, srs, size, layer_id, (), "best")
+                    fast = self.twms.bbox_image(bbox, srs, size, layer_id, (), "fast")
+                with self.subTest(plan=plan):
+                    self.assertGreater(plan.reduction(), 1)
+                    self.assertEqual(fast.size, best.size)
+                    self.assertLessEqual(max_difference(best, fast), 32)
+
+    def test_broken_tile_drawn_empty(self):
+        broken = fetchers.TileImage(b"<html>", "image/png")
+        bbox, srs, size = (27.5, 53.85, 27.6, 53.95), "EPSG:4326", (300, 300)
+        with mock.patch.object(twms.TWMSMain, "tile_image", return_value=broken):
+            im = self.twms.bbox_image(bbox, srs, size, "test_3857", ())
+            status, _, _ = self.twms.tiles_handler(
+                "test_3857", 12, 2360, 1316, "image/jpeg"
+            )
+        self.assertEqual(im.getextrema()[3], (255, 255))  # Opaque empty_color
+        self.assertEqual(status, 404)
+
+    def test_invalid_quality(self):
+        status, content_type, content = self.twms.wms_handler(
+            {"layers": "test_3857", "bbox": "27.5,53.85,27.6,53.95", "quality": "x"}
+        )
+        self.assertEqual(status, 400)
+
+
+@mock.patch.dict(config.layers, LAYERS)
+@mock.patch.object(twms.TWMSMain, "tile_image", noise_tile)
+class TestHidpiTile(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(config, "tiles_cache", tempfile.mkdtemp())
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.twms = twms.TWMSMain()
+
+    def test_composed_of_subtiles(self):
+        status, mimetype, data = self.twms.tiles_handler(
+            "test_3857@2x", 12, 2360, 1316, "image/png"
+        )
+        im = Image.open(io.BytesIO(data)).convert("RGBA")
+        self.assertEqual(im.size, (512, 512))
+        subtile = noise_tile(self.twms, "test_3857", 13, 4721, 2633).image()
+        self.assertEqual(im.crop((256, 256, 512, 512)).tobytes(), subtile.tobytes())
+
+    def test_derived_cache(self):
+        self.twms.hidpi_tile("test_3857", 12, 2360, 1316)
+        writer.flush()
+        with mock.patch.object(twms.TWMSMain, "tile_image") as tile_image:
+            tile = self.twms.hidpi_tile("test_3857", 12, 2360, 1316)
+        tile_image.assert_not_called()
+        self.assertEqual(tile.image().size, (512, 512))
+
+    def test_invalidated_by_subtile_store(self):
+        self.twms.hidpi_tile("test_3857", 12, 2360, 1316)
+        writer.flush()
+        storage = fetchers.hidpi_storage(LAYERS["test_3857"], 12, 2360, 1316)
+        self.assertFalse(storage.needs_fetch())
+        fetchers.invalidate_hidpi(LAYERS["test_3857"], 13, 4721, 2633)
+        self.assertTrue(storage.needs_fetch())
+
+    def test_recomposed_of_fresh_subtiles(self):
+        fresh = fetchers.TileImage(None, "image/png", Image.new("RGBA", (256, 256)))
+        self.twms.hidpi_tile("test_3857", 12, 2360, 1316)
+        writer.flush()
+        # Subtile fetched again, RAM cache still holds the old one
+        fetchers.invalidate_hidpi(LAYERS["test_3857"], 13, 4721, 2633)
+        with mock.patch.object(noise_tile, "__wrapped__", return_value=fresh):
+            tile = self.twms.hidpi_tile("test_3857", 12, 2360, 1316)
+        self.assertEqual(tile.image().getextrema()[3], (0, 0))
+
+    def test_not_invalidated_without_hidpi(self):
+        self.twms.hidpi_tile("test_3857", 12, 2360, 1316)
+        writer.flush()
+        storage = fetchers.hidpi_storage(LAYERS["test_3857"], 12, 2360, 1316)
+        with mock.patch.object(config, "wmts_hidpi", False):
+            fetchers.invalidate_hidpi(LAYERS["test_3857"], 13, 4721, 2633)
+        self.assertFalse(storage.needs_fetch())
+
+    def test_under_janitor_quota(self):
+        self.twms.hidpi_tile("test_3857", 12, 2360, 1316)
+        writer.flush()
+        with mock.patch.dict(LAYERS["test_3857"], cache_quota=1):
+            cache_janitor = janitor.Janitor(config.layers)
+            hidpi = cache_janitor.layers["test_3857@2x"]
+            self.assertGreater(cache_janitor.measure(hidpi, 0).total, 0)
+            cache_janitor.run_once()
+        storage = fetchers.hidpi_storage(LAYERS["test_3857"], 12, 2360, 1316)
+        self.assertFalse(storage.exists())
+
+    def test_capabilities(self):
+        xml = api.maps_wmts_rest()
+        self.assertIn("<ows:Identifier>test_3857@2x</ows:Identifier>", xml)
+        self.assertIn("<ows:Identifier>EPSG:3857@2x</ows:Identifier>", xml)
+        self.assertIn("/test_3857@2x/{TileMatrix}/{TileCol}/{TileRow}.jpg", xml)
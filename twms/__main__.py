@@ -1,18 +1,36 @@
 #!/usr/bin/env python
+"""Hacky TMS/WMS proxy for JOSM."""
 
+import argparse
+import contextlib
 import logging
 import mimetypes
 import os
+import pathlib
 import re
+import select
+import socket
 import textwrap
+import typing
 import urllib.parse
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import twms
+import twms.admission
 import twms.api
 import twms.config
+import twms.dedup
+import twms.inventory
+import twms.janitor
+import twms.layouts
+import twms.mosaic
+import twms.pmtiles
+import twms.request
+import twms.sasplanet
+import twms.tne
 import twms.twms
+import twms.writer
 
 mimetypes.init()  # Init or mimetypes.types_map['.webp'] wont work
 # https://stackoverflow.com/questions/384076/how-can-i-color-python-logging-output
@@ -43,6 +61,8 @@ logger = logging.getLogger(__name__)
 
 class GetHandler(BaseHTTPRequestHandler):
     TWMS = twms.twms.TWMSMain()
+    gates = twms.admission.build_gates(twms.config.admission)
+    clients = twms.admission.ClientLimiter(twms.config.client_max_requests)
     server_version = f"twms/{twms.__version__}"
     wms_route = re.compile(r"/wms/(.*)/(\d+)/(\d+)/(\d+)(\.[a-zA-Z]+)?(.*)")
 
@@ -54,6 +74,58 @@ class GetHandler(BaseHTTPRequestHandler):
         josm/maps.xml
         any overview
         """
+        context = twms.request.RequestContext(
+            client=self.headers.get(twms.config.client_header, self.client_address[0]),
+            timeout=twms.config.request_timeout,
+            is_disconnected=self.client_disconnected,
+        )
+        gate = self.gates.get(self.request_class(), None)
+        try:
+            with twms.request.scope(context), self.clients.admit(context.client):
+                with gate.admit() if gate else contextlib.nullcontext():
+                    self.handle_get()
+        except twms.request.RequestCancelled as err:
+            logger.info(f"'{self.path}' cancelled: {err}")
+            self.close_connection = True
+        except twms.admission.QuotaExceeded as err:
+            logger.warning(f"'{self.path}' rejected: {err}")
+            self.send_content(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                "text/plain",
+                repr(HTTPStatus.TOO_MANY_REQUESTS),
+                headers={"Retry-After": str(twms.config.retry_after)},
+            )
+        except twms.admission.Overloaded as err:
+            logger.warning(f"'{self.path}' shed: {err}")
+            self.send_content(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                "text/plain",
+                repr(HTTPStatus.SERVICE_UNAVAILABLE),
+                headers={"Retry-After": str(twms.config.retry_after)},
+            )
+
+    def request_class(self) -> str | None:
+        """Classify request for admission control.
+
+        Returns:
+            "tile" for tile passthrough, "map" for WMS GetMap rendering,
+            None for service documents.
+        """
+        if self.path.startswith("/wmts"):
+            if self.path.startswith("/wmts/1.0.0/"):
+                return None
+            return "tile"
+        elif self.path.startswith("/wms"):
+            if self.wms_route.fullmatch(self.path):
+                return "tile"
+            query = urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query)
+            if {k.casefold(): v for k, v in query}.get("request") == "GetCapabilities":
+                return None
+            return "map"
+        return None
+
+    def handle_get(self):
+        """Route request and send response."""
         if self.path.startswith("/wmts"):
             if self.path.startswith("/wmts/1.0.0/WMTSCapabilities.xml"):
                 status = HTTPStatus.OK
@@ -98,9 +170,26 @@ class GetHandler(BaseHTTPRequestHandler):
             status = HTTPStatus.NOT_FOUND
             content_type = "text/plain"
             content = repr(status)
+        self.send_content(status, content_type, content)
 
+    def send_content(
+        self,
+        status: HTTPStatus,
+        content_type: str,
+        content: bytes | memoryview | str | typing.Iterator[bytes],
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        """Send response with headers and body.
+
+        Body iterator is written part by part as it is produced, without
+        Content-Length, so the response ends with connection close. Status is
+        sent before the body is produced, so an error raised by the iterator
+        closes connection and the client gets truncated body.
+        """
         self.send_response(status)
         self.send_header("Content-Type", content_type)
+        for keyword, value in (headers or {}).items():
+            self.send_header(keyword, value)
         if "text/" in content_type or "xml" in content_type:
             # JOSM tends to save old XML
             self.send_header("Cache-Control", "no-cache, no-store, must-revalidate")
@@ -109,7 +198,30 @@ class GetHandler(BaseHTTPRequestHandler):
         self.end_headers()
         if "text/" in content_type or "xml" in content_type:
             content = content.encode("utf-8")
-        self.wfile.write(content)
+        if isinstance(content, (bytes, memoryview)):
+            self.wfile.write(content)
+            return
+        self.close_connection = True
+        try:
+            for part in content:
+                self.wfile.write(part)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError) as err:
+            logger.info(f"'{self.path}' client gone while streaming: {err}")
+
+    def client_disconnected(self) -> bool:
+        """Check whether client closed connection while waiting for response.
+
+        Client sends nothing after request, so readable socket without
+        data means EOF.
+        """
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if readable:
+                return not self.connection.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
+        return False
 
     def log_message(self, format, *args):
         """Override logger."""
@@ -120,7 +232,7 @@ class GetHandler(BaseHTTPRequestHandler):
         logger.error(format, *args)
 
 
-def main():
+def serve():
     """Run simple TWMS server."""
     server = ThreadingHTTPServer((twms.config.host, twms.config.port), GetHandler)
     print(
@@ -135,7 +247,213 @@ def main():
         Press <Ctrl-C> to stop"""
         )
     )
-    server.serve_forever()
+    twms.tne.start_saver(twms.config.tne_index_save_interval)
+    twms.inventory.start(twms.config.layers)
+    janitor = twms.janitor.Janitor(
+        twms.config.layers,
+        quota=twms.config.cache_quota,
+        batch=twms.config.janitor_batch,
+        pause=twms.config.janitor_pause,
+    )
+    if janitor.layers:
+        janitor.start(twms.config.janitor_interval)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        twms.writer.flush()
+        twms.tne.save_all()
+        twms.inventory.save_all()
+        twms.janitor.save_all()
+        twms.sasplanet.pool.close()
+
+
+def tne_import(layers: list[str], remove: bool = False) -> None:
+    """Import SAS.Planet `*.tne` files into TNE index."""
+    for layer_id in layers:
+        prefix = twms.config.layers[layer_id]["prefix"]
+        index = twms.tne.get_index(prefix)
+        count = index.import_tne(pathlib.Path(twms.config.tiles_cache) / prefix, remove)
+        index.save()
+        print(f"{layer_id}: imported {count} TNE files")
+
+
+def tne_export(layers: list[str]) -> None:
+    """Write TNE index as SAS.Planet `*.tne` files."""
+    for layer_id in layers:
+        prefix = twms.config.layers[layer_id]["prefix"]
+        count = twms.tne.get_index(prefix).export_tne(
+            pathlib.Path(twms.config.tiles_cache) / prefix
+        )
+        print(f"{layer_id}: exported {count} TNE files")
+
+
+def inventory_scan(layers: list[str]) -> None:
+    """Rebuild tile inventory snapshot from scratch."""
+    for layer_id in layers:
+        layer = twms.config.layers[layer_id]
+        inventory = twms.inventory.Inventory(
+            pathlib.Path(twms.config.tiles_cache) / layer["prefix"],
+            ext=mimetypes.guess_extension(layer["mimetype"]),
+            threads=twms.config.inventory_threads,
+        )
+        inventory.scan()
+        inventory.save()
+        print(f"{layer_id}: {len(inventory)} tiles")
+
+
+def dedup(layers: list[str], convert: bool = False) -> None:
+    """Report deduplication ratio, deduplicate existing tiles on request."""
+    for layer_id in layers:
+        layer = twms.config.layers[layer_id]
+        store = twms.dedup.BlobStore(
+            pathlib.Path(twms.config.tiles_cache) / layer["prefix"],
+            mimetypes.guess_extension(layer["mimetype"]),
+            layer["layout"],
+            twms.tne.get_index(layer["prefix"], twms.dedup.FetchIndex),
+        )
+        if convert:
+            linked = store.convert()
+            removed = store.collect_garbage()
+            twms.tne.save_all()
+            print(f"{layer_id}: linked {linked} duplicates, removed {removed} blobs")
+        tiles, logical, physical = store.stats()
+        print(
+            f"{layer_id}: {tiles} tiles, {logical} bytes, {physical} bytes unique, dedup ratio {logical / max(physical, 1):.2f}"
+        )
+
+
+def migrate(layers: list[str], src: str, dst: str | None = None) -> None:
+    """Move tile cache to another directory layout."""
+    for layer_id in layers:
+        layer = twms.config.layers[layer_id]
+        dst_layout = dst or layer["layout"]
+        count = twms.layouts.migrate(
+            pathlib.Path(twms.config.tiles_cache) / layer["prefix"],
+            src,
+            dst_layout,
+            (mimetypes.guess_extension(layer["mimetype"]), ".tne"),
+            threads=twms.config.inventory_threads,
+        )
+        print(f"{layer_id}: moved {count} files from '{src}' to '{dst_layout}' layout")
+
+
+def pmtiles_export(layers: list[str], output: str | None = None) -> None:
+    """Pack layer file cache into a single PMTiles archive."""
+    for layer_id in layers:
+        layer = twms.config.layers[layer_id]
+        path = (
+            pathlib.Path(output)
+            if output and len(layers) == 1
+            else twms.pmtiles.archive_path(layer)
+        )
+        tiles, contents = twms.pmtiles.export(
+            pathlib.Path(twms.config.tiles_cache) / layer["prefix"],
+            layer["layout"],
+            layer["mimetype"],
+            path,
+            bounds=layer["bounds"],
+            metadata={"name": layer["name"], "format": layer["mimetype"]},
+        )
+        print(f"{layer_id}: {tiles} tiles, {contents} unique, written to '{path}'")
+
+
+def mosaic(
+    layer_id: str, bbox: str, zoom: int, output: str, bigtiff: bool = False
+) -> None:
+    """Export cached tiles covering bbox as a single GeoTIFF."""
+    tiles, missing = twms.mosaic.export(
+        twms.config.layers[layer_id],
+        tuple(map(float, bbox.split(","))),
+        zoom,
+        output,
+        bigtiff=bigtiff or None,
+        threads=twms.config.mosaic_threads,
+    )
+    print(f"{layer_id}: {tiles} tiles, {missing} missing, written to '{output}'")
+
+
+def main():
+    """Run TWMS server or cache maintenance command."""
+    parser = argparse.ArgumentParser(prog="twms", description=__doc__)
+    commands = parser.add_subparsers(dest="command")
+    parser_import = commands.add_parser(
+        "tne-import", help="import SAS.Planet *.tne files into TNE index"
+    )
+    parser_import.add_argument("layers", nargs="+", metavar="layer_id")
+    parser_import.add_argument(
+        "--remove", action="store_true", help="delete imported *.tne files"
+    )
+    parser_export = commands.add_parser(
+        "tne-export", help="write TNE index as SAS.Planet *.tne files"
+    )
+    parser_export.add_argument("layers", nargs="+", metavar="layer_id")
+    parser_scan = commands.add_parser(
+        "inventory-scan", help="rebuild tile inventory snapshot"
+    )
+    parser_scan.add_argument("layers", nargs="+", metavar="layer_id")
+    parser_dedup = commands.add_parser(
+        "dedup", help="report deduplication ratio of tile cache"
+    )
+    parser_dedup.add_argument("layers", nargs="+", metavar="layer_id")
+    parser_dedup.add_argument(
+        "--convert", action="store_true", help="hardlink identical tiles to blobs"
+    )
+    parser_migrate = commands.add_parser(
+        "migrate",
+        help="move tile cache to another directory layout, while server is running",
+    )
+    parser_migrate.add_argument("layers", nargs="+", metavar="layer_id")
+    parser_migrate.add_argument(
+        "--from", dest="src", required=True, choices=twms.layouts.LAYOUTS
+    )
+    parser_migrate.add_argument(
+        "--to",
+        dest="dst",
+        choices=twms.layouts.LAYOUTS,
+        help='default is layer "layout"',
+    )
+    parser_pmtiles = commands.add_parser(
+        "pmtiles-export", help="pack tile cache into PMTiles archive"
+    )
+    parser_pmtiles.add_argument("layers", nargs="+", metavar="layer_id")
+    parser_pmtiles.add_argument(
+        "-o",
+        "--output",
+        help='archive path for single layer, default "{prefix}.pmtiles"',
+    )
+    parser_mosaic = commands.add_parser(
+        "mosaic", help="export cached tiles of a bbox as GeoTIFF with world file"
+    )
+    parser_mosaic.add_argument("layer_id")
+    parser_mosaic.add_argument(
+        "--bbox", required=True, help="EPSG:4326 west,south,east,north"
+    )
+    parser_mosaic.add_argument("--zoom", type=int, required=True)
+    parser_mosaic.add_argument("-o", "--output", required=True, help="TIFF path")
+    parser_mosaic.add_argument(
+        "--bigtiff", action="store_true", help="default is BigTIFF above 4 GiB only"
+    )
+    args = parser.parse_args()
+
+    if args.command == "tne-import":
+        tne_import(args.layers, args.remove)
+    elif args.command == "tne-export":
+        tne_export(args.layers)
+    elif args.command == "inventory-scan":
+        inventory_scan(args.layers)
+    elif args.command == "dedup":
+        dedup(args.layers, args.convert)
+    elif args.command == "migrate":
+        migrate(args.layers, args.src, args.dst)
+    elif args.command == "pmtiles-export":
+        pmtiles_export(args.layers, args.output)
+    elif args.command == "mosaic":
+        mosaic(args.layer_id, args.bbox, args.zoom, args.output, args.bigtiff)
+    else:
+        serve()
 
 
 if __name__ == "__main__":
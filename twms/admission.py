@@ -0,0 +1,273 @@
+"""Admission control for HTTP front end.
+
+`ThreadingHTTPServer` starts a thread for every connection, so concurrency
+is limited here: each request class has a number of render slots and a bounded
+waiting queue. Requests that don't fit are shed with "503 Service Unavailable".
+
+Per-client accounting keeps one heavy user of a shared instance from starving
+others: concurrent requests per client are capped and upstream fetches are
+scheduled fairly between clients.
+"""
+
+import collections
+import contextlib
+import threading
+import typing
+from concurrent.futures import Future
+
+
+class Overloaded(Exception):
+    """Request can't be admitted, client should retry later."""
+
+
+class AdmissionGate:
+    """Concurrency limit with bounded waiting queue for one request class."""
+
+    def __init__(self, name: str, concurrency: int, queue: int, timeout: float):
+        """Create gate.
+
+        Args:
+            name: request class name, for logging
+            concurrency: requests served simultaneously
+            queue: requests allowed to wait for a free slot
+            timeout: seconds to wait for a free slot
+        """
+        self.name = name
+        self.queue = queue
+        self.timeout = timeout
+        self.waiting = 0
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a slot or wait in queue.
+
+        >>> gate = AdmissionGate("map", concurrency=1, queue=0, timeout=0)
+        >>> gate.acquire()
+        >>> gate.acquire()
+        Traceback (most recent call last):
+        ...
+        twms.admission.Overloaded: 'map' queue is full
+        >>> gate.release()
+        >>> gate.acquire()
+        """
+        if self._slots.acquire(blocking=False):
+            return
+        with self._lock:
+            if self.waiting >= self.queue:
+                raise Overloaded(f"'{self.name}' queue is full")
+            self.waiting += 1
+        try:
+            if not self._slots.acquire(timeout=self.timeout):
+                raise Overloaded(f"'{self.name}' queue wait timeout")
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def release(self) -> None:
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def admit(self) -> typing.Iterator[None]:
+        """Hold a slot while serving request.
+
+        Raises:
+            Overloaded
+        """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def build_gates(limits: dict[str, dict[str, float]]) -> dict[str, AdmissionGate]:
+    """Create gate for each request class from config.
+
+    >>> gates = build_gates({"tile": {"concurrency": 2, "queue": 4, "timeout": 1}})
+    >>> gates["tile"].queue
+    4
+    """
+    return {
+        name: AdmissionGate(
+            name,
+            concurrency=int(limit["concurrency"]),
+            queue=int(limit["queue"]),
+            timeout=limit["timeout"],
+        )
+        for name, limit in limits.items()
+    }
+
+
+class QuotaExceeded(Overloaded):
+    """Client exceeded its own limit of concurrent requests."""
+
+
+class ClientLimiter:
+    """Count concurrent requests per client and cap them."""
+
+    def __init__(self, max_requests: int):
+        self.max_requests = max_requests
+        self.active: collections.Counter[str] = collections.Counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def admit(self, client: str) -> typing.Iterator[None]:
+        """Hold client request slot.
+
+        >>> limiter = ClientLimiter(max_requests=1)
+        >>> with limiter.admit("10.0.0.2"):
+        ...     with limiter.admit("10.0.0.3"):
+        ...         with limiter.admit("10.0.0.2"):
+        ...             pass
+        Traceback (most recent call last):
+        ...
+        twms.admission.QuotaExceeded: '10.0.0.2' has 1 requests in progress
+        >>> limiter.active
+        Counter()
+
+        Raises:
+            QuotaExceeded
+        """
+        with self._lock:
+            if self.active[client] >= self.max_requests:
+                raise QuotaExceeded(
+                    f"'{client}' has {self.active[client]} requests in progress"
+                )
+            self.active[client] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active[client] -= 1
+                if not self.active[client]:
+                    del self.active[client]
+
+
+class FairExecutor:
+    """Thread pool with weighted fair queueing of tasks between clients.
+
+    Each client has own FIFO queue. Free worker takes a task of a client with
+    least virtual time, which advances by `1 / weight` for each started task
+    (start-time fair queueing). So a client with thousands of queued fetches
+    can't delay a single tile requested by somebody else.
+
+    Drop-in replacement for `concurrent.futures.ThreadPoolExecutor.submit()`.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_per_client: int | None = None,
+        weights: dict[str, float] | None = None,
+        thread_name_prefix: str = "",
+    ):
+        """Create pool, threads are started on demand.
+
+        Args:
+            max_workers: number of worker threads
+            max_per_client: tasks of a single client running simultaneously,
+                no limit by default
+            weights: client share of workers, default is 1
+            thread_name_prefix: worker thread name prefix
+        """
+        self.max_workers = max_workers
+        self.max_per_client = max_per_client or max_workers
+        self.weights = weights or {}
+        self.thread_name_prefix = thread_name_prefix
+        self.running: collections.Counter[str] = collections.Counter()
+        self._queues: dict[str, collections.deque] = dict()
+        self._vtime: dict[str, float] = dict()
+        self._system_vtime = 0.0
+        self._threads: list[threading.Thread] = list()
+        self._idle = 0
+        self._shutdown = False
+        self._cond = threading.Condition()
+
+    def submit(self, fn, /, *args, client: str = "", **kwargs) -> Future:
+        """Schedule `fn(*args, **kwargs)` on behalf of a client.
+
+        >>> pool = FairExecutor(max_workers=1)
+        >>> pool.submit(pow, 2, 10, client="10.0.0.2").result()
+        1024
+        >>> pool.shutdown()
+        """
+        future: Future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            if client not in self._queues:
+                # Idle client can't accumulate credit
+                self._vtime[client] = max(
+                    self._vtime.get(client, 0.0), self._system_vtime
+                )
+                self._queues[client] = collections.deque()
+            self._queues[client].append((future, fn, args, kwargs))
+            # Burst needs a worker per task, not just some idle one
+            queued = sum(len(queue) for queue in self._queues.values())
+            if queued > self._idle and len(self._threads) < self.max_workers:
+                thread = threading.Thread(
+                    target=self._worker,
+                    name=f"{self.thread_name_prefix}_{len(self._threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        return future
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _pop(self) -> tuple | None:
+        """Take next task of the client with least virtual time."""
+        ready = [
+            client
+            for client, queue in self._queues.items()
+            if self.running[client] < self.max_per_client
+        ]
+        if not ready:
+            return None
+        client = min(ready, key=self._vtime.__getitem__)
+        queue = self._queues[client]
+        task = queue.popleft()
+        if not queue:
+            del self._queues[client]
+        self._system_vtime = self._vtime[client]
+        self._vtime[client] += 1 / self.weights.get(client, 1.0)
+        self.running[client] += 1
+        return client, *task
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                self._idle += 1
+                while (task := self._pop()) is None:
+                    if self._shutdown and not self._queues:
+                        self._idle -= 1
+                        return
+                    self._cond.wait()
+                self._idle -= 1
+            client, future, fn, args, kwargs = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as exc:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+            with self._cond:
+                self.running[client] -= 1
+                if not self.running[client]:
+                    del self.running[client]
+                    if client not in self._queues and (
+                        self._vtime[client] <= self._system_vtime
+                    ):
+                        del self._vtime[client]
+                # Client may be below its limit again
+                self._cond.notify_all()
@@ -14,14 +14,17 @@ def get_wms_url(layer) -> str:
     return f"{twms.config.service_wms_url}/{layer['prefix']}/{{z}}/{{x}}/{{y}}{ext}"
 
 
-def get_wmts_url(layer) -> str:
+def get_wmts_url(layer, suffix: str = "") -> str:
     """Generate simpleProfileTile URL.
 
     <ResourceURL format="image/png" resourceType="simpleProfileTile"
     template="http://tile.openstreetmap.org/{TileMatrix}/{TileCol}/{TileRow}.png"/>
+
+    Args:
+        suffix: "@2x" for 512 px tiles
     """
     ext = mimetypes.guess_extension(layer["mimetype"])
-    return f"{twms.config.service_wmts_url}/{layer['prefix']}/{{TileMatrix}}/{{TileCol}}/{{TileRow}}{ext}"
+    return f"{twms.config.service_wmts_url}/{layer['prefix']}{suffix}/{{TileMatrix}}/{{TileCol}}/{{TileRow}}{ext}"
 
 
 def get_tms_url(layer) -> str:
@@ -422,13 +425,25 @@ class TileMatrixSet:
         )
 
     def add_xml_element(
-        self, parent: ET.Element, proj: twms.projections.EPSG, levels: int = 24
+        self,
+        parent: ET.Element,
+        proj: twms.projections.EPSG,
+        levels: int = 24,
+        tile_size: int = 256,
     ) -> None:
         """Append TileMatrixSet to Capabilities XML.
 
         Cannot declare multiple TileMatrixSets with same Identifier
         (i.e. Simple WMTS "WorldCRS84Quad", "WorldWebMercatorQuad")
         but different CRS.
+
+        Larger tiles cover the same area as 256 px ones of the same level,
+        with finer pixels. Such set is identified like "EPSG:3857@2x".
+
+        >>> root = ET.Element("Contents")
+        >>> TileMatrixSet().add_xml_element(root, "EPSG:3857", 2, tile_size=512)
+        >>> [e.text for e in root.find("TileMatrixSet/TileMatrix")][1:4]
+        ['279541132.0143588', '-20037508.3427892 20037508.3427892', '512']
         """
         wkss = None
         if proj in self.mercator_crs:
@@ -440,7 +455,7 @@ class TileMatrixSet:
             wkss = "urn:ogc:def:wkss:OGC:1.0:GoogleMapsCompatible"
         else:
             top_left = "-180.0 90.0"
-        pixel_resolution = self.earth_circumference / self.tile_size
+        pixel_resolution = self.earth_circumference / tile_size
         scale_denominator = pixel_resolution / self.ogc_pixel_size  # Always meters
 
         # Annex E provides several well-known scale sets for TileMatrixSetDef
@@ -449,7 +464,11 @@ class TileMatrixSet:
         tilematrixset = ET.SubElement(parent, "TileMatrixSet")
         ET.SubElement(
             tilematrixset, "{http://www.opengis.net/ows/1.1}Identifier"
-        ).text = proj
+        ).text = (
+            proj
+            if tile_size == self.tile_size
+            else f"{proj}@{tile_size // self.tile_size}x"
+        )
 
         # JOSM looks for "urn:ogc:def:crs:" with "urn:ogc:def:crs:([^:]*)(?::.*)?:(.*)$",
         # so double semicolon like "urn:ogc:def:crs:EPSG::3857" should be fine
@@ -459,7 +478,7 @@ class TileMatrixSet:
         ).text = ("urn:ogc:def:crs:EPSG::" + proj.rsplit(":")[-1])
         # A WKSS is a commonly used combination of a CRS and a set of scales
         # https://docs.ogc.org/is/17-083r2/17-083r2.html
-        if proj == "EPSG:3857":
+        if proj == "EPSG:3857" and tile_size == self.tile_size:
             ET.SubElement(tilematrixset, "WellKnownScaleSet").text = wkss
 
         scale_factor = 2
@@ -476,8 +495,8 @@ class TileMatrixSet:
             )
             # Half of the Earth circumference (math.pi * sradiusa)
             ET.SubElement(tilematrix, "TopLeftCorner").text = top_left
-            ET.SubElement(tilematrix, "TileWidth").text = str(self.tile_size)
-            ET.SubElement(tilematrix, "TileHeight").text = str(self.tile_size)
+            ET.SubElement(tilematrix, "TileWidth").text = str(tile_size)
+            ET.SubElement(tilematrix, "TileHeight").text = str(tile_size)
             ET.SubElement(tilematrix, "MatrixWidth").text = str(matrix_width)
             ET.SubElement(tilematrix, "MatrixHeight").text = str(matrix_width)
 
@@ -518,51 +537,58 @@ def maps_wmts_rest() -> str:
     contents = ET.SubElement(root, "Contents")
 
     proj_set = set()
+    # 512 px tiles composed of four z+1 tiles, for high-DPI displays
+    suffixes = ("", "@2x") if twms.config.wmts_hidpi else ("",)
     for layer_id, layer_item in twms.config.layers.items():
         # if layer_item["proj"] not in self.tile_matrix_sets:
         #     logging.warning(f"Unsupported projection for '{layer_id}'")
         #     continue
-        layer = ET.SubElement(contents, "Layer")
-        ET.SubElement(layer, "{http://www.opengis.net/ows/1.1}Title").text = layer_item[
-            "name"
-        ]
-        wgs84_bbox = ET.SubElement(
-            layer, "{http://www.opengis.net/ows/1.1}WGS84BoundingBox"
-        )
-        ET.SubElement(
-            wgs84_bbox, "{http://www.opengis.net/ows/1.1}LowerCorner"
-        ).text = "{} {}".format(*layer_item["bounds"])
-        ET.SubElement(
-            wgs84_bbox, "{http://www.opengis.net/ows/1.1}UpperCorner"
-        ).text = "{2} {3}".format(*layer_item["bounds"])
-        ET.SubElement(
-            layer, "{http://www.opengis.net/ows/1.1}Identifier"
-        ).text = layer_id
-        # Style mandatory: Identifier,
-        style = ET.SubElement(layer, "Style", attrib={"isDefault": "true"})
-        ET.SubElement(
-            style, "{http://www.opengis.net/ows/1.1}Identifier"
-        ).text = "default"
-        ET.SubElement(layer, "Format").text = layer_item["mimetype"]
-
-        tilematrixset_link = ET.SubElement(layer, "TileMatrixSetLink")
-        ET.SubElement(tilematrixset_link, "TileMatrixSet").text = layer_item["proj"]
-        # resourceType: ("tile", "simpleProfileTile", "simpleProfileCRSTile").
-        # JOSM supports "tile" only
-        ET.SubElement(
-            layer,
-            "ResourceURL",
-            attrib={
-                "format": layer_item["mimetype"],
-                "resourceType": "tile",
-                "template": get_wmts_url(layer_item),
-            },
-        )
+        for suffix in suffixes:
+            layer = ET.SubElement(contents, "Layer")
+            ET.SubElement(layer, "{http://www.opengis.net/ows/1.1}Title").text = (
+                f"{layer_item['name']} (512 px)" if suffix else layer_item["name"]
+            )
+            wgs84_bbox = ET.SubElement(
+                layer, "{http://www.opengis.net/ows/1.1}WGS84BoundingBox"
+            )
+            ET.SubElement(
+                wgs84_bbox, "{http://www.opengis.net/ows/1.1}LowerCorner"
+            ).text = "{} {}".format(*layer_item["bounds"])
+            ET.SubElement(
+                wgs84_bbox, "{http://www.opengis.net/ows/1.1}UpperCorner"
+            ).text = "{2} {3}".format(*layer_item["bounds"])
+            ET.SubElement(layer, "{http://www.opengis.net/ows/1.1}Identifier").text = (
+                f"{layer_id}{suffix}"
+            )
+            # Style mandatory: Identifier,
+            style = ET.SubElement(layer, "Style", attrib={"isDefault": "true"})
+            ET.SubElement(style, "{http://www.opengis.net/ows/1.1}Identifier").text = (
+                "default"
+            )
+            ET.SubElement(layer, "Format").text = layer_item["mimetype"]
+
+            tilematrixset_link = ET.SubElement(layer, "TileMatrixSetLink")
+            ET.SubElement(tilematrixset_link, "TileMatrixSet").text = (
+                f"{layer_item['proj']}{suffix}"
+            )
+            # resourceType: ("tile", "simpleProfileTile", "simpleProfileCRSTile").
+            # JOSM supports "tile" only
+            ET.SubElement(
+                layer,
+                "ResourceURL",
+                attrib={
+                    "format": layer_item["mimetype"],
+                    "resourceType": "tile",
+                    "template": get_wmts_url(layer_item, suffix),
+                },
+            )
         proj_set.add(layer_item["proj"])
 
     tm_set = TileMatrixSet()
     for proj in proj_set:
         tm_set.add_xml_element(contents, proj=proj)
+        if twms.config.wmts_hidpi:
+            tm_set.add_xml_element(contents, proj=proj, tile_size=512)
     # tm_set.add_xml_element(contents, proj="CRS84")
 
     ET.SubElement(
@@ -95,12 +95,50 @@ tiles_cache = os.path.expanduser("~/dev/gis/sasplanet/SAS.Planet/cache_ma/")
 # tiles_cache = os.path.expanduser("~/dev/gis/sasplanet/SAS.Planet/cache_test/")
 
 ram_cache_tiles = 2048  # Number of tiles in RAM cache
+ram_cache_plans = 1024  # Number of WMS GetMap geometries to keep precomputed
+coverage_max_zoom = 14  # Rasterize layer "coverage" polygons up to this zoom
+# Disk quota, bytes, for all layers together. See also layer "cache_quota".
+# Least recently used tiles are evicted down to 'janitor_target' of quota
+cache_quota: int | None = None  # e.g. 50 * 2**30
+janitor_interval = 600  # seconds between quota checks
+janitor_target = 0.9
+janitor_batch = 1000  # files processed between pauses
+janitor_pause = 0.1  # seconds, leave disk for the server
+inventory_threads = 8  # Parallel directory scan of layer "inventory" at startup
+mosaic_threads = 8  # Parallel tile readers of `python -m twms mosaic` export
+tne_index_save_interval = 300  # seconds, persist TNE indexes. See layer "tne_index"
 dl_threads_per_layer = 5
+# Write fetched tiles to cache in background. 0 to write before response
+write_behind_threads = 2
+write_behind_queue = 1024  # tiles waiting to be written, fetching blocks when full
+request_timeout = 120  # seconds, stop rendering when exceeded. None to disable
+cancel_poll_interval = 0.5  # seconds, how often to check for client disconnect
+
+# Admission control: concurrent requests and waiting queue length per request class.
+# "tile" - tile passthrough, mostly cache hits; "map" - WMS GetMap reprojection and composition
+admission = {
+    "tile": {"concurrency": 32, "queue": 256, "timeout": 30},
+    "map": {"concurrency": 4, "queue": 8, "timeout": 30},
+}
+retry_after = 5  # seconds, 'Retry-After' header for shed requests
+
+# Per-client fairness for a shared instance. Client is identified by
+# 'client_header' token or by IP address if header is missing
+client_header = "X-TWMS-Client"
+client_max_requests = 16  # concurrent HTTP requests per client
+client_max_fetches = None  # concurrent upstream fetches per client per layer, None for all of `dl_threads_per_layer`
+# Client share of fetch threads, e.g. {"192.168.1.10": 2.0}, default 1.0
+client_weights: dict[str, float] = {}
 
 # WMS GetCapabilities
 default_layers = ""  # layer(s) to show when no layers given explicitly
 max_height = 4095  # WMS maximal allowed requested height
 max_width = 4095  # WMS maximal allowed requested width
+# Stream PNG taller than this in strips, 0 to render whole image. Streamed
+# response has no Content-Length, so an error or request_timeout after the
+# first strip leaves the client with a truncated PNG instead of an error status
+wms_strip_height = 1024
+wmts_hidpi = True  # Advertise "{layer_id}@2x" 512 px WMTS layers composed of z+1 tiles
 
 
 layer_defaults = {
@@ -113,16 +151,30 @@ layer_defaults = {
     "proj": "EPSG:3857",  # str EPSG code of layer tiles projection.
     "empty_color": "#ffffff",  # PIL color string. If this layer is overlayed over another, this color will be considered transparent. Also used for dead tile detection in fetchers.WMS
     "cache_ttl": None,  # int cache expiration time
+    "cache_quota": None,  # int bytes, evict least recently used tiles when exceeded
+    "cache_type": "ma",  # str "ma" - SAS.Planet MOBAC "{z}/{x}/{y}{ext}" files, "sqlite" - SAS.Planet SQLite cache (no dedup, inventory, tne_index), "pmtiles" - read-only "{prefix}.pmtiles" archive, no fetching. See `python -m twms pmtiles-export`
+    "dedup": False,  # bool Store identical tiles once in ".blobs/", hardlinked to "{z}/{x}/{y}". See `python -m twms dedup`
+    "layout": "tms",  # str Cache directory layout for "ma" cache_type: "tms" - "{z}/{x}/{y}", "tc" - MapProxy "zz/xxx/xxx/xxx/yyy/yyy/yyy", "quadkey", "hashed". Inventory works with "tms" only. See `twms.layouts`
+    "layout_previous": None,  # str Layout to move tiles from on access, while `python -m twms migrate` moves the rest
+    "tne_subtree": None,  # int seconds. Don't fetch children of TNE tiles, re-probe upstream once per this period. For sparse coverage layers
+    "tne_index": False,  # bool Keep TNE markers in compact "tne.twms" index file instead of SAS.Planet "*.tne" files. See `python -m twms tne-export`
+    # "inventory": None - check cache files on disk for each request; "scan" - keep cache files list in RAM, built at startup; "watch" - also track files written by SAS.Planet with inotify (Linux)
+    "inventory": None,
     # WGS84 (EPSG:4326) (min-lon, min-lat, max-lon, max-lat; lower left and upper right corners; W, S, E, N) no wms fetching will be performed outside this bbox.
     "bounds": (-180.0, -85.0511287798, 180.0, 85.0511287798),
+    "coverage": None,  # str GeoJSON (Multi)Polygon file in EPSG:4326, path relative to this file. Narrows "bounds"
     # "dead_tile": { dict, if given, loaded tiles matching pattern won't be saved.
     #     "md5": {}, # set of md5sum hashes of that tile
-    #     "size" tile size in bytes
+    #     "size" tile size in bytes, body isn't hashed unless size matches
     #     "sha256"
     #     "http_status": 503  # TNE by HTTP status code
     # }
     "fetch": "tms",  # str name of the function that fetches tiles. func(z, x, y, layer_id) -> Imaga.Image | None
     "headers": dict(),  # Headers and authentication cookies
+    "validate": "header",  # str "header" - check format, size and end marker only, decode on demand; "full" - decode fetched tiles
+    "max_body_size": 4194304,  # int bytes (4 MiB), larger responses (e.g. HTML error pages) are discarded. Per tile for metatiles
+    "metatile": 1,  # int Fetch N×N tiles block with a single "{bbox}" (WMS) request, e.g. 4 for 1024×1024 px. Tiles of a block being fetched wait for it
+    "quality": "best",  # str "best" resamples source tiles with Lanczos, "fast" decodes JPEG at 1/2..1/8 scale (DCT draft) and reduces by box filter when downscaling. WMS "quality" parameter overrides it
     "min_zoom": 0,  # >= zoom to load
     "max_zoom": 19,  # <= # Load tiles with equal or less zoom. Can be set with 'max_zoom' per layer. [19] 30 cm resolution - best Maxar satellite resolution at 2021
     "scalable": False,  # bool Could zN tile be constructed of four z(N+1) tiles. Construct tile from available better ones. If False, tWMS will use nearest zoom level
@@ -238,7 +290,10 @@ layers: dict[str, dict[str, typing.Any]] = {
         "prefix": "ncaby_radr",
         "mimetype": "image/png",
         "bounds": (23.16722, 51.25930, 32.82244, 56.18162),  # Belarus
+        # "coverage": "belarus.geojson",  # Country outline, skips neighbours
         "min_zoom": 15,
+        "tne_index": True,
+        "metatile": 4,  # WMS renders labels across tile edges consistently
         "remote_url": "http://gisserver3.nca.by:8080/geoserver/wms?SERVICE=WMS&VERSION=1.3.0&REQUEST=GetMap&FORMAT=image/png&TRANSPARENT=true&layers=prod:radr&propertyName=obj_name,elementtyp,elementnam,addr_label,geom&TILED=true&STYLES=addr_ks&WIDTH={width}&HEIGHT={height}&CRS={proj}&BBOX={bbox}",
         "cache_ttl": 60 * 60 * 24 * 30,  # 1 month
     },
@@ -314,6 +369,7 @@ layers: dict[str, dict[str, typing.Any]] = {
         "provider_url": "https://www.dzz.by/izuchdzz/",  # https://beldzz.by/
         "prefix": "dzzby_orthophoto",
         "bounds": (23.16722, 51.25930, 32.82244, 56.18162),  # Belarus
+        # "coverage": "belarus.geojson",  # Country outline, skips neighbours
         # nca.by has sane proxy (valid 404, SSL certificate)
         # https://api.nca.by/gis/dzz/tile/11/41342/76532
         # "remote_url": "https://api.nca.by/gis/dzz/tile/{z}/{y}/{x}",  # GeoIP 403
@@ -328,6 +384,7 @@ layers: dict[str, dict[str, typing.Any]] = {
         "transform_tile_number": lambda z, x, y: (z - 6, x, y),
         "min_zoom": 6,
         "max_zoom": 19,  # max_zoom is 20, but in most places it just blurred 19
+        "tne_subtree": 60 * 60 * 24 * 7,  # Week
         # "scalable": True,
         "dead_tile": {"http_status": 502, "md5": {"d95150a258cdd8d2c6282c406c287b81"}},
     },
@@ -356,6 +413,8 @@ layers: dict[str, dict[str, typing.Any]] = {
         "transform_tile_number": lambda z, x, y: (z - 8, x, y),
         "min_zoom": 8,
         "max_zoom": 22,
+        "tne_index": True,
+        "tne_subtree": 60 * 60 * 24 * 7,  # Week
         "dead_tile": {
             "http_status": 502,
             "md5": {
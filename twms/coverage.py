@@ -0,0 +1,209 @@
+"""Layer coverage compiled into per-zoom tile ranges and bitmaps.
+
+Checking tile bbox against layer bounds costs several projection transforms
+per tile. Instead bounds are converted to tile number ranges for each zoom
+level once, and coverage polygon (e.g. country outline from GeoJSON file)
+is rasterized into per-zoom tile bitmaps. Then both checks are index lookups.
+"""
+
+import json
+import logging
+import math
+import pathlib
+
+import twms.bbox
+import twms.projections
+
+logger = logging.getLogger(__name__)
+
+MAX_ZOOM = 31
+MAX_BITMAP_TILES = 2**24  # Don't rasterize deeper if bitmap would be larger
+
+Ring = list[twms.bbox.Point]
+
+
+def load_geojson(path: str | pathlib.Path) -> list[Ring]:
+    """Read rings of all Polygon and MultiPolygon geometries from GeoJSON file.
+
+    Outer rings and holes are returned together, as even-odd rule
+    is used to rasterize them.
+    """
+    with open(path, encoding="utf-8") as f:
+        geojson = json.load(f)
+    rings: list[Ring] = list()
+
+    def walk(obj: dict) -> None:
+        if obj["type"] == "FeatureCollection":
+            for feature in obj["features"]:
+                walk(feature)
+        elif obj["type"] == "Feature":
+            walk(obj["geometry"])
+        elif obj["type"] == "GeometryCollection":
+            for geometry in obj["geometries"]:
+                walk(geometry)
+        elif obj["type"] == "Polygon":
+            rings.extend([tuple(p[:2]) for p in ring] for ring in obj["coordinates"])
+        elif obj["type"] == "MultiPolygon":
+            for polygon in obj["coordinates"]:
+                rings.extend([tuple(p[:2]) for p in ring] for ring in polygon)
+
+    walk(geojson)
+    return rings
+
+
+class TileBitmap:
+    """Set of tiles of a single zoom level, stored as a byte per tile."""
+
+    def __init__(self, x0: int, y0: int, x1: int, y1: int):
+        """Empty bitmap covering tile ranges [x0, x1], [y0, y1]."""
+        self.x0, self.y0, self.x1, self.y1 = x0, y0, x1, y1
+        self.width = x1 - x0 + 1
+        self.bits = bytearray(self.width * (y1 - y0 + 1))
+
+    def __contains__(self, xy: tuple[int, int]) -> bool:
+        x, y = xy
+        if self.x0 <= x <= self.x1 and self.y0 <= y <= self.y1:
+            return bool(self.bits[(y - self.y0) * self.width + x - self.x0])
+        return False
+
+    def mark(self, y: int, x_from: int, x_to: int) -> None:
+        """Add tiles of a row."""
+        if not self.y0 <= y <= self.y1:
+            return
+        x_from, x_to = max(x_from, self.x0), min(x_to, self.x1)
+        if x_from > x_to:
+            return
+        row = (y - self.y0) * self.width - self.x0
+        start, end = row + x_from, row + x_to + 1
+        self.bits[start:end] = b"\x01" * (end - start)
+
+
+def rasterize(rings: list[list[tuple[float, float]]], zoom: int) -> TileBitmap:
+    """Find tiles intersecting polygon given in zoom 0 tile coordinates.
+
+    Tile intersects polygon if any polygon edge crosses it, otherwise it
+    is either fully inside or outside, which is tested by its center.
+
+    >>> square = [(0.25, 0.25), (0.75, 0.25), (0.75, 0.75), (0.25, 0.75)]
+    >>> bitmap = rasterize([square], 3)
+    >>> (1, 1) in bitmap, (2, 3) in bitmap, (7, 7) in bitmap, (0, 0) in bitmap
+    (False, True, False, False)
+    >>> (2, 2) in bitmap, (5, 5) in bitmap
+    (True, True)
+    """
+    n = 2**zoom
+    points = [p for ring in rings for p in ring]
+    bitmap = TileBitmap(
+        max(0, int(min(p[0] for p in points) * n)),
+        max(0, int(min(p[1] for p in points) * n)),
+        min(n - 1, int(max(p[0] for p in points) * n)),
+        min(n - 1, int(max(p[1] for p in points) * n)),
+    )
+    crossings: dict[int, list[float]] = dict()
+    for ring in rings:
+        for i in range(len(ring)):
+            ax, ay = ring[i - 1][0] * n, ring[i - 1][1] * n
+            bx, by = ring[i][0] * n, ring[i][1] * n
+            y_lo, y_hi = min(ay, by), max(ay, by)
+            # Tiles crossed by the edge, row by row
+            for row in range(int(y_lo), min(int(y_hi), bitmap.y1) + 1):
+                if ay == by:
+                    xs = (ax, bx)
+                else:
+                    xs = tuple(
+                        ax + (yc - ay) * (bx - ax) / (by - ay)
+                        for yc in (max(y_lo, row), min(y_hi, row + 1))
+                    )
+                bitmap.mark(row, math.floor(min(xs)), math.floor(max(xs)))
+            # Crossings of tile rows center lines
+            for row in range(math.ceil(y_lo - 0.5), math.ceil(y_hi - 0.5)):
+                yc = row + 0.5
+                crossings.setdefault(row, list()).append(
+                    ax + (yc - ay) * (bx - ax) / (by - ay)
+                )
+    # Tiles inside polygon, by even-odd rule
+    for row, xs in crossings.items():
+        xs.sort()
+        for x_from, x_to in zip(xs[::2], xs[1::2]):
+            bitmap.mark(row, math.ceil(x_from - 0.5), math.floor(x_to - 0.5))
+    return bitmap
+
+
+class CoverageMask:
+    """Tiles of a layer pyramid covered by bounds and optional polygon."""
+
+    def __init__(
+        self,
+        bounds: twms.bbox.Bbox,
+        proj: twms.projections.EPSG,
+        rings: list[Ring] | None = None,
+        max_bitmap_zoom: int = 14,
+    ):
+        """Compile coverage.
+
+        Args:
+            bounds: EPSG:4326 bbox
+            proj: layer tiles projection
+            rings: EPSG:4326 polygon rings
+            max_bitmap_zoom: rasterize polygon up to this zoom, deeper
+                tiles are checked by their ancestor
+        """
+        minx, miny = twms.projections.tile_by_coords((bounds[0], bounds[3]), 0, proj)
+        maxx, maxy = twms.projections.tile_by_coords((bounds[2], bounds[1]), 0, proj)
+        # Tiles touching bounds are included, as in `bbox.bbox_is_in(fully=False)`
+        self.ranges = list()
+        for z in range(MAX_ZOOM + 1):
+            n = 2**z
+            self.ranges.append(
+                (
+                    min(max(math.ceil(minx * n) - 1, 0), n - 1),
+                    min(max(math.ceil(miny * n) - 1, 0), n - 1),
+                    min(max(math.floor(maxx * n), 0), n - 1),
+                    min(max(math.floor(maxy * n), 0), n - 1),
+                )
+            )
+
+        self.bitmaps: list[TileBitmap] = list()
+        if rings:
+            # Project once into zoom 0 tile coordinates
+            projected = [
+                [twms.projections.tile_by_coords(p, 0, proj) for p in ring]
+                for ring in rings
+            ]
+            for z in range(max_bitmap_zoom + 1):
+                bitmap = rasterize(projected, z)
+                if len(bitmap.bits) > MAX_BITMAP_TILES:
+                    break
+                self.bitmaps.append(bitmap)
+
+    @classmethod
+    def for_layer(cls, layer: dict, max_bitmap_zoom: int = 14) -> "CoverageMask":
+        """Compile layer "bounds" and "coverage" GeoJSON file."""
+        rings = None
+        if layer["coverage"]:
+            path = pathlib.Path(layer["coverage"]).expanduser()
+            if not path.is_absolute():
+                path = pathlib.Path(__file__).parent / path
+            rings = load_geojson(path)
+            logger.info(f"{layer['prefix']}: compiling coverage '{path}'")
+        return cls(layer["bounds"], layer["proj"], rings, max_bitmap_zoom)
+
+    def contains(self, z: int, x: int, y: int) -> bool:
+        """Check whether tile is inside layer coverage.
+
+        >>> mask = CoverageMask((23.16722, 51.25930, 32.82244, 56.18162), "EPSG:3857")
+        >>> mask.contains(10, 585, 331), mask.contains(10, 620, 331)
+        (True, False)
+        >>> mask.contains(0, 0, 0)
+        True
+        """
+        if z > MAX_ZOOM:
+            return True
+        x0, y0, x1, y1 = self.ranges[z]
+        if not (x0 <= x <= x1 and y0 <= y <= y1):
+            return False
+        if self.bitmaps:
+            bz = min(z, len(self.bitmaps) - 1)
+            shift = z - bz
+            return (x >> shift, y >> shift) in self.bitmaps[bz]
+        return True
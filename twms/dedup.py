@@ -0,0 +1,231 @@
+"""Deduplicating tile storage.
+
+Large parts of a cache are byte-identical tiles: sea, blank `empty_color`
+areas, "no imagery" placeholders. In dedup mode each unique tile is stored
+once as `{layer}/.blobs/{sha256[:2]}/{sha256}{ext}` and hardlinked into
+`{z}/{x}/{y}{ext}` (or other layer "layout"), so the layout stays readable by SAS.Planet and MapProxy,
+while duplicates share disk blocks and page cache.
+
+Hardlink count is the reference count: blob with `st_nlink == 1` is not
+referenced by any tile and is removed by `BlobStore.collect_garbage()`.
+
+Links share blob mtime, so a tile just fetched would look as old as the
+first tile with the same content. Time each tile was stored is kept in
+`FetchIndex` instead, for "cache_ttl" checks and janitor.
+"""
+
+import contextlib
+import errno
+import hashlib
+import logging
+import mimetypes
+import os
+import pathlib
+import threading
+
+import twms.config
+import twms.layouts
+import twms.tne
+import twms.writer
+
+logger = logging.getLogger(__name__)
+
+BLOBS_DIR = ".blobs"
+
+
+class FetchIndex(twms.tne.TneIndex):
+    """Time deduplicated tiles were stored, stored like TNE index."""
+
+    magic = b"TWMSFET1"
+    name = "fetched.twms"
+
+
+class BlobStore:
+    """Unique tile contents of a single layer."""
+
+    def __init__(
+        self,
+        layer_dir: str | pathlib.Path,
+        ext: str,
+        layout: str = "tms",
+        fetched: FetchIndex | None = None,
+    ):
+        """Create store.
+
+        Args:
+            layer_dir: layer cache directory
+            ext: tile file extension, e.g. ".jpg"
+            layout: cache directory layout
+            fetched: per tile store time, RAM-only if None
+        """
+        self.layer_dir = pathlib.Path(layer_dir)
+        self.blobs_dir = self.layer_dir / BLOBS_DIR
+        self.ext = ext
+        self.layout = layout
+        self.fetched = fetched if fetched is not None else FetchIndex()
+
+    def stored(self, z: int, x: int, y: int, timestamp: float | None = None) -> None:
+        """Record tile store time, now by default."""
+        self.fetched.add(z, x, y, timestamp)
+
+    def forget(self, z: int, x: int, y: int) -> None:
+        self.fetched.remove(z, x, y)
+
+    def mtime(self, z: int, x: int, y: int, st_mtime: float) -> float:
+        """Tile store time instead of shared blob mtime.
+
+        >>> import tempfile
+        >>> store = BlobStore(tempfile.mkdtemp(), ".png")
+        >>> store.stored(3, 1, 2, timestamp=1700000000)
+        >>> store.mtime(3, 1, 2, 1600000000), store.mtime(3, 1, 1, 1600000000)
+        (1700000000, 1600000000)
+
+        Args:
+            st_mtime: file mtime, used for tiles stored before recording
+                started or by other programs
+        """
+        stamp = self.fetched.get(z, x, y)
+        return st_mtime if stamp is None else stamp
+
+    def blob_path(self, digest: str) -> pathlib.Path:
+        return self.blobs_dir / digest[:2] / f"{digest}{self.ext}"
+
+    def link(self, path: pathlib.Path, blob: bytes | memoryview) -> None:
+        """Store tile as hardlink to its unique blob, atomically.
+
+        >>> import tempfile
+        >>> store = BlobStore(tempfile.mkdtemp(), ".png")
+        >>> for y in range(3):
+        ...     store.link(store.layer_dir / f"1/0/{y}.png", b"sea")
+        >>> store.stats()
+        (3, 9, 3)
+        """
+        blob_path = self.blob_path(hashlib.sha256(blob).hexdigest())
+        try:
+            if os.path.samefile(path, blob_path):
+                return
+        except FileNotFoundError:
+            pass
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{threading.get_native_id()}.tmp")
+        for _ in range(3):
+            if not blob_path.exists():
+                blob_path.parent.mkdir(parents=True, exist_ok=True)
+                twms.writer.write_atomic(blob_path, blob)
+            try:
+                os.link(blob_path, tmp)
+                break
+            except FileNotFoundError:
+                continue  # Blob was collected meanwhile
+            except OSError as err:
+                if err.errno != errno.EMLINK:
+                    raise
+                # Filesystem link limit reached (65000 for ext4), so start
+                # a new copy. Old one stays referenced by existing tiles
+                with contextlib.suppress(FileNotFoundError):
+                    ino = os.stat(blob_path).st_ino
+                    os.replace(
+                        blob_path, blob_path.with_stem(f"{blob_path.stem}.{ino}")
+                    )
+        else:
+            twms.writer.write_atomic(path, blob)
+            return
+        os.replace(tmp, path)
+
+    def unlink(self, path: pathlib.Path) -> None:
+        """Remove tile and its blob if that was the last reference."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        if st.st_nlink > 1:
+            blob_path = self.blob_path(hashlib.sha256(path.read_bytes()).hexdigest())
+            path.unlink(missing_ok=True)
+            try:
+                blob_st = os.stat(blob_path)
+                if blob_st.st_ino == st.st_ino and blob_st.st_nlink == 1:
+                    blob_path.unlink()
+            except FileNotFoundError:
+                pass
+        else:
+            path.unlink(missing_ok=True)
+
+    def collect_garbage(self) -> int:
+        """Remove blobs not referenced by tiles, e.g. after overwrite or eviction.
+
+        Returns:
+            Number of removed blobs.
+        """
+        count = 0
+        for prefix in _scandir(self.blobs_dir):
+            for entry in _scandir(prefix.path):
+                try:
+                    if entry.stat().st_nlink == 1:
+                        os.unlink(entry.path)
+                        count += 1
+                except FileNotFoundError:
+                    pass
+        return count
+
+    def stats(self) -> tuple[int, int, int]:
+        """Measure deduplication.
+
+        Returns:
+            Number of tiles, their total size and size of unique files.
+        """
+        tiles = logical = physical = 0
+        inodes = set()
+        for _, path, st in self._tiles():
+            tiles += 1
+            logical += st.st_size
+            if st.st_ino not in inodes:
+                inodes.add(st.st_ino)
+                physical += st.st_size
+        return tiles, logical, physical
+
+    def convert(self) -> int:
+        """Deduplicate existing tiles.
+
+        Returns:
+            Number of tiles replaced by a link to an existing blob.
+        """
+        count = 0
+        for (z, x, y), path, st in self._tiles():
+            if st.st_nlink > 1:
+                continue  # Already linked
+            blob = path.read_bytes()
+            blob_path = self.blob_path(hashlib.sha256(blob).hexdigest())
+            count += blob_path.exists()
+            self.stored(z, x, y, timestamp=st.st_mtime)
+            self.link(path, blob)
+        return count
+
+    def _tiles(self):
+        """Iterate over ((z, x, y), path, stat) of tile files."""
+        for z, x, y, _, entry in twms.layouts.walk(
+            self.layer_dir, self.layout, (self.ext,)
+        ):
+            try:
+                yield (z, x, y), pathlib.Path(entry.path), entry.stat()
+            except FileNotFoundError:
+                pass
+
+
+def _scandir(path: str | pathlib.Path) -> list[os.DirEntry]:
+    try:
+        with os.scandir(path) as it:
+            return list(it)
+    except FileNotFoundError:
+        return []
+
+
+def for_layer(layer: dict) -> BlobStore | None:
+    """Return blob store of a layer or None if layer has no "dedup"."""
+    if not layer["dedup"]:
+        return None
+    return BlobStore(
+        pathlib.Path(twms.config.tiles_cache) / layer["prefix"],
+        mimetypes.guess_extension(layer["mimetype"]),
+        layer["layout"],
+        twms.tne.get_index(layer["prefix"], FetchIndex),
+    )
@@ -1,3 +1,4 @@
+import contextlib
 import functools
 import hashlib
 import http
@@ -9,16 +10,28 @@ import mimetypes
 import pathlib
 import re
 import textwrap
+import threading
 import time
 import urllib.error
 import urllib.request
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import CancelledError, Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from io import BytesIO
 
 import PIL.Image
 
+import twms.admission
 import twms.config
+import twms.dedup
+import twms.inventory
+import twms.janitor
+import twms.layouts
+import twms.pmtiles
 import twms.projections
+import twms.request
+import twms.sasplanet
+import twms.tne
+import twms.writer
 
 # import ssl
 # ssl._create_default_https_context = ssl._create_unverified_context  # Disable context for gismap.by
@@ -49,10 +62,17 @@ class TileFile:
         x: int,
         y: int,
         ttl: int | None = None,
+        tne_index: twms.tne.TneIndex | None = None,
+        inventory: twms.inventory.Inventory | None = None,
+        writer: twms.writer.WriteBehind | None = None,
+        blobs: twms.dedup.BlobStore | None = None,
+        layout: str = "tms",
+        layout_previous: str | None = None,
     ):
         """Filesystem tile storage "cache_dir/layer_id/z/x/y.ext".
 
-        Conforms SAS.Planet (with TNE), MOBAC, MapProxy 'tms' directory layout.
+        Conforms SAS.Planet (with TNE), MOBAC, MapProxy 'tms' directory layout,
+        other layouts are in `twms.layouts`.
 
         TNE - tile not exist (got HTTP 404 or default tile for empty zones aka "dead tile")
 
@@ -64,19 +84,43 @@ class TileFile:
             x: tile coordinate
             y: tile coordinate (positive)
             ttl: time-to-live, seconds or None
+            tne_index: keep TNE markers in the index instead of `*.tne` files
+            inventory: layer cache inventory to check tile state without stat()
+            writer: write tiles to disk in background
+            blobs: store identical tiles once, as hardlinks to a blob
+            layout: cache directory layout
+            layout_previous: layout to move tile from on first access
         """
         self.mimetype = mimetype
         self.ttl = ttl
+        self.tne_index = tne_index
+        self.inventory = inventory
+        self.writer = writer
+        self.blobs = blobs
 
         z, x, y = int(z), int(x), int(y)  # Prevent floats from messing up path
+        self.z, self.x, self.y = z, x, y
         prefix = pathlib.Path(cache_dir) / layer_id
         ext = mimetypes.guess_extension(self.mimetype)
-        self.path = prefix / f"{z}/{x}/{y}{ext}"
-        self.path_tne = prefix / f"{z}/{x}/{y}.tne"  # Tile not exists
+        path = twms.layouts.tile_path(layout, z, x, y)
+        self.path = prefix / f"{path}{ext}"
+        self.path_tne = prefix / f"{path}.tne"  # Tile not exists
+        self.previous = None
+        if layout_previous and layout_previous != layout:
+            path = twms.layouts.tile_path(layout_previous, z, x, y)
+            self.previous = (prefix / f"{path}{ext}", prefix / f"{path}.tne")
 
     def __str__(self):
         return f"'{self.mimetype}' TTL: {self.ttl}, '{self.path}'"
 
+    def adopt_previous(self) -> None:
+        """Move tile from previous layout, so cache migrates while serving."""
+        if self.previous is None:
+            return
+        for src, dst in zip(self.previous, (self.path, self.path_tne)):
+            twms.layouts.move(src, dst)
+        self.previous = None
+
     def get(self) -> pathlib.Path:
         """Get tile path.
 
@@ -86,30 +130,100 @@ class TileFile:
         logger.debug(f"Cache hit 'file://{self.path}'")
         return self.path
 
-    def set(self, blob: bytes | None = None) -> None:
+    def read(self) -> bytes:
+        """Read tile image data.
+
+        Must check `needs_fetch()` or `exists()` before.
+        """
+        if self.writer is not None:
+            pending, blob = self.writer.pending(self.path)
+            if pending and blob:
+                return bytes(blob)
+        self.adopt_previous()
+        try:
+            return self.get().read_bytes()
+        except FileNotFoundError:
+            if self.inventory is not None:
+                # Deleted behind our back
+                self.inventory.discard_tile(self.z, self.x, self.y)
+            raise
+
+    def set(self, blob: bytes | memoryview | None = None) -> None:
         """Set image to cache and remove TNE.
 
+        Written to disk in background if layer has write-behind writer.
+
         Args:
             blob: Image data. Create TNE file is None (tile not exists).
         """
         logger.debug(f"Saving {self.path}")
-        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.tne_index is not None and not blob:
+            logger.warning(f"TILE NOT EXISTS {self.path_tne} (index)")
+            self.tne_index.add(self.z, self.x, self.y)
+            return
         if blob:
-            self.path.write_bytes(blob)  # Overwrite if exists, newer delete
-            self.path_tne.unlink(missing_ok=True)  # Remove TNE-files only there
+            if self.inventory is not None:
+                self.inventory.set_tile(self.z, self.x, self.y, time.time(), len(blob))
+            if self.tne_index is not None:
+                self.tne_index.remove(self.z, self.x, self.y)
+            elif self.inventory is not None:
+                self.inventory.discard_tne(self.z, self.x, self.y)
         else:
-            # Empty file, no timestamp inside to save disk space
             logger.warning(f"TILE NOT EXISTS {self.path_tne}")
+            if self.inventory is not None:
+                self.inventory.set_tne(self.z, self.x, self.y, time.time())
+        if self.writer is not None:
+            self.writer.submit(self, blob)
+        else:
+            self.write(blob)
+
+    def write(self, blob: bytes | memoryview | None, mkdir: bool = True) -> None:
+        """Write tile or TNE file to disk."""
+        if mkdir:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        if blob:
+            # Overwrite if exists, newer delete
+            if self.blobs is not None:
+                self.blobs.link(self.path, blob)
+                self.blobs.stored(self.z, self.x, self.y)
+            else:
+                twms.writer.write_atomic(self.path, blob)
+            if self.tne_index is None:
+                self.path_tne.unlink(missing_ok=True)  # Remove TNE-files only there
+        else:
+            # Empty file, no timestamp inside to save disk space
             self.path_tne.touch()
 
     def delete(self) -> None:
         logger.info(f"Deleting '{self.path}', '{self.path_tne}'")
-        self.path.unlink(missing_ok=True)
+        if self.writer is not None:
+            self.writer.discard(self.path)
+        if self.blobs is not None:
+            self.blobs.unlink(self.path)
+            self.blobs.forget(self.z, self.x, self.y)
+        else:
+            self.path.unlink(missing_ok=True)
         self.path_tne.unlink(missing_ok=True)
+        if self.tne_index is not None:
+            self.tne_index.remove(self.z, self.x, self.y)
+        if self.inventory is not None:
+            self.inventory.discard_tile(self.z, self.x, self.y)
+            self.inventory.discard_tne(self.z, self.x, self.y)
+
+    def indexed(self) -> bool:
+        """Check whether tile state can be taken from inventory."""
+        return self.inventory is not None and self.inventory.ready.is_set()
 
     def exists(self) -> bool:
         """For filling map."""
         # Return (1, timestamp) in SQL
+        if self.writer is not None:
+            pending, blob = self.writer.pending(self.path)
+            if pending and blob:
+                return True
+        if self.indexed():
+            return self.inventory.stat(self.z, self.x, self.y) is not None
+        self.adopt_previous()
         return self.path.exists()
 
     def needs_fetch(self) -> bool:
@@ -118,8 +232,20 @@ class TileFile:
         Returns:
             True if not exists or st_mtime > TTL.
         """
-        if self.path_tne.exists():
-            if self.ttl and self.ttl < (time.time() - self.path_tne.stat().st_mtime):
+        if self.writer is not None and self.writer.pending(self.path)[0]:
+            return False  # Has just been set
+        self.adopt_previous()
+        if self.tne_index is not None:
+            # No filesystem access for TNE
+            tne_mtime = self.tne_index.get(self.z, self.x, self.y)
+        elif self.indexed():
+            tne_mtime = self.inventory.tne(self.z, self.x, self.y)
+        elif self.path_tne.exists():
+            tne_mtime = self.path_tne.stat().st_mtime
+        else:
+            tne_mtime = None
+        if tne_mtime is not None:
+            if self.ttl and self.ttl < (time.time() - tne_mtime):
                 logger.info(f"TTL TNE reached: '{self.path_tne}'")
                 return True
             else:
@@ -127,8 +253,17 @@ class TileFile:
                 return False
         # No else for TNE, try to check tile image
 
-        if self.path.exists():
-            if self.ttl and self.ttl < (time.time() - self.path.stat().st_mtime):
+        if self.indexed():
+            stat = self.inventory.stat(self.z, self.x, self.y)
+            mtime = stat[0] if stat else None
+        elif self.path.exists():
+            mtime = self.path.stat().st_mtime
+        else:
+            mtime = None
+        if mtime is not None and self.blobs is not None:
+            mtime = self.blobs.mtime(self.z, self.x, self.y, mtime)
+        if mtime is not None:
+            if self.ttl and self.ttl < (time.time() - mtime):
                 logger.info(f"TTL reached: '{self.path}'")
                 return True
             else:
@@ -137,6 +272,171 @@ class TileFile:
             return True
 
 
+class TileImage:
+    """Encoded tile image with pixels decoded on demand.
+
+    Decoding is the most expensive part of serving a tile, while tile
+    passthrough needs bytes only. So tiles are validated cheaply by
+    `probe_image()` and decoded once on first `image()` call.
+    """
+
+    def __init__(
+        self,
+        data: bytes | None,
+        mimetype: str | None,
+        image: PIL.Image.Image | None = None,
+    ):
+        """Wrap encoded or decoded image.
+
+        Args:
+            data: encoded image or None for constructed tile
+            mimetype: mimetype of data
+            image: decoded image, if already known
+        """
+        self.data = data
+        self.mimetype = mimetype
+        self._image = image
+        self._reduced: dict[int, PIL.Image.Image] = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_bytes(
+        cls,
+        data: bytes,
+        validate: str = "header",
+        size: tuple[int, int] | None = None,
+    ) -> "TileImage":
+        """Validate encoded image.
+
+        Args:
+            data: encoded image
+            validate: "header" to check format, dimensions and end marker,
+                "full" to decode image
+            size: expected image size, any if None
+
+        Raises:
+            OSError: image is invalid
+
+        >>> buf = io.BytesIO()
+        >>> PIL.Image.new("RGB", (256, 256)).save(buf, "PNG")
+        >>> tile = TileImage.from_bytes(buf.getvalue())
+        >>> tile.mimetype, tile.image().size
+        ('image/png', (256, 256))
+        >>> TileImage.from_bytes(buf.getvalue()[:-12])
+        Traceback (most recent call last):
+        ...
+        PIL.UnidentifiedImageError: Truncated 'image/png'
+        """
+        mimetype = probe_image(data, size)
+        tile = cls(data, mimetype)
+        if validate == "full":
+            tile._image = tile._decode()
+        return tile
+
+    @classmethod
+    def from_image(cls, image: PIL.Image.Image) -> "TileImage":
+        """Wrap constructed image, it will be encoded on demand."""
+        return cls(None, None, image=image)
+
+    def _decode(self, scale: int = 1) -> PIL.Image.Image:
+        with PIL.Image.open(io.BytesIO(self.data)) as im:
+            if scale > 1:
+                # JPEG DCT scaling, other formats ignore it
+                im.draft(None, (im.width // scale, im.height // scale))
+            im.load()
+        return im
+
+    def image(self, scale: int = 1) -> PIL.Image.Image:
+        """Return decoded image, shared between callers, so don't modify it.
+
+        >>> buf = io.BytesIO()
+        >>> PIL.Image.new("RGB", (256, 256), "red").save(buf, "JPEG")
+        >>> tile = TileImage.from_bytes(buf.getvalue())
+        >>> tile.image(4).size, tile.image(4).getpixel((0, 0))
+        ((64, 64), (254, 0, 0))
+
+        >>> TileImage(b"<html>", "image/jpeg").image()  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        PIL.UnidentifiedImageError: cannot identify image file ...
+
+        Args:
+            scale: 2, 4 or 8 to get image reduced so. JPEG is decoded at
+                reduced scale right away, others are reduced by box filter
+
+        Raises:
+            OSError: image is broken, treat tile as missing
+        """
+        if scale > 1:
+            return self._reduce(scale)
+        with self._lock:
+            if self._image is None:
+                try:
+                    self._image = self._decode()
+                except OSError as err:
+                    logger.error(f"Failed to decode '{self.mimetype}': {err}")
+                    raise
+            return self._image
+
+    def _reduce(self, scale: int) -> PIL.Image.Image:
+        with self._lock:
+            if scale in self._reduced:
+                return self._reduced[scale]
+            im = None
+            if self._image is None and self.mimetype == "image/jpeg":
+                with contextlib.suppress(OSError):
+                    im = self._decode(scale)
+        if im is None:
+            im = self.image()
+            if im.mode not in ("RGB", "RGBA"):
+                im = im.convert("RGBA")
+        if im.width != 256 // scale:
+            im = im.reduce(im.width * scale // 256)  # Exact for power of two
+        with self._lock:
+            return self._reduced.setdefault(scale, im)
+
+    def encode(self, mimetype: str) -> bytes:
+        """Return original data if possible, as encoding is lossy."""
+        if self.data is not None and self.mimetype == mimetype:
+            return self.data
+        return im_convert(self.image(), mimetype)
+
+
+def probe_image(data: bytes | memoryview, size: tuple[int, int] | None = None) -> str:
+    """Validate image without decoding.
+
+    Image header gives format and dimensions, end of file marker catches
+    truncated downloads.
+
+    Args:
+        data: encoded image
+        size: expected image size
+
+    Returns:
+        Image mimetype.
+
+    Raises:
+        PIL.UnidentifiedImageError: not an image or image is broken
+    """
+    with PIL.Image.open(io.BytesIO(data)) as im:
+        mimetype = im.get_format_mimetype()
+        if size and im.size != size:
+            raise PIL.UnidentifiedImageError(
+                f"Unexpected '{mimetype}' size {im.size}, {size} required"
+            )
+    if mimetype == "image/jpeg":
+        # EOI marker, some encoders add padding
+        complete = bytes(data[-16:]).rstrip(b"\x00").endswith(b"\xff\xd9")
+    elif mimetype == "image/png":
+        # Zero length IEND chunk with its constant CRC
+        complete = data[-12:] == b"\x00\x00\x00\x00IEND\xaeB`\x82"
+    else:
+        complete = True
+    if not complete:
+        raise PIL.UnidentifiedImageError(f"Truncated '{mimetype}'")
+    return mimetype
+
+
 def retry_opener(tries: int = 3, delay: int = 3, backoff: int = 2):
     """Retry on network error, pass HTTP errors.
 
@@ -238,20 +538,135 @@ class TileFetcher:
         self.http_session = HttpSessionDirector(
             headers=(twms.config.default_headers | self.layer["headers"])
         )
-        self.thread_pool = ThreadPoolExecutor(
-            max_workers=twms.config.dl_threads_per_layer
+        self.thread_pool = twms.admission.FairExecutor(
+            max_workers=twms.config.dl_threads_per_layer,
+            max_per_client=twms.config.client_max_fetches,
+            weights=twms.config.client_weights,
+            thread_name_prefix=layer_id,
         )
         # self._ic = Image.new("RGBA", (256, 256), self.layer["empty_color"])
-
-    def fetch(self, z: int, x: int, y: int) -> PIL.Image.Image | None:
+        # In-flight metatile fetches and tiles they fetch by (z, from x, from y)
+        self._metatiles: dict[
+            tuple[int, int, int], tuple[Future, tuple[int, int, int]]
+        ] = dict()
+        self._metatiles_lock = threading.Lock()
+        self.coverage = None
+        if self.layer["tne_subtree"]:
+            self.coverage = twms.tne.CoverageTree(
+                reprobe=self.layer["tne_subtree"], min_zoom=self.layer["min_zoom"]
+            )
+            if self.layer["tne_index"]:
+                self.coverage.seed(twms.tne.get_index(self.layer["prefix"]))
+
+    def fetch(self, z: int, x: int, y: int) -> "TileImage | None":
         """Fetch tile asynchronously.
 
+        Queued fetch is cancelled if request was cancelled while waiting.
+        Fetch already in flight is left to finish and populate the cache.
+        Tile of a metatile in flight waits for it, then is read from cache.
+        If the metatile fetch failed, stale or no tile is served, so the
+        failure is not repeated by each waiting tile.
+
         Returns:
             Image or None if no image can be served.
+
+        Raises:
+            twms.request.RequestCancelled
+        """
+        context = twms.request.current()
+        if context is not None:
+            context.check()
+        while True:
+            future, fetching = self.submit(z, x, y, context.client if context else "")
+            own = fetching == (z, x, y)
+            try:
+                result = self.wait(future, context, f"{z}/{x}/{y}", cancel=own)
+            except CancelledError:
+                continue  # Queued metatile fetch of other request was cancelled
+            if own:
+                return result
+            # Shared outcome: stored tile, TNE, stale cached tile or nothing
+            tile = tile_storage(self.layer, z, x, y)
+            if (
+                tile.needs_fetch()
+                and not tile_storage(self.layer, *fetching).needs_fetch()
+            ):
+                continue  # Metatile was stored without this tile
+            return self.from_cache(tile)
+
+    def submit(
+        self, z: int, x: int, y: int, client: str = ""
+    ) -> tuple[Future, tuple[int, int, int]]:
+        """Schedule tile fetch, at most one upstream request per metatile.
+
+        Tile not needing upstream fetch is read on its own, not to wait for
+        a metatile in flight nor to be awaited by neighbours needing one.
+
+        Returns:
+            Future and (z, x, y) of the tile it fetches, a neighbour in the
+            same metatile if fetch is shared.
+        """
+        key = self.metatile_key(z, x, y)
+        if key is None or not tile_storage(self.layer, z, x, y).needs_fetch():
+            future = self.thread_pool.submit(self.__worker, z, x, y, client=client)
+            return future, (z, x, y)
+        with self._metatiles_lock:
+            if (shared := self._metatiles.get(key)) and not shared[0].done():
+                return shared
+            future = self.thread_pool.submit(self.__worker, z, x, y, client=client)
+            self._metatiles[key] = future, (z, x, y)
+        future.add_done_callback(functools.partial(self._metatile_done, key))
+        return future, (z, x, y)
+
+    def _metatile_done(self, key: tuple[int, int, int], future: Future) -> None:
+        with self._metatiles_lock:
+            if (shared := self._metatiles.get(key)) and shared[0] is future:
+                del self._metatiles[key]
+
+    def wait(
+        self,
+        future: Future,
+        context: "twms.request.RequestContext | None",
+        tile_id: str,
+        cancel: bool = True,
+    ) -> "TileImage | None":
+        """Wait for fetch result while request is alive."""
+        if context is None:
+            return future.result()
+        while True:
+            try:
+                return future.result(timeout=twms.config.cancel_poll_interval)
+            except FutureTimeoutError:
+                if context.is_cancelled():
+                    if cancel and future.cancel():
+                        logger.info(
+                            f"{self.layer['prefix']}/{tile_id}: queued fetch cancelled, {context.reason}"
+                        )
+                    context.check()
+
+    def metatile_key(self, z: int, x: int, y: int) -> tuple[int, int, int] | None:
+        """Metatile of a tile, None if layer doesn't use metatiles.
+
+        Metatile is N×N tiles block aligned to N, clipped at zoom level edge.
         """
-        return self.thread_pool.submit(self.__worker, z, x, y).result()
+        n = self.layer["metatile"]
+        if n < 2 or "{bbox}" not in self.layer.get("remote_url", ""):
+            return None
+        return z, x - x % n, y - y % n
 
-    def tms(self, z: int, x: int, y: int) -> PIL.Image.Image | None:
+    def metatile_tiles(self, z: int, x: int, y: int) -> tuple[int, int, int, int]:
+        """Tile block fetched along with a tile.
+
+        Returns:
+            (from x, from y, width, height) in tiles.
+        """
+        if (key := self.metatile_key(z, x, y)) is None:
+            return x, y, 1, 1
+        _, from_x, from_y = key
+        n = self.layer["metatile"]
+        return from_x, from_y, min(n, 2**z - from_x), min(n, 2**z - from_y)
+
+    def tms(self, z: int, x: int, y: int) -> "TileImage | None":
         """Fetch tile by coordinates: network/cache.
 
         Function fetches image, checks it validity and detects actual
@@ -260,7 +675,7 @@ class TileFetcher:
         converted before saving to cache.
 
         Returns:
-            Image in layer mimetype (converted if necessary).
+            Tile in layer mimetype (converted if necessary), decoded on demand.
         """
         tile_id = f"{self.layer['prefix']}/{z}/{x}/{y}"
 
@@ -268,18 +683,14 @@ class TileFetcher:
             logger.debug(f"Zoom limit {tile_id}")
             return None
 
-        tile = TileFile(
-            cache_dir=twms.config.tiles_cache,
-            layer_id=self.layer["prefix"],
-            z=z,
-            x=x,
-            y=y,
-            mimetype=self.layer["mimetype"],
-            ttl=self.layer["cache_ttl"],
-        )
+        tile = tile_storage(self.layer, z, x, y)
 
         # Fetching image
-        if "remote_url" in self.layer and tile.needs_fetch():
+        if (
+            "remote_url" in self.layer
+            and tile.needs_fetch()
+            and not self.in_empty_subtree(z, x, y)
+        ):
             if "transform_tile_number" in self.layer:
                 trans_z, trans_x, trans_y = self.layer["transform_tile_number"](z, x, y)
             else:
@@ -300,19 +711,23 @@ class TileFetcher:
 
             # WMS support, no difference with TMS except missing TNE feature
             # Some considerations:
-            #   * Biger tile request (e.g. 512x512)?
             #   * Using different 'wms_proj' parameter, as server may be broken
+            from_x, from_y, width, height = self.metatile_tiles(z, x, y)
             if "{bbox}" in remote:
+                # Whole metatile in one request, if layer has one
                 proj = self.layer["proj"]
+                west, _, _, north = twms.projections.bbox_by_tile(
+                    z, from_x, from_y, proj
+                )
+                _, south, east, _ = twms.projections.bbox_by_tile(
+                    z, from_x + width - 1, from_y + height - 1, proj
+                )
                 tile_bbox = "{},{},{},{}".format(
-                    *twms.projections.from4326(
-                        twms.projections.bbox_by_tile(z, x, y, proj),
-                        proj,
-                    )
+                    *twms.projections.from4326((west, south, east, north), proj)
                 )
                 remote = remote.replace("{bbox}", tile_bbox)
-                remote = remote.replace("{width}", "256")
-                remote = remote.replace("{height}", "256")
+                remote = remote.replace("{width}", str(256 * width))
+                remote = remote.replace("{height}", str(256 * height))
                 remote = remote.replace("{proj}", proj)
 
             # Fetching tiles
@@ -320,65 +735,75 @@ class TileFetcher:
                 # Got response, need to verify content
                 logger.info(f"{tile_id}: FETCHING {remote}")
                 with self.http_session.get(remote) as remote_resp:
-                    resp_bytes = remote_resp.read()  # Doesn't support seek()
-                    resp_md5 = hashlib.md5(resp_bytes).hexdigest()
-                    resp_buf = io.BytesIO(resp_bytes)
                     # Just 404, as decent server would respond
                     if remote_resp.status == http.HTTPStatus.NOT_FOUND:
-                        tile.set()
+                        self.tile_not_exists(tile)
                         return None
                     elif remote_resp.status == http.HTTPStatus.FORBIDDEN:
                         return None
+                    dead_tile = self.layer.get("dead_tile", {})
                     # Sometimes tile missing, but server reports other code instead 404
-                    if "dead_tile" in self.layer:
-                        if (
-                            "http_status" in self.layer["dead_tile"]
-                            and remote_resp.status
-                            == self.layer["dead_tile"]["http_status"]
-                        ):
-                            logger.warning(f"{tile_id}: TNE - {remote_resp}")
-                            tile.set()
-                            return None
+                    if (
+                        "http_status" in dead_tile
+                        and remote_resp.status == dead_tile["http_status"]
+                    ):
+                        logger.warning(f"{tile_id}: TNE - {remote_resp}")
+                        self.tile_not_exists(tile)
+                        return None
 
-                        # Sometimes server returns same dummy file instead of empty HTTP response
-                        # Compare bytestring with dead tile hash
-                        if (
-                            "md5" in self.layer["dead_tile"]
-                            and resp_md5 in self.layer["dead_tile"]["md5"]
-                        ):
-                            # Tile is recognized as empty
-                            # An example http://ecn.t0.tiles.virtualearth.net/tiles/a120210103101222.jpeg?g=0
-                            # SASPlanet writes empty files with '.tne' ext
-                            logger.warning(f"{tile_id}: TNE - dead tile checksum")
-                            tile.set()
-                            return None
+                    # Don't hash a body which can't be a dead tile by size
+                    resp_md5 = None
+                    content_length = content_length_header(remote_resp)
+                    if "md5" in dead_tile and (
+                        "size" not in dead_tile
+                        or content_length is None
+                        or content_length == dead_tile["size"]
+                    ):
+                        resp_md5 = hashlib.md5()
+                    resp_buf = read_body(
+                        remote_resp,
+                        max_size=self.layer["max_body_size"] * width * height,
+                        digest=resp_md5,
+                        digest_limit=dead_tile.get("size", None),
+                    )
+                    if resp_buf is None:
+                        logger.error(
+                            f"{tile_id}: response exceeds {self.layer['max_body_size'] * width * height} bytes"
+                        )
+                        return None
+                    resp_size = resp_buf.getbuffer().nbytes
+
+                    # Sometimes server returns same dummy file instead of empty HTTP response
+                    # Compare bytestring with dead tile hash
+                    if (
+                        resp_md5 is not None
+                        and dead_tile.get("size", resp_size) == resp_size
+                        and resp_md5.hexdigest() in dead_tile["md5"]
+                    ):
+                        # Tile is recognized as empty
+                        # An example http://ecn.t0.tiles.virtualearth.net/tiles/a120210103101222.jpeg?g=0
+                        # SASPlanet writes empty files with '.tne' ext
+                        logger.warning(f"{tile_id}: TNE - dead tile checksum")
+                        self.tile_not_exists(tile)
+                        return None
 
                     # Catching invalid pictures
-                    if not resp_bytes:
+                    if not resp_size:
                         logger.warning(f"{tile_id}: empty response")
                         # tile.set()
 
                     try:
-                        with PIL.Image.open(resp_buf) as im:
-                            im.load()  # Validate image
-                            # TNE based on histogram (from WMS)
-                            # if im.histogram() == self._ic.histogram():
-                            #     logger.debug(f"{tile_id}: TNE - empty histogram")
-                            #     tile.set()
-                            #     return None
-
-                            # All well, save tile to cache
-                            # Preserving original image if possible, as encoding is lossy
-                            # Storing all images into one format, just like SAS.Planet does
-                            if im.get_format_mimetype() == self.layer["mimetype"]:
-                                tile.set(resp_bytes)
-                            else:
-                                logger.warning(
-                                    f"{tile_id}: converting '{im.get_format_mimetype()}' to '{self.layer['mimetype']}'"
-                                )
-                                tile.set(im_convert(im, self.layer["mimetype"]))
-                            return im
-                    except PIL.UnidentifiedImageError:
+                        tile_im = TileImage.from_bytes(
+                            resp_buf.getvalue(),  # Shares buffer, no copy
+                            validate=self.layer["validate"],
+                            size=(256 * width, 256 * height),
+                        )
+                        if (
+                            width * height > 1
+                            or tile_im.mimetype != self.layer["mimetype"]
+                        ):
+                            tile_im.image()  # Decoded anyway, catch broken data
+                    except OSError:
                         logger.error(f"{tile_id}: failed to parse response as image")
                         logger.debug(
                             textwrap.dedent(
@@ -388,7 +813,7 @@ class TileFetcher:
                             {remote_resp}
                             """
                             )
-                            + f"md5sum: '{resp_md5}'"
+                            + f"md5sum: '{hashlib.md5(resp_buf.getbuffer()).hexdigest()}'"
                         )
                         # try:
                         #     logger.debug(remote_bytes.decode("utf-8"))
@@ -397,17 +822,55 @@ class TileFetcher:
                         # if logger.getLogger().getEffectiveLevel() == logger.DEBUG:
                         #     with open('err.htm', mode='wb') as f:
                         #         f.write(remote_bytes)
+                    else:
+                        # TNE based on histogram (from WMS)
+                        # if im.histogram() == self._ic.histogram():
+                        #     logger.debug(f"{tile_id}: TNE - empty histogram")
+                        #     tile.set()
+                        #     return None
+
+                        if width * height > 1:
+                            return self.store_metatile(
+                                z, x, y, (from_x, from_y, width, height), tile_im
+                            )
+
+                        # All well, save tile to cache
+                        # Preserving original image if possible, as encoding is lossy
+                        # Storing all images into one format, just like SAS.Planet does
+                        if tile_im.mimetype != self.layer["mimetype"]:
+                            logger.warning(
+                                f"{tile_id}: converting '{tile_im.mimetype}' to '{self.layer['mimetype']}'"
+                            )
+                            tile_im = TileImage(
+                                im_convert(tile_im.image(), self.layer["mimetype"]),
+                                self.layer["mimetype"],
+                                image=tile_im.image(),
+                            )
+                        tile.set(tile_im.data)
+                        invalidate_hidpi(self.layer, z, x, y)
+                        if self.coverage:
+                            self.coverage.mark_present(z, x, y)
+                        return tile_im
             except urllib.error.URLError as err:
                 # Nothing we can do: no connection, so cannot guess TNE or not
                 logger.error(f"{tile_id} URLError '{err}'")
             logger.error(f"{tile_id}: tile fetch failed")
 
         # If fetching failed
+        return self.from_cache(tile)
+
+    def from_cache(
+        self, tile: "TileFile | twms.sasplanet.SqliteTile | twms.pmtiles.PmtilesTile"
+    ) -> "TileImage | None":
+        """Read cached tile, expired or not, without fetching."""
+        z, x, y = tile.z, tile.x, tile.y
+        tile_id = f"{self.layer['prefix']}/{z}/{x}/{y}"
         if tile.exists():
+            twms.janitor.touch(self.layer, z, x, y)
             try:
-                with PIL.Image.open(tile.get()) as im:
-                    im.load()
-                    return im
+                return TileImage.from_bytes(
+                    tile.read(), validate=self.layer["validate"]
+                )
             except OSError:
                 logger.error(f"{tile_id}: failed to parse image from cache")
                 # tile.delete()  # Cached tile is broken - remove it
@@ -415,7 +878,67 @@ class TileFetcher:
         logger.error(f"{tile_id}: no tile")
         return None
 
-    def tms_google_sat(self, z: int, x: int, y: int) -> PIL.Image.Image:
+    def in_empty_subtree(self, z: int, x: int, y: int) -> bool:
+        """Check whether tile is below a tile known to be TNE."""
+        if self.coverage and (parent := self.coverage.empty_ancestor(z, x, y)):
+            logger.info(
+                f"{self.layer['prefix']}/{z}/{x}/{y}: TNE - inside empty {'/'.join(map(str, parent))}"
+            )
+            return True
+        return False
+
+    def tile_not_exists(
+        self, tile: "TileFile | twms.sasplanet.SqliteTile | twms.pmtiles.PmtilesTile"
+    ) -> None:
+        """Mark tile and the rest of its metatile as TNE and learn empty subtree."""
+        from_x, from_y, width, height = self.metatile_tiles(tile.z, tile.x, tile.y)
+        for x in range(from_x, from_x + width):
+            for y in range(from_y, from_y + height):
+                if (x, y) != (tile.x, tile.y):
+                    tile_storage(self.layer, tile.z, x, y).set()
+                if self.coverage:
+                    self.coverage.mark_empty(tile.z, x, y)
+        tile.set()
+
+    def store_metatile(
+        self,
+        z: int,
+        x: int,
+        y: int,
+        block: tuple[int, int, int, int],
+        metatile: "TileImage",
+    ) -> "TileImage":
+        """Slice metatile into tiles and save all of them to cache.
+
+        Returns:
+            Requested tile.
+        """
+        from_x, from_y, width, height = block
+        image = metatile.image()
+        result = None
+        for tx in range(from_x, from_x + width):
+            for ty in range(from_y, from_y + height):
+                left, top = 256 * (tx - from_x), 256 * (ty - from_y)
+                im = image.crop((left, top, left + 256, top + 256))
+                tile_im = TileImage(
+                    im_convert(im, self.layer["mimetype"]),
+                    self.layer["mimetype"],
+                    image=im,
+                )
+                tile_storage(self.layer, z, tx, ty).set(tile_im.data)
+                if self.coverage:
+                    self.coverage.mark_present(z, tx, ty)
+                if (tx, ty) == (x, y):
+                    result = tile_im
+        for hx in range(from_x // 2, (from_x + width - 1) // 2 + 1):
+            for hy in range(from_y // 2, (from_y + height - 1) // 2 + 1):
+                invalidate_hidpi(self.layer, z, hx * 2, hy * 2)
+        logger.info(
+            f"{self.layer['prefix']}/{z}/{x}/{y}: stored {width}x{height} metatile"
+        )
+        return result
+
+    def tms_google_sat(self, z: int, x: int, y: int) -> "TileImage | None":
         """Construct template URI with version from JS API.
 
         May be use different servers in future:
@@ -454,6 +977,139 @@ class TileFetcher:
         return im
 
 
+def tile_storage(
+    layer: dict, z: int, x: int, y: int
+) -> TileFile | twms.sasplanet.SqliteTile | twms.pmtiles.PmtilesTile:
+    """Create tile storage for layer "cache_type"."""
+    if layer["cache_type"] == "pmtiles":
+        return twms.pmtiles.PmtilesTile(
+            twms.pmtiles.archive_path(layer), layer["mimetype"], z, x, y
+        )
+    elif layer["cache_type"] == "sqlite":
+        return twms.sasplanet.SqliteTile(
+            cache_dir=twms.config.tiles_cache,
+            layer_id=layer["prefix"],
+            mimetype=layer["mimetype"],
+            z=z,
+            x=x,
+            y=y,
+            ttl=layer["cache_ttl"],
+        )
+    elif layer["cache_type"] == "ma":
+        return TileFile(
+            cache_dir=twms.config.tiles_cache,
+            layer_id=layer["prefix"],
+            z=z,
+            x=x,
+            y=y,
+            mimetype=layer["mimetype"],
+            ttl=layer["cache_ttl"],
+            tne_index=(
+                twms.tne.get_index(layer["prefix"]) if layer["tne_index"] else None
+            ),
+            inventory=twms.inventory.for_layer(layer),
+            writer=twms.writer.default(),
+            blobs=twms.dedup.for_layer(layer),
+            layout=layer["layout"],
+            layout_previous=layer["layout_previous"],
+        )
+    raise ValueError(f"{layer['prefix']}: unknown cache_type '{layer['cache_type']}'")
+
+
+def hidpi_layer(layer: dict) -> dict:
+    """Layer config of 512 px tiles derived from z+1 tiles of a layer.
+
+    Derived tiles are plain files in "{prefix}@2x" directory, whatever layer
+    "cache_type" is. They expire with layer "cache_ttl" and are kept by the
+    janitor under layer "cache_quota" of their own and the global one.
+
+    >>> hidpi_layer(twms.config.layers["yasat"])["prefix"]
+    'yasat@2x'
+    """
+    return layer | {
+        "prefix": f"{layer['prefix']}@2x",
+        "cache_type": "ma",
+        "tne_index": False,
+        "inventory": False,
+        "dedup": False,
+        "layout_previous": None,
+    }
+
+
+def hidpi_storage(layer: dict, z: int, x: int, y: int) -> TileFile:
+    """Create storage of 512 px tile derived from z+1 tiles."""
+    return tile_storage(hidpi_layer(layer), z, x, y)
+
+
+def invalidate_hidpi(layer: dict, z: int, x: int, y: int) -> None:
+    """Drop cached 512 px tile derived from a tile just stored."""
+    if not twms.config.wmts_hidpi or z < 1:
+        return
+    storage = hidpi_storage(layer, z - 1, x // 2, y // 2)
+    if storage.writer is not None:
+        storage.writer.discard(storage.path)
+    storage.path.unlink(missing_ok=True)
+
+
+def content_length_header(resp: io.BufferedIOBase) -> int | None:
+    """Parse Content-Length, None if missing or malformed.
+
+    >>> import types
+    >>> resp = types.SimpleNamespace(headers={"Content-Length": "1,024"})
+    >>> content_length_header(resp) is None
+    True
+    """
+    length = getattr(resp, "headers", {}).get("Content-Length")
+    if length is None or not length.strip().isdigit():
+        return None
+    return int(length)
+
+
+def read_body(
+    resp: io.BufferedIOBase,
+    max_size: int,
+    digest=None,
+    digest_limit: int | None = None,
+    chunk_size: int = 64 * 1024,
+) -> io.BytesIO | None:
+    """Read response body by chunks into a single buffer, hashing on the fly.
+
+    Args:
+        resp: HTTP response
+        max_size: bytes, larger body is discarded without reading it through
+        digest: hashlib object to update with body
+        digest_limit: stop hashing when body grows larger, as digest
+            is not needed anymore (e.g. dead tile size)
+        chunk_size: bytes to read at once
+
+    Returns:
+        Buffer with whole body at position 0 or None if body is too large.
+
+    >>> read_body(io.BytesIO(b"tile"), max_size=4).read()
+    b'tile'
+    >>> read_body(io.BytesIO(b"<html>error"), max_size=4) is None
+    True
+    >>> md5 = hashlib.md5()
+    >>> buf = read_body(io.BytesIO(b"tile"), max_size=4, digest=md5, chunk_size=3)
+    >>> md5.hexdigest() == hashlib.md5(b"tile").hexdigest()
+    True
+    """
+    if (length := content_length_header(resp)) is not None and length > max_size:
+        return None
+    buf = io.BytesIO()
+    while chunk := resp.read(chunk_size):
+        if buf.tell() + len(chunk) > max_size:
+            return None
+        buf.write(chunk)
+        if digest is not None:
+            if digest_limit is not None and buf.tell() > digest_limit:
+                digest = None
+            else:
+                digest.update(chunk)
+    buf.seek(0)
+    return buf
+
+
 def tile_to_quadkey(z: int, x: int, y: int) -> str:
     """Transform tile coordinates to a Bing quadkey.
 
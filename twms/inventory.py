@@ -0,0 +1,492 @@
+"""In-memory inventory of layer cache files.
+
+Deciding cache hit or miss with `stat()` for each request is slow on spinning
+disks and network storage. `Inventory` holds existence, mtime and size of all
+tiles and `*.tne` markers of a layer instead. It is built by parallel
+`os.scandir()` walk or loaded from a snapshot, kept current by `TileFile`
+writes and optionally by inotify watcher for files written by SAS.Planet.
+
+Snapshot stores mtime of every `{z}/{x}` directory, so on startup only
+directories changed since snapshot was saved are rescanned.
+"""
+
+import array
+import ctypes
+import ctypes.util
+import logging
+import mimetypes
+import os
+import pathlib
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import twms.config
+import twms.writer
+
+logger = logging.getLogger(__name__)
+
+INVENTORY_NAME = "inventory.twms"
+MAGIC = b"TWMSINV1"
+DIR_HEADER = "<BIqII"  # z, x, directory mtime ns, tiles count, TNE count
+
+
+def pack_stat(mtime: float, size: int) -> int:
+    """Pack tile mtime and size into a single integer.
+
+    >>> unpack_stat(pack_stat(1700000000.5, 12345))
+    (1700000000, 12345)
+    """
+    return int(mtime) << 32 | size
+
+
+def unpack_stat(value: int) -> tuple[int, int]:
+    return value >> 32, value & 0xFFFFFFFF
+
+
+class Inventory:
+    """Tile files of a single layer cache directory."""
+
+    def __init__(self, layer_dir: str | pathlib.Path, ext: str, threads: int = 8):
+        """Create empty inventory.
+
+        Args:
+            layer_dir: layer cache directory with `{z}/{x}/{y}{ext}` files
+            ext: tile file extension, e.g. ".jpg"
+            threads: directories scanned in parallel
+        """
+        self.layer_dir = pathlib.Path(layer_dir)
+        self.path = self.layer_dir / INVENTORY_NAME
+        self.ext = ext
+        self.threads = threads
+        # Set when inventory reflects directory content and can replace stat()
+        self.ready = threading.Event()
+        # {(z, x): {y: packed (mtime, size)}} for tiles, {y: mtime} for TNE
+        self._tiles: dict[tuple[int, int], dict[int, int]] = dict()
+        self._tne: dict[tuple[int, int], dict[int, int]] = dict()
+        # {(z, x): st_mtime_ns} of scanned directories
+        self._dirs: dict[tuple[int, int], int] = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Number of tiles, not counting TNE."""
+        with self._lock:
+            return sum(len(column) for column in self._tiles.values())
+
+    def stat(self, z: int, x: int, y: int) -> tuple[int, int] | None:
+        """Return (mtime, size) of a tile file or None if it doesn't exist.
+
+        >>> inventory = Inventory("/nonexistent", ".jpg")
+        >>> inventory.set_tile(3, 1, 2, mtime=1700000000, size=100)
+        >>> inventory.stat(3, 1, 2), inventory.stat(3, 2, 1)
+        ((1700000000, 100), None)
+        """
+        column = self._tiles.get((z, x))
+        if column and (value := column.get(y)) is not None:
+            return unpack_stat(value)
+        return None
+
+    def tne(self, z: int, x: int, y: int) -> int | None:
+        """Return mtime of `*.tne` marker or None if tile isn't marked."""
+        column = self._tne.get((z, x))
+        return column.get(y) if column else None
+
+    def set_tile(self, z: int, x: int, y: int, mtime: float, size: int) -> None:
+        with self._lock:
+            self._tiles.setdefault((z, x), dict())[y] = pack_stat(mtime, size)
+
+    def set_tne(self, z: int, x: int, y: int, mtime: float) -> None:
+        with self._lock:
+            self._tne.setdefault((z, x), dict())[y] = int(mtime)
+
+    def discard_tile(self, z: int, x: int, y: int) -> None:
+        with self._lock:
+            if column := self._tiles.get((z, x)):
+                column.pop(y, None)
+
+    def discard_tne(self, z: int, x: int, y: int) -> None:
+        with self._lock:
+            if column := self._tne.get((z, x)):
+                column.pop(y, None)
+
+    def items(self):
+        """Iterate over (z, x, y, mtime, size) of all tiles."""
+        with self._lock:
+            snapshot = [
+                (zx, list(column.items())) for zx, column in self._tiles.items()
+            ]
+        for (z, x), column in snapshot:
+            for y, value in column:
+                yield z, x, y, *unpack_stat(value)
+
+    def tne_items(self):
+        """Iterate over (z, x, y, mtime) of all `*.tne` markers."""
+        with self._lock:
+            snapshot = [(zx, list(column.items())) for zx, column in self._tne.items()]
+        for (z, x), column in snapshot:
+            for y, mtime in column:
+                yield z, x, y, mtime
+
+    def _scan_dir(self, z: int, x: int, path: str) -> tuple:
+        """Read `{z}/{x}` directory."""
+        tiles: dict[int, int] = dict()
+        tne: dict[int, int] = dict()
+        try:
+            dir_mtime = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                for entry in it:
+                    y, ext = os.path.splitext(entry.name)
+                    if not y.isdigit():
+                        continue
+                    if ext == self.ext:
+                        st = entry.stat()
+                        tiles[int(y)] = pack_stat(st.st_mtime, st.st_size)
+                    elif ext == ".tne":
+                        tne[int(y)] = int(entry.stat().st_mtime)
+        except FileNotFoundError:
+            return z, x, None, tiles, tne
+        return z, x, dir_mtime, tiles, tne
+
+    def _update_dirs(self, results, since: float) -> None:
+        """Replace columns with scan results.
+
+        Args:
+            results: `_scan_dir()` results
+            since: scan start time, entries set after it are kept
+        """
+        since = int(since)
+        with self._lock:
+            for z, x, dir_mtime, tiles, tne in results:
+                # Keep files written while directory was scanned
+                for y, value in self._tiles.pop((z, x), {}).items():
+                    if unpack_stat(value)[0] >= since:
+                        tiles[y] = value
+                for y, mtime in self._tne.pop((z, x), {}).items():
+                    if mtime >= since:
+                        tne[y] = mtime
+                self._dirs.pop((z, x), None)
+                if dir_mtime is not None:
+                    self._dirs[(z, x)] = dir_mtime
+                if tiles:
+                    self._tiles[(z, x)] = tiles
+                if tne:
+                    self._tne[(z, x)] = tne
+
+    def _list_dirs(self) -> list[tuple[int, int, str]]:
+        """List all `{z}/{x}` directories."""
+        return [
+            (int(z_entry.name), int(x_entry.name), x_entry.path)
+            for z_entry in _scandir_numeric(self.layer_dir)
+            for x_entry in _scandir_numeric(z_entry.path)
+        ]
+
+    def scan(self, changed_only: bool = False) -> None:
+        """Walk layer directory and rebuild inventory.
+
+        Args:
+            changed_only: rescan only directories with mtime differing from
+                the known one, e.g. after loading a snapshot
+        """
+        start = time.monotonic()
+        since = time.time()
+        dirs = self._list_dirs()
+        on_disk = {(z, x) for z, x, _ in dirs}
+        with self._lock:
+            removed = [
+                (z, x, None, {}, {}) for z, x in self._dirs if (z, x) not in on_disk
+            ]
+        if changed_only:
+            with ThreadPoolExecutor(self.threads) as pool:
+                mtimes = pool.map(lambda d: _mtime_ns(d[2]), dirs)
+                dirs = [
+                    d
+                    for d, mtime in zip(dirs, mtimes)
+                    if mtime != self._dirs.get((d[0], d[1]))
+                ]
+        with ThreadPoolExecutor(self.threads) as pool:
+            results = list(pool.map(lambda d: self._scan_dir(*d), dirs))
+        self._update_dirs(results, since)
+        self._update_dirs(removed, since)
+        logger.info(
+            f"{self.layer_dir}: scanned {len(dirs)} directories, {len(self)} tiles in {time.monotonic() - start:.1f} s"
+        )
+
+    def load(self) -> bool:
+        """Load snapshot and rescan directories changed since it was saved.
+
+        Returns:
+            False if there is no snapshot.
+        """
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return False
+        if data[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"'{self.path}' is not a tile inventory")
+        offset = len(MAGIC)
+        header_size = struct.calcsize(DIR_HEADER)
+        with self._lock:
+            while offset < len(data):
+                z, x, dir_mtime, n_tiles, n_tne = struct.unpack_from(
+                    DIR_HEADER, data, offset
+                )
+                offset += header_size
+                columns = list()
+                for count, typecode in (
+                    (n_tiles, "I"),
+                    (n_tiles, "Q"),
+                    (n_tne, "I"),
+                    (n_tne, "I"),
+                ):
+                    values = array.array(typecode)
+                    end = offset + count * values.itemsize
+                    values.frombytes(data[offset:end])
+                    if sys.byteorder == "big":
+                        values.byteswap()
+                    columns.append(values)
+                    offset = end
+                self._dirs[(z, x)] = dir_mtime
+                if n_tiles:
+                    self._tiles[(z, x)] = dict(zip(columns[0], columns[1]))
+                if n_tne:
+                    self._tne[(z, x)] = dict(zip(columns[2], columns[3]))
+        logger.info(f"Loaded {len(self)} tiles from '{self.path}'")
+        self.scan(changed_only=True)
+        return True
+
+    def save(self) -> None:
+        """Write snapshot atomically."""
+        chunks = [MAGIC]
+        with self._lock:
+            for (z, x), dir_mtime in self._dirs.items():
+                tiles = self._tiles.get((z, x), {})
+                tne = self._tne.get((z, x), {})
+                chunks.append(
+                    struct.pack(DIR_HEADER, z, x, dir_mtime, len(tiles), len(tne))
+                )
+                for typecode, values in (
+                    ("I", tiles.keys()),
+                    ("Q", tiles.values()),
+                    ("I", tne.keys()),
+                    ("I", tne.values()),
+                ):
+                    values = array.array(typecode, values)
+                    if sys.byteorder == "big":
+                        values.byteswap()
+                    chunks.append(values.tobytes())
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        twms.writer.write_atomic(self.path, b"".join(chunks))
+        logger.debug(f"Saved tile inventory '{self.path}'")
+
+    def on_file_changed(self, z: int, x: int, path: str) -> None:
+        """Update single file state after external write or removal."""
+        y, ext = os.path.splitext(os.path.basename(path))
+        if not y.isdigit() or ext not in (self.ext, ".tne"):
+            return
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if ext == ".tne":
+            if st:
+                self.set_tne(z, x, int(y), st.st_mtime)
+            else:
+                self.discard_tne(z, x, int(y))
+        elif st:
+            self.set_tile(z, x, int(y), st.st_mtime, st.st_size)
+        else:
+            self.discard_tile(z, x, int(y))
+
+
+def _scandir_numeric(path: str | pathlib.Path) -> list[os.DirEntry]:
+    """List `{z}` or `{x}` subdirectories."""
+    try:
+        with os.scandir(path) as it:
+            return [e for e in it if e.name.isdigit() and e.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+def _mtime_ns(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class InotifyWatcher:
+    """Track files written into layer cache by other programs.
+
+    Linux only, via libc inotify API. A watch is added for every `{z}/{x}`
+    directory, so `fs.inotify.max_user_watches` may need to be raised for
+    large caches.
+    """
+
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+    def __init__(self, inventory: Inventory):
+        """Start watching.
+
+        Raises:
+            OSError if inotify is not available
+        """
+        self.inventory = inventory
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not supported")
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Watch descriptor to (z, x); None for layer and zoom directories
+        self._watches: dict[int, tuple[int | None, int | None]] = dict()
+        self._add_watch(self.inventory.layer_dir, None, None)
+        for z_entry in _scandir_numeric(self.inventory.layer_dir):
+            self._watch_zoom(int(z_entry.name), z_entry.path, rescan=False)
+        self.thread = threading.Thread(
+            target=self._run, name=f"inotify_{inventory.layer_dir.name}", daemon=True
+        )
+        self.thread.start()
+
+    def _add_watch(self, path: str | pathlib.Path, z: int | None, x: int | None):
+        mask = self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM | self.IN_MOVED_TO
+        if x is not None:
+            mask |= self.IN_CLOSE_WRITE | self.IN_ATTRIB
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            logger.error(f"Can't watch '{path}': {os.strerror(ctypes.get_errno())}")
+        else:
+            self._watches[wd] = (z, x)
+
+    def _watch_zoom(self, z: int, path: str, rescan: bool = True) -> None:
+        self._add_watch(path, z, None)
+        for x_entry in _scandir_numeric(path):
+            self._watch_column(z, int(x_entry.name), x_entry.path, rescan)
+
+    def _watch_column(self, z: int, x: int, path: str, rescan: bool = True) -> None:
+        self._add_watch(path, z, x)
+        if rescan:
+            # Files may have been written before the watch was added
+            since = time.time()
+            self.inventory._update_dirs([self.inventory._scan_dir(z, x, path)], since)
+
+    def _run(self) -> None:
+        while True:
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                end = offset + length
+                name = data[offset:end].rstrip(b"\0").decode()
+                offset = end
+                try:
+                    self._handle(wd, mask, name)
+                except OSError:
+                    logger.exception(f"inotify event '{name}'")
+
+    def _handle(self, wd: int, mask: int, name: str) -> None:
+        if mask & self.IN_Q_OVERFLOW:
+            logger.warning(f"{self.inventory.layer_dir}: inotify overflow, rescanning")
+            self.inventory.scan()
+            return
+        if mask & self.IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        if wd not in self._watches:
+            return
+        z, x = self._watches[wd]
+        path = os.path.join(self._path(z, x), name)
+        if mask & self.IN_ISDIR:
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO) and name.isdigit():
+                if z is None:
+                    self._watch_zoom(int(name), path)
+                elif x is None:
+                    self._watch_column(z, int(name), path)
+        elif x is not None:
+            self.inventory.on_file_changed(z, x, path)
+
+    def _path(self, z: int | None, x: int | None) -> str:
+        parts = [str(p) for p in (z, x) if p is not None]
+        return os.path.join(self.inventory.layer_dir, *parts)
+
+
+_inventories: dict[str, Inventory] = dict()
+_inventories_lock = threading.Lock()
+
+
+def for_layer(layer: dict) -> Inventory | None:
+    """Return inventory of a layer or None if layer has no "inventory".
+
+    Inventory is indexed by "tms" layout directories and is off while cache
+    is migrated between layouts.
+    """
+    if not layer["inventory"] or layer["layout"] != "tms" or layer["layout_previous"]:
+        return None
+    with _inventories_lock:
+        if layer["prefix"] not in _inventories:
+            _inventories[layer["prefix"]] = Inventory(
+                pathlib.Path(twms.config.tiles_cache) / layer["prefix"],
+                ext=mimetypes.guess_extension(layer["mimetype"]),
+                threads=twms.config.inventory_threads,
+            )
+        return _inventories[layer["prefix"]]
+
+
+def start(layers: dict[str, dict]) -> list[threading.Thread]:
+    """Build inventories of layers in background.
+
+    Until inventory is ready, tile state is checked on disk.
+    """
+
+    def build(layer: dict) -> None:
+        inventory = for_layer(layer)
+        if layer["inventory"] == "watch":
+            # Before scan, not to miss files written meanwhile
+            try:
+                InotifyWatcher(inventory)
+            except OSError as err:
+                logger.error(f"{layer['prefix']}: can't watch cache: {err}")
+        try:
+            if not inventory.load():
+                inventory.scan()
+        except (OSError, ValueError):
+            logger.exception(f"{layer['prefix']}: failed to build tile inventory")
+            return
+        inventory.ready.set()
+
+    threads = list()
+    for layer in layers.values():
+        if layer["inventory"] and for_layer(layer) is None:
+            logger.warning(
+                f"{layer['prefix']}: inventory requires \"tms\" layout, disabled"
+            )
+        elif layer["inventory"]:
+            thread = threading.Thread(
+                target=build,
+                args=(layer,),
+                name=f"inventory_{layer['prefix']}",
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+    return threads
+
+
+def save_all() -> None:
+    """Persist snapshots of ready inventories."""
+    with _inventories_lock:
+        inventories = list(_inventories.values())
+    for inventory in inventories:
+        if inventory.ready.is_set():
+            inventory.save()
@@ -0,0 +1,344 @@
+"""Disk quota enforcement for tile cache.
+
+Janitor thread periodically measures layer cache directories and, when a
+layer quota or global quota is exceeded, evicts tiles:
+
+  1. expired by layer "cache_ttl", tiles and TNE markers, as they would be
+     fetched again anyway;
+  2. least recently used tiles.
+
+Last access time is recorded by the server, as filesystem atime is usually
+disabled or relaxed. Tiles never accessed since recording started are aged
+by their mtime.
+
+To keep memory low for millions of files, eviction takes two passes: first
+pass builds a histogram of tile sizes by last access hour and finds a cutoff
+hour, second pass deletes tiles accessed before it. Directory walk runs in
+batches with pauses, at idle IO priority where supported.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import mimetypes
+import os
+import pathlib
+import platform
+import threading
+import time
+
+import twms.config
+import twms.dedup
+import twms.fetchers
+import twms.inventory
+import twms.layouts
+import twms.tne
+
+logger = logging.getLogger(__name__)
+
+ACCESS_NAME = "access.twms"
+BUCKET = 3600  # seconds, last access histogram resolution
+TOUCH_EVERY = 3600  # seconds, don't record repeated access more often
+
+
+class AccessIndex(twms.tne.TneIndex):
+    """Last access time of cached tiles, stored like TNE index."""
+
+    magic = b"TWMSACC1"
+
+
+_access: dict[str, AccessIndex] = dict()
+_access_lock = threading.Lock()
+
+
+def access_index(prefix: str) -> AccessIndex:
+    """Return access index of a layer cache, loading it on first use."""
+    with _access_lock:
+        if prefix not in _access:
+            index = AccessIndex(
+                pathlib.Path(twms.config.tiles_cache) / prefix / ACCESS_NAME
+            )
+            try:
+                index.load()
+            except ValueError:
+                logger.exception(f"{prefix}: access index is broken, starting anew")
+            _access[prefix] = index
+        return _access[prefix]
+
+
+def enabled(layer: dict) -> bool:
+    """Check whether layer cache is under a quota."""
+    return bool(twms.config.cache_quota or layer["cache_quota"])
+
+
+def touch(layer: dict, z: int, x: int, y: int) -> None:
+    """Record access to a cached tile."""
+    if not enabled(layer):
+        return
+    index = access_index(layer["prefix"])
+    now = time.time()
+    last = index.get(z, x, y)
+    if last is None or now - last > TOUCH_EVERY:
+        index.add(z, x, y, now)
+
+
+def save_all() -> None:
+    """Persist modified access indexes."""
+    with _access_lock:
+        indexes = list(_access.values())
+    for index in indexes:
+        if index.dirty:
+            index.save()
+
+
+def lower_io_priority() -> None:
+    """Make current thread nice and idle IO class, best effort (Linux)."""
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)  # Per thread on Linux
+    except (AttributeError, OSError):
+        pass
+    # ioprio_set() has no libc wrapper
+    syscalls = {"x86_64": 251, "aarch64": 30, "i686": 289, "armv7l": 314}
+    if (nr := syscalls.get(platform.machine())) is None:
+        return
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        IOPRIO_WHO_PROCESS, IOPRIO_CLASS_IDLE = 1, 3
+        libc.syscall(nr, IOPRIO_WHO_PROCESS, tid, IOPRIO_CLASS_IDLE << 13)
+    except (AttributeError, OSError):
+        pass
+
+
+class LayerUsage:
+    """First pass result for a single layer."""
+
+    def __init__(self):
+        self.total = 0
+        self.expired = 0
+        self.histogram: dict[int, int] = dict()  # {access hour: bytes}
+        self.evict = False  # delete expired files
+        self.cutoff: int | None = None  # and tiles accessed before this hour
+        self.freed = 0
+
+    def need(self, quota: int | None) -> int:
+        """Bytes to free to get below target fraction of quota."""
+        if not quota or self.total <= quota:
+            return 0
+        return self.total - int(quota * twms.config.janitor_target)
+
+    def find_cutoff(self, need: int) -> None:
+        """Find access hour to evict tiles before, to free `need` bytes.
+
+        >>> usage = LayerUsage()
+        >>> usage.histogram = {10: 100, 11: 100, 12: 100}
+        >>> usage.find_cutoff(150)
+        >>> usage.cutoff, usage.freed
+        (12, 200)
+        """
+        for hour in sorted(self.histogram):
+            if self.freed >= need:
+                break
+            self.freed += self.histogram[hour]
+            self.cutoff = hour + 1
+
+
+class Janitor:
+    """Background quota enforcement for configured layers."""
+
+    def __init__(
+        self,
+        layers: dict[str, dict],
+        quota: int | None = None,
+        batch: int = 1000,
+        pause: float = 0.1,
+    ):
+        """Create janitor.
+
+        Args:
+            layers: layers config
+            quota: bytes, all layers together
+            batch: files processed between pauses
+            pause: seconds to yield disk to the server
+        """
+        self.layers = {
+            layer["prefix"]: layer for layer in layers.values() if enabled(layer)
+        }
+        # 512 px tiles derived from z+1 tiles of the layers
+        for layer in list(self.layers.values()):
+            hidpi = twms.fetchers.hidpi_layer(layer)
+            self.layers[hidpi["prefix"]] = hidpi
+        self.quota = quota
+        self.batch = batch
+        self.pause = pause
+        self._processed = 0
+
+    def _throttle(self) -> None:
+        self._processed += 1
+        if self._processed % self.batch == 0:
+            time.sleep(self.pause)
+
+    def entries(self, layer: dict):
+        """Iterate over (z, x, y, ext, mtime, size) of layer cache files."""
+        inventory = twms.inventory.for_layer(layer)
+        blobs = twms.dedup.for_layer(layer)
+        ext = mimetypes.guess_extension(layer["mimetype"])
+        if inventory is not None and inventory.ready.is_set():
+            for z, x, y, mtime, size in inventory.items():
+                if blobs is not None:
+                    mtime = blobs.mtime(z, x, y, mtime)
+                yield z, x, y, ext, mtime, size
+            for z, x, y, mtime in inventory.tne_items():
+                yield z, x, y, ".tne", mtime, 0
+            return
+        layer_dir = pathlib.Path(twms.config.tiles_cache) / layer["prefix"]
+        for z, x, y, file_ext, entry in twms.layouts.walk(
+            layer_dir, layer["layout"], (ext, ".tne")
+        ):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            self._throttle()
+            mtime = st.st_mtime
+            if blobs is not None and file_ext == ext:
+                mtime = blobs.mtime(z, x, y, mtime)
+            yield (
+                z,
+                x,
+                y,
+                file_ext,
+                mtime,
+                # Deduplicated tile shares blob size with other links
+                st.st_size // max(st.st_nlink - 1, 1),
+            )
+
+    def measure(self, layer: dict, now: float) -> LayerUsage:
+        """First pass: count bytes by last access hour."""
+        usage = LayerUsage()
+        access = access_index(layer["prefix"])
+        ttl = layer["cache_ttl"]
+        for z, x, y, ext, mtime, size in self.entries(layer):
+            usage.total += size
+            if ttl and now - mtime > ttl:
+                usage.expired += size
+            elif ext != ".tne":
+                hour = int(max(mtime, access.get(z, x, y) or 0) // BUCKET)
+                usage.histogram[hour] = usage.histogram.get(hour, 0) + size
+        return usage
+
+    def evict(self, layer: dict, cutoff: int | None, now: float) -> tuple[int, int]:
+        """Second pass: delete expired and least recently used files.
+
+        Returns:
+            Number of deleted files and freed bytes.
+        """
+        layer_dir = pathlib.Path(twms.config.tiles_cache) / layer["prefix"]
+        access = access_index(layer["prefix"])
+        inventory = twms.inventory.for_layer(layer)
+        blobs = twms.dedup.for_layer(layer)
+        ttl = layer["cache_ttl"]
+        count = freed = 0
+        for z, x, y, ext, mtime, size in self.entries(layer):
+            expired = ttl and now - mtime > ttl
+            if not expired:
+                if ext == ".tne" or cutoff is None:
+                    continue
+                if max(mtime, access.get(z, x, y) or 0) // BUCKET >= cutoff:
+                    continue
+            try:
+                path = twms.layouts.tile_path(layer["layout"], z, x, y)
+                os.unlink(layer_dir / f"{path}{ext}")
+            except FileNotFoundError:
+                pass
+            if inventory is not None:
+                if ext == ".tne":
+                    inventory.discard_tne(z, x, y)
+                else:
+                    inventory.discard_tile(z, x, y)
+            if ext != ".tne":
+                access.remove(z, x, y)
+                if blobs is not None:
+                    blobs.forget(z, x, y)
+            count += 1
+            freed += size
+            self._throttle()
+
+        if blobs is not None:
+            blobs.collect_garbage()
+
+        if ttl and layer["tne_index"]:
+            index = twms.tne.get_index(layer["prefix"])
+            for z, x, y, stamp in list(index.items()):
+                if now - stamp > ttl:
+                    index.remove(z, x, y)
+                    count += 1
+        return count, freed
+
+    def run_once(self) -> dict[str, tuple[int, int]]:
+        """Check quotas and evict.
+
+        Returns:
+            {prefix: (deleted files, freed bytes)} for layers over quota.
+        """
+        now = time.time()
+        usages = {
+            prefix: self.measure(layer, now) for prefix, layer in self.layers.items()
+        }
+        # Layer quotas, expired files go first
+        for prefix, usage in usages.items():
+            if need := usage.need(self.layers[prefix]["cache_quota"]):
+                usage.evict = True
+                if need > usage.expired:
+                    usage.find_cutoff(need - usage.expired)
+
+        # Global quota over what is left after layer eviction
+        remaining = sum(
+            u.total - u.expired - u.freed if u.evict else u.total
+            for u in usages.values()
+        )
+        if self.quota and remaining > self.quota:
+            need = remaining - int(self.quota * twms.config.janitor_target)
+            merged = LayerUsage()
+            for usage in usages.values():
+                if not usage.evict:
+                    usage.evict = True
+                    need -= usage.expired
+                for hour, size in usage.histogram.items():
+                    if usage.cutoff is None or hour >= usage.cutoff:
+                        merged.histogram[hour] = merged.histogram.get(hour, 0) + size
+            if need > 0:
+                merged.find_cutoff(need)
+                for usage in usages.values():
+                    if usage.cutoff is None or usage.cutoff < merged.cutoff:
+                        usage.cutoff = merged.cutoff
+
+        results = dict()
+        for prefix, usage in usages.items():
+            if not usage.evict:
+                continue
+            count, freed = self.evict(self.layers[prefix], usage.cutoff, now)
+            results[prefix] = count, freed
+            quota = self.layers[prefix]["cache_quota"] or self.quota
+            logger.info(
+                f"{prefix}: cache {usage.total} bytes, quota {quota} bytes, evicted {count} files, {freed} bytes"
+            )
+        save_all()
+        return results
+
+    def start(self, interval: float) -> threading.Thread:
+        """Run janitor periodically in background."""
+
+        def loop():
+            lower_io_priority()
+            while True:
+                try:
+                    self.run_once()
+                except Exception:
+                    # Keep janitor alive, next run may succeed
+                    logger.exception("Cache janitor failed")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=loop, name="janitor", daemon=True)
+        thread.start()
+        return thread
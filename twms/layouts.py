@@ -0,0 +1,226 @@
+"""Tile cache directory layouts.
+
+MOBAC `{z}/{x}/{y}` layout puts up to 2^z subdirectories into a single zoom
+directory, which is slow on many filesystems at high zoom levels. Other
+layouts limit directory size:
+
+  * "tms" - `{z}/{x}/{y}`, SAS.Planet MOBAC, MapProxy "tms"
+  * "tc" - `{z:02}/{x:09}/{y:09}` split into triplets, MapProxy "tc",
+    up to 1000 entries per directory
+  * "quadkey" - `{z}/{q[0:4]}/{q[4:8]}/.../{q}`, up to 256 entries per directory
+  * "hashed" - `{z}/{h[0:2]}/{h[2:4]}/{x}_{y}`, uniform 256-way fan-out
+    by CRC32 of tile number
+
+Tile paths are given without extension, as tile and TNE files share them.
+Path is computed from tile number alone, so lookup is a single `stat()`
+regardless of cache size.
+
+Cache is moved to another layout online: layer "layout_previous" makes the
+server move each requested tile on first access, while `python -m twms
+migrate` moves the rest in background. Files are moved with link and
+unlink, so a tile already written in new layout is never overwritten.
+"""
+
+import concurrent.futures
+import contextlib
+import itertools
+import logging
+import os
+import pathlib
+import zlib
+
+logger = logging.getLogger(__name__)
+
+LAYOUTS = ("tms", "tc", "quadkey", "hashed")
+
+
+def quadkey(z: int, x: int, y: int) -> str:
+    """Bing quadkey of a tile.
+
+    >>> quadkey(3, 3, 5)
+    '213'
+    """
+    digits = []
+    for i in range(z, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return "".join(digits)
+
+
+def from_quadkey(q: str) -> tuple[int, int, int]:
+    """Tile number from Bing quadkey.
+
+    >>> from_quadkey("213")
+    (3, 3, 5)
+    """
+    x = y = 0
+    for digit in q:
+        x, y = x << 1 | int(digit) & 1, y << 1 | int(digit) >> 1
+    return len(q), x, y
+
+
+def _triplets(n: int) -> str:
+    return f"{n // 1000000:03d}/{n // 1000 % 1000:03d}/{n % 1000:03d}"
+
+
+def tile_path(layout: str, z: int, x: int, y: int) -> str:
+    """Relative tile path without extension.
+
+    >>> [tile_path(layout, 19, 300000, 170000) for layout in LAYOUTS]
+    ['19/300000/170000', '19/000/300/000/000/170/000', '19/1203/0032/0111/1120/1203003201111120000', '19/5c/ea/300000_170000']
+    """
+    if layout == "tms":
+        return f"{z}/{x}/{y}"
+    elif layout == "tc":
+        return f"{z:02d}/{_triplets(x)}/{_triplets(y)}"
+    elif layout == "quadkey":
+        q = quadkey(z, x, y)
+        dirs = [q[:end][-4:] for end in range(4, len(q), 4)]
+        return "/".join([str(z), *dirs, q or "0"])
+    elif layout == "hashed":
+        h = zlib.crc32(f"{z}/{x}/{y}".encode())
+        return f"{z}/{h & 0xFF:02x}/{h >> 8 & 0xFF:02x}/{x}_{y}"
+    raise ValueError(f"Unknown cache layout '{layout}', must be one of {LAYOUTS}")
+
+
+def parse_path(layout: str, rel_path: str) -> tuple[int, int, int] | None:
+    """Tile number from relative path without extension, None if not a tile.
+
+    >>> all(
+    ...     parse_path(layout, tile_path(layout, 19, 300000, 170000))
+    ...     == (19, 300000, 170000)
+    ...     for layout in LAYOUTS
+    ... )
+    True
+    """
+    parts = rel_path.split("/")
+    try:
+        if layout == "tms" and len(parts) == 3:
+            z, x, y = map(int, parts)
+        elif layout == "tc" and len(parts) == 7:
+            n = [int(p) for p in parts]
+            z = n[0]
+            x = n[1] * 1000000 + n[2] * 1000 + n[3]
+            y = n[4] * 1000000 + n[5] * 1000 + n[6]
+        elif layout == "quadkey" and not set(parts[-1]) - set("0123"):
+            z, x, y = from_quadkey(parts[-1] if parts[0] != "0" else "")
+            if z != int(parts[0]):
+                return None
+        elif layout == "hashed" and len(parts) == 4:
+            x, y = map(int, parts[3].split("_"))
+            z = int(parts[0])
+        else:
+            return None
+    except ValueError:
+        return None
+    return z, x, y
+
+
+def walk(layer_dir: str | pathlib.Path, layout: str, exts: tuple[str, ...]):
+    """Iterate over (z, x, y, ext, DirEntry) of tile files in any layout."""
+    layer_dir = str(layer_dir)
+    stack = [layer_dir]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue  # Blobs, temporary files
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+                continue
+            root, ext = os.path.splitext(entry.path)
+            if ext not in exts:
+                continue
+            rel_path = os.path.relpath(root, layer_dir).replace(os.sep, "/")
+            if tile := parse_path(layout, rel_path):
+                yield *tile, ext, entry
+
+
+def move(src: str | pathlib.Path, dst: str | pathlib.Path) -> bool:
+    """Move file unless destination exists, stale source is removed then.
+
+    >>> import tempfile
+    >>> root = pathlib.Path(tempfile.mkdtemp())
+    >>> (root / "old.png").write_bytes(b"old")
+    3
+    >>> move(root / "old.png", root / "new/new.png"), (root / "old.png").exists()
+    (True, False)
+    >>> (root / "old.png").write_bytes(b"stale")
+    5
+    >>> move(root / "old.png", root / "new/new.png"), (root / "new/new.png").read_bytes()
+    (False, b'old')
+
+    Returns:
+        True if moved.
+    """
+    for attempt in range(2):
+        try:
+            os.link(src, dst)
+            moved = True
+            break
+        except FileExistsError:
+            moved = False  # Newer tile was written meanwhile
+            break
+        except FileNotFoundError:
+            if attempt or not os.path.exists(src):
+                return False
+            pathlib.Path(dst).parent.mkdir(parents=True, exist_ok=True)
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(src)
+    return moved
+
+
+def migrate(
+    layer_dir: str | pathlib.Path,
+    src: str,
+    dst: str,
+    exts: tuple[str, ...],
+    threads: int = 8,
+    batch: int = 1024,
+) -> int:
+    """Move layer cache from `src` layout to `dst`, safe to run with server.
+
+    >>> import tempfile
+    >>> root = pathlib.Path(tempfile.mkdtemp())
+    >>> for y in range(3):
+    ...     path = root / f"{tile_path('tms', 19, 300000, y)}.png"
+    ...     path.parent.mkdir(parents=True, exist_ok=True)
+    ...     _ = path.write_bytes(b"PNG")
+    >>> migrate(root, "tms", "tc", (".png", ".tne"))
+    3
+    >>> sorted(p.relative_to(root).as_posix() for p in root.rglob("*.png"))
+    ['19/000/300/000/000/000/000.png', '19/000/300/000/000/000/001.png', '19/000/300/000/000/000/002.png']
+
+    Returns:
+        Number of moved files.
+    """
+    layer_dir = pathlib.Path(layer_dir)
+
+    def move_tile(tile) -> bool:
+        z, x, y, ext, entry = tile
+        return move(entry.path, layer_dir / f"{tile_path(dst, z, x, y)}{ext}")
+
+    count = 0
+    tiles = walk(layer_dir, src, exts)
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        # Bounded batches, as walk over millions of files is lazy
+        while chunk := list(itertools.islice(tiles, batch)):
+            count += sum(pool.map(move_tile, chunk))
+    logger.info(f"{layer_dir}: moved {count} files from '{src}' to '{dst}' layout")
+    remove_empty_dirs(layer_dir)
+    return count
+
+
+def remove_empty_dirs(layer_dir: str | pathlib.Path) -> None:
+    """Remove directories left empty, except hidden ones."""
+    for root, dirs, files in os.walk(layer_dir, topdown=False):
+        rel_path = os.path.relpath(root, layer_dir)
+        if rel_path == "." or any(p.startswith(".") for p in rel_path.split(os.sep)):
+            continue
+        if not dirs and not files:
+            with contextlib.suppress(OSError):
+                os.rmdir(root)  # Server may have written a tile meanwhile
@@ -0,0 +1,342 @@
+"""Export of cached tiles as a single GeoTIFF mosaic.
+
+WMS output is limited by `max_width` and `max_height`, as the whole image
+is built in RAM. Mosaic export has no size limit. Output is a tiled TIFF
+whose 256 px tiles are the cached tiles of the chosen zoom level, so no
+resampling is done. Tiles are read, decoded and deflated by a pool of
+threads, and written in file order as they complete, while only a bounded
+window of them is kept in memory.
+
+TIFF is written here, not by Pillow, which needs the whole image:
+
+    header  (first IFD offset patched at the end)
+    tile data, row by row
+    IFD with tile offsets, GeoTIFF tags and world file alongside
+
+BigTIFF is used when output may exceed 4 GiB.
+"""
+
+import array
+import collections
+import concurrent.futures
+import logging
+import math
+import os
+import pathlib
+import struct
+import typing
+import zlib
+
+from PIL import Image, ImageChops
+
+import twms.bbox
+import twms.config
+import twms.fetchers
+import twms.projections
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+CLASSIC_LIMIT = 2**32 - 2**24  # Margin for IFD and deflate overhead
+
+# TIFF field types by struct format
+FIELD_TYPES = {"s": 2, "H": 3, "I": 4, "d": 12, "Q": 16}
+
+
+class TiffWriter:
+    """Tiled RGBA TIFF or BigTIFF writer, tiles are written once in any order.
+
+    >>> import io
+    >>> buf = io.BytesIO()
+    >>> tiff = TiffWriter(buf, (512, 256))
+    >>> red = encode_tile(Image.new("RGBA", (256, 256), "red"))
+    >>> tiff.write_tile(1, encode_tile(Image.new("RGBA", (256, 256), "blue")))
+    >>> tiff.write_tile(0, red)
+    >>> tiff.close()
+    >>> im = Image.open(buf)
+    >>> im.size, im.mode, im.getpixel((0, 0)), im.getpixel((511, 255))
+    ((512, 256), 'RGBA', (255, 0, 0, 255), (0, 0, 255, 255))
+    """
+
+    def __init__(
+        self,
+        file: typing.BinaryIO,
+        size: tuple[int, int],
+        bigtiff: bool = False,
+        tags: list[tuple[int, str, tuple]] = (),
+    ):
+        """Write header.
+
+        Args:
+            file: seekable binary file
+            size: image (width, height), multiple of tile size
+            bigtiff: use 64-bit offsets
+            tags: extra (tag, struct format, values) IFD entries
+        """
+        self.file = file
+        self.size = size
+        self.bigtiff = bigtiff
+        self.tags = list(tags)
+        self.tiles_across = math.ceil(size[0] / TILE_SIZE)
+        tiles = self.tiles_across * math.ceil(size[1] / TILE_SIZE)
+        self.offsets = array.array("Q", bytes(8 * tiles))
+        self.counts = array.array("Q", bytes(8 * tiles))
+        if bigtiff:
+            self.file.write(struct.pack("<2sHHHQ", b"II", 43, 8, 0, 0))
+        else:
+            self.file.write(struct.pack("<2sHI", b"II", 42, 0))
+
+    def write_tile(self, index: int, data: bytes) -> None:
+        """Append compressed tile, `index` is row-major tile number."""
+        offset = self.file.tell()
+        self.file.write(data)
+        if len(data) % 2:
+            self.file.write(b"\0")  # Word alignment
+        if not self.bigtiff and offset + len(data) >= 2**32:
+            raise ValueError("TIFF exceeds 4 GiB, use BigTIFF")
+        self.offsets[index] = offset
+        self.counts[index] = len(data)
+
+    def close(self) -> None:
+        """Write image file directory and point header to it."""
+        offset_format = "Q" if self.bigtiff else "I"
+        entries = sorted(
+            [
+                (256, "I", (self.size[0],)),  # ImageWidth
+                (257, "I", (self.size[1],)),  # ImageLength
+                (258, "H", (8, 8, 8, 8)),  # BitsPerSample
+                (259, "H", (8,)),  # Compression: Adobe deflate
+                (262, "H", (2,)),  # PhotometricInterpretation: RGB
+                (277, "H", (4,)),  # SamplesPerPixel
+                (284, "H", (1,)),  # PlanarConfiguration: chunky
+                (305, "s", (twms.config.wms_name.encode("latin-1") + b"\0",)),
+                (317, "H", (2,)),  # Predictor: horizontal differencing
+                (322, "H", (TILE_SIZE,)),  # TileWidth
+                (323, "H", (TILE_SIZE,)),  # TileLength
+                (324, offset_format, tuple(self.offsets)),  # TileOffsets
+                (325, offset_format, tuple(self.counts)),  # TileByteCounts
+                (338, "H", (2,)),  # ExtraSamples: unassociated alpha
+                *self.tags,
+            ]
+        )
+        if self.bigtiff:
+            slot, entry_format, count_format = 8, "<HHQ", "<Q"
+        else:
+            slot, entry_format, count_format = 4, "<HHI", "<H"
+
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() % 2:
+            self.file.write(b"\0")
+        ifd_offset = self.file.tell()
+        ifd_size = (
+            struct.calcsize(count_format)
+            + len(entries) * (struct.calcsize(entry_format) + slot)
+            + slot
+        )
+        ifd = bytearray(struct.pack(count_format, len(entries)))
+        values = bytearray()
+        for tag, fmt, value in entries:
+            if fmt == "s":
+                data, count = value[0], len(value[0])
+            else:
+                data, count = struct.pack(f"<{len(value)}{fmt}", *value), len(value)
+            ifd += struct.pack(entry_format, tag, FIELD_TYPES[fmt], count)
+            if len(data) <= slot:
+                ifd += data.ljust(slot, b"\0")
+            else:
+                ifd += struct.pack(
+                    f"<{offset_format}", ifd_offset + ifd_size + len(values)
+                )
+                values += data + b"\0" * (len(data) % 2)
+        ifd += bytes(slot)  # No next IFD
+        self.file.write(ifd + values)
+        self.file.seek(8 if self.bigtiff else 4)
+        self.file.write(struct.pack(f"<{offset_format}", ifd_offset))
+
+
+def encode_tile(im: Image.Image, level: int = 6) -> bytes:
+    """Deflate RGBA tile with horizontal differencing predictor."""
+    left = Image.new("RGBA", im.size)
+    left.paste(im.crop((0, 0, im.width - 1, im.height)), (1, 0))
+    return zlib.compress(ImageChops.subtract_modulo(im, left).tobytes(), level)
+
+
+def geotiff_tags(
+    srs: twms.projections.EPSG, scale: tuple[float, float], origin: tuple[float, float]
+) -> list[tuple[int, str, tuple]]:
+    """GeoTIFF georeferencing of north-up image.
+
+    >>> geotiff_tags("EPSG:3857", (1.0, 1.0), (0.0, 0.0))[2]
+    (34735, 'H', (1, 1, 0, 3, 1024, 0, 1, 1, 1025, 0, 1, 1, 3072, 0, 1, 3857))
+    """
+    tags = [
+        (33550, "d", (scale[0], scale[1], 0.0)),  # ModelPixelScale
+        (33922, "d", (0.0, 0.0, 0.0, origin[0], origin[1], 0.0)),  # ModelTiepoint
+    ]
+    authority, _, code = srs.partition(":")
+    if authority == "EPSG" and code.isdigit():
+        if srs == "EPSG:4326":
+            model, key = 2, 2048  # Geographic, GeographicTypeGeoKey
+        else:
+            model, key = 1, 3072  # Projected, ProjectedCSTypeGeoKey
+        tags.append(
+            (
+                34735,  # GeoKeyDirectory: version, revision, keys: id, location, count, value
+                "H",
+                (1, 1, 0, 3, 1024, 0, 1, model, 1025, 0, 1, 1, key, 0, 1, int(code)),
+            )
+        )
+    return tags
+
+
+def read_tile(layer: dict, z: int, x: int, y: int) -> Image.Image | None:
+    """Decode cached tile, None if it is missing or invalid."""
+    try:
+        data = twms.fetchers.tile_storage(layer, z, x, y).read()
+        return twms.fetchers.TileImage.from_bytes(data).image().convert("RGBA")
+    except FileNotFoundError:
+        return None
+    except OSError as err:
+        logger.warning(f"z{z}/x{x}/y{y} invalid tile: {err}")
+        return None
+
+
+def tile_range(
+    bbox: twms.bbox.Bbox, zoom: int, srs: twms.projections.EPSG
+) -> tuple[int, int, int, int]:
+    """Whole tiles covering EPSG:4326 bbox.
+
+    >>> tile_range((27.4, 53.8, 27.7, 54.0), 12, "EPSG:3857")
+    (2359, 1315, 2363, 1319)
+
+    Returns:
+        (from x, from y, to x, to y), inclusive, north-west origin.
+    """
+    if bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        raise ValueError(f"Invalid bbox {bbox}, must be west,south,east,north")
+    tile_grid = twms.projections.grid(srs)
+    left, top = tile_grid.tile_by_coords((bbox[0], bbox[3]), zoom)
+    right, bottom = tile_grid.tile_by_coords((bbox[2], bbox[1]), zoom)
+    last = 2**zoom - 1
+    return (
+        min(max(int(left), 0), last),
+        min(max(int(top), 0), last),
+        min(max(math.ceil(right) - 1, 0), last),
+        min(max(math.ceil(bottom) - 1, 0), last),
+    )
+
+
+def bounded_map(
+    pool: concurrent.futures.Executor,
+    func: typing.Callable,
+    items: typing.Iterable,
+    window: int,
+) -> typing.Iterator:
+    """`Executor.map` with at most `window` results pending.
+
+    >>> with concurrent.futures.ThreadPoolExecutor(2) as pool:
+    ...     list(bounded_map(pool, abs, range(0, -5, -1), 3))
+    [0, 1, 2, 3, 4]
+    """
+    pending: collections.deque[concurrent.futures.Future] = collections.deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def export(
+    layer: dict,
+    bbox: twms.bbox.Bbox,
+    zoom: int,
+    path: str | pathlib.Path,
+    bigtiff: bool | None = None,
+    threads: int = 8,
+) -> tuple[int, int]:
+    """Write cached tiles covering bbox as GeoTIFF with world file.
+
+    Mosaic is snapped outwards to whole tiles. Missing tiles are transparent.
+
+    >>> import tempfile
+    >>> from unittest import mock
+    >>> def read(layer, z, x, y):
+    ...     return Image.new("RGBA", (256, 256), "green") if x % 2 else None
+    >>> path = pathlib.Path(tempfile.mkdtemp()) / "minsk.tif"
+    >>> with mock.patch(f"{__name__}.read_tile", read):
+    ...     export({"proj": "EPSG:3857"}, (27.4, 53.8, 27.7, 54.0), 12, path)
+    (25, 10)
+    >>> im = Image.open(path)
+    >>> im.size, im.getpixel((0, 0)), im.getpixel((256, 0))
+    ((1280, 1280), (0, 128, 0, 255), (0, 0, 0, 0))
+    >>> [round(float(v), 2) for v in path.with_suffix(".tfw").read_text().split()]
+    [38.22, 0.0, 0.0, -38.22, 3042824.33, 7171608.63]
+
+    Args:
+        layer: layer config
+        bbox: EPSG:4326 bbox
+        zoom: zoom level of cached tiles
+        path: output TIFF
+        bigtiff: force BigTIFF or classic TIFF, None to choose by size
+        threads: parallel tile readers
+
+    Returns:
+        Number of tiles and number of missing ones.
+    """
+    path = pathlib.Path(path)
+    tile_grid = twms.projections.grid(layer["proj"])
+    from_x, from_y, to_x, to_y = tile_range(bbox, zoom, layer["proj"])
+    across, down = to_x - from_x + 1, to_y - from_y + 1
+    size = (across * TILE_SIZE, down * TILE_SIZE)
+    if bigtiff is None:
+        bigtiff = size[0] * size[1] * 4 > CLASSIC_LIMIT
+
+    scale = (
+        tile_grid.extent[0] / (TILE_SIZE * 2**zoom),
+        tile_grid.extent[1] / (TILE_SIZE * 2**zoom),
+    )
+    origin = (
+        tile_grid.projected_bounds[0] + from_x * TILE_SIZE * scale[0],
+        tile_grid.projected_bounds[3] - from_y * TILE_SIZE * scale[1],
+    )
+    empty = encode_tile(Image.new("RGBA", (TILE_SIZE, TILE_SIZE)))
+
+    def read_encode(index: int) -> bytes | None:
+        im = read_tile(layer, zoom, from_x + index % across, from_y + index // across)
+        return encode_tile(im) if im else None
+
+    missing = 0
+    tmp = path.with_name(f".{path.name}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            tiff = TiffWriter(
+                f, size, bigtiff, geotiff_tags(tile_grid.srs, scale, origin)
+            )
+            with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+                tiles = bounded_map(
+                    pool, read_encode, range(across * down), threads * 4
+                )
+                for index, data in enumerate(tiles):
+                    missing += data is None
+                    tiff.write_tile(index, data or empty)
+            tiff.close()
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    # World file: pixel size, rotation, center of north-west pixel
+    world = (
+        scale[0],
+        0.0,
+        0.0,
+        -scale[1],
+        origin[0] + scale[0] / 2,
+        origin[1] - scale[1] / 2,
+    )
+    path.with_suffix(".tfw").write_text("".join(f"{v!r}\n" for v in world))
+    logger.info(
+        f"{path}: {size[0]}x{size[1]} px, {across * down} tiles, {missing} missing"
+    )
+    return across * down, missing
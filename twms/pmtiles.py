@@ -0,0 +1,460 @@
+"""PMTiles v3 single-file tile archive.
+
+Pre-seeded cache for offline use is easier to copy as one file than as
+millions of tiles. PMTiles archive consists of:
+
+    header (127 bytes)
+    root directory (with header fits into first 16 KiB)
+    JSON metadata
+    leaf directories
+    tile data
+
+Tiles are addressed by Hilbert curve tile id, a directory is a sorted list
+of (tile_id, run_length, length, offset) entries, varint encoded. Entry with
+zero run length points to a leaf directory.
+
+Archive is memory mapped, so serving a tile is a binary search in decoded
+directory and a zero copy slice of the mapping, no file opens per tile.
+
+See:
+  [1] https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+"""
+
+import array
+import bisect
+import functools
+import hashlib
+import itertools
+import json
+import logging
+import mimetypes
+import mmap
+import os
+import pathlib
+import struct
+import tempfile
+import threading
+import zlib
+
+import twms.config
+import twms.layouts
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct("<7sBQQQQQQQQQQQBBBBBBiiiiBii")
+HEADER_FIELDS = (
+    "magic",
+    "version",
+    "root_offset",
+    "root_length",
+    "metadata_offset",
+    "metadata_length",
+    "leaf_offset",
+    "leaf_length",
+    "data_offset",
+    "data_length",
+    "addressed_tiles",
+    "tile_entries",
+    "tile_contents",
+    "clustered",
+    "internal_compression",
+    "tile_compression",
+    "tile_type",
+    "min_zoom",
+    "max_zoom",
+    "min_lon_e7",
+    "min_lat_e7",
+    "max_lon_e7",
+    "max_lat_e7",
+    "center_zoom",
+    "center_lon_e7",
+    "center_lat_e7",
+)
+ROOT_MAX = 16384 - HEADER.size  # Root directory must fit first 16 KiB
+COMPRESSION_NONE, COMPRESSION_GZIP = 1, 2
+TILE_TYPES = {"image/png": 2, "image/jpeg": 3, "image/webp": 4, "image/avif": 5}
+
+
+def zxy_to_tileid(z: int, x: int, y: int) -> int:
+    """Hilbert curve tile id, tiles of lower zooms go first.
+
+    >>> [zxy_to_tileid(*t) for t in ((0, 0, 0), (1, 0, 0), (1, 0, 1), (1, 1, 1), (1, 1, 0))]
+    [0, 1, 2, 3, 4]
+    """
+    tile_id = ((1 << 2 * z) - 1) // 3  # Tiles on lower zooms
+    n = 1 << z
+    s = n >> 1
+    while s:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        if not ry:
+            if rx:
+                x, y = n - 1 - x, n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return tile_id
+
+
+def tileid_to_zxy(tile_id: int) -> tuple[int, int, int]:
+    """Tile number from Hilbert curve tile id.
+
+    >>> tileid_to_zxy(zxy_to_tileid(19, 300000, 170000))
+    (19, 300000, 170000)
+    """
+    z = 0
+    while tile_id >= ((1 << 2 * (z + 1)) - 1) // 3:
+        z += 1
+    d = tile_id - ((1 << 2 * z) - 1) // 3
+    x = y = 0
+    s = 1
+    while s < 1 << z:
+        rx = 1 & (d >> 1)
+        ry = 1 & (d ^ rx)
+        if not ry:
+            if rx:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+        x += s * rx
+        y += s * ry
+        d >>= 2
+        s <<= 1
+    return z, x, y
+
+
+def _varints(buf: bytes) -> list[int]:
+    values = list()
+    value = shift = 0
+    for byte in buf:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def _write_varint(buf: bytearray, value: int) -> None:
+    while value >= 0x80:
+        buf.append(value & 0x7F | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def decode_directory(buf: bytes) -> tuple[array.array, ...]:
+    """Decode directory into (tile_ids, run_lengths, lengths, offsets) arrays."""
+    values = iter(_varints(buf))
+    n = next(values)
+    # Columns follow each other
+    tile_ids, run_lengths, lengths, offsets = (
+        array.array("Q", itertools.islice(values, n)) for _ in range(4)
+    )
+    for i in range(1, n):
+        tile_ids[i] += tile_ids[i - 1]  # Delta encoded
+    for i in range(n):
+        if offsets[i] == 0 and i > 0:
+            offsets[i] = offsets[i - 1] + lengths[i - 1]  # Contiguous
+        else:
+            offsets[i] -= 1
+    return tile_ids, run_lengths, lengths, offsets
+
+
+def encode_directory(entries: list[tuple[int, int, int, int]]) -> bytes:
+    """Encode (tile_id, run_length, length, offset) entries, gzip compressed.
+
+    >>> entries = [(0, 1, 10, 0), (1, 2, 20, 10), (5, 0, 30, 0)]
+    >>> [list(a) for a in decode_directory(zlib.decompress(encode_directory(entries), 31))]
+    [[0, 1, 5], [1, 2, 0], [10, 20, 30], [0, 10, 0]]
+    """
+    buf = bytearray()
+    _write_varint(buf, len(entries))
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        _write_varint(buf, tile_id - last_id)
+        last_id = tile_id
+    for _, run_length, _, _ in entries:
+        _write_varint(buf, run_length)
+    for _, _, length, _ in entries:
+        _write_varint(buf, length)
+    for i, (_, _, length, offset) in enumerate(entries):
+        if i and offset == entries[i - 1][3] + entries[i - 1][2]:
+            _write_varint(buf, 0)
+        else:
+            _write_varint(buf, offset + 1)
+    compressor = zlib.compressobj(wbits=31)  # gzip
+    return compressor.compress(buf) + compressor.flush()
+
+
+class Archive:
+    """Memory mapped PMTiles archive, safe to share between threads."""
+
+    def __init__(self, path: str | pathlib.Path):
+        """Open archive.
+
+        Raises:
+            ValueError if not a PMTiles v3 archive
+        """
+        self.path = pathlib.Path(path)
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self._mmap)
+        if len(self.buf) < HEADER.size:
+            raise ValueError(f"'{self.path}' is too short for PMTiles")
+        self.header = dict(zip(HEADER_FIELDS, HEADER.unpack_from(self.buf)))
+        if self.header["magic"] != b"PMTiles" or self.header["version"] != 3:
+            raise ValueError(f"'{self.path}' is not a PMTiles v3 archive")
+        for field in ("internal_compression", "tile_compression"):
+            if self.header[field] not in (COMPRESSION_NONE, COMPRESSION_GZIP):
+                raise ValueError(f"'{self.path}': unsupported {field}")
+        self._directory = functools.lru_cache(maxsize=256)(self._read_directory)
+
+    def _decompress(self, data: memoryview, compression: int) -> bytes | memoryview:
+        if compression == COMPRESSION_GZIP:
+            return zlib.decompress(data, 31)
+        return data
+
+    def _read_directory(self, offset: int, length: int) -> tuple[array.array, ...]:
+        end = offset + length
+        return decode_directory(
+            self._decompress(self.buf[offset:end], self.header["internal_compression"])
+        )
+
+    def metadata(self) -> dict:
+        start = self.header["metadata_offset"]
+        end = start + self.header["metadata_length"]
+        return json.loads(
+            self._decompress(self.buf[start:end], self.header["internal_compression"])
+        )
+
+    def get(self, z: int, x: int, y: int) -> bytes | memoryview | None:
+        """Tile data, slice of the mapping if tiles aren't compressed."""
+        tile_id = zxy_to_tileid(z, x, y)
+        offset, length = self.header["root_offset"], self.header["root_length"]
+        for _ in range(4):  # Spec limits directory depth to 3 levels
+            tile_ids, run_lengths, lengths, offsets = self._directory(offset, length)
+            i = bisect.bisect_right(tile_ids, tile_id) - 1
+            if i < 0:
+                return None
+            if run_lengths[i]:
+                if tile_id >= tile_ids[i] + run_lengths[i]:
+                    return None
+                start = self.header["data_offset"] + offsets[i]
+                end = start + lengths[i]
+                return self._decompress(
+                    self.buf[start:end], self.header["tile_compression"]
+                )
+            # Leaf directory
+            offset = self.header["leaf_offset"] + offsets[i]
+            length = lengths[i]
+        return None
+
+
+_archives: dict[pathlib.Path, Archive] = dict()
+_archives_lock = threading.Lock()
+
+
+def archive_path(layer: dict) -> pathlib.Path:
+    return pathlib.Path(twms.config.tiles_cache) / f"{layer['prefix']}.pmtiles"
+
+
+def open_archive(path: pathlib.Path) -> Archive:
+    """Return shared archive, mapped on first use."""
+    with _archives_lock:
+        if path not in _archives:
+            _archives[path] = Archive(path)
+        return _archives[path]
+
+
+class PmtilesTile:
+    """Tile in read-only PMTiles archive, same interface as `fetchers.TileFile`."""
+
+    def __init__(self, path: pathlib.Path, mimetype: str, z: int, x: int, y: int):
+        """Tile storage "cache_dir/layer_id.pmtiles".
+
+        Args:
+            path: archive path
+            mimetype: One mimetype for whole layer
+            z: tile coordinate (starts with zero)
+            x: tile coordinate
+            y: tile coordinate (positive)
+        """
+        self.path = path
+        self.mimetype = mimetype
+        self.z, self.x, self.y = int(z), int(x), int(y)
+
+    def __str__(self):
+        return f"'{self.mimetype}' '{self.path}' z={self.z} x={self.x} y={self.y}"
+
+    def _get(self) -> bytes | memoryview | None:
+        try:
+            return open_archive(self.path).get(self.z, self.x, self.y)
+        except FileNotFoundError:
+            return None
+
+    def read(self) -> bytes | memoryview:
+        """Read tile image data.
+
+        Raises:
+            FileNotFoundError if tile doesn't exist
+        """
+        if (data := self._get()) is None:
+            raise FileNotFoundError(f"{self} not found")
+        logger.debug(f"Cache hit {self}")
+        return data
+
+    def exists(self) -> bool:
+        return self._get() is not None
+
+    def needs_fetch(self) -> bool:
+        """Archive is read-only, missing tiles are never fetched."""
+        return False
+
+    def set(self, blob: bytes | memoryview | None = None) -> None:
+        logger.warning(f"Read-only archive, not saving {self}")
+
+    def delete(self) -> None:
+        logger.warning(f"Read-only archive, not deleting {self}")
+
+
+def _build_directories(
+    entries: list[tuple[int, int, int, int]],
+) -> tuple[bytes, bytes]:
+    """Encode root directory, splitting entries into leaves if it's too big.
+
+    Returns:
+        Root directory and leaf directories.
+    """
+    root = encode_directory(entries)
+    if len(root) <= ROOT_MAX:
+        return root, b""
+    leaf_size = 4096
+    while True:
+        root_entries = list()
+        leaves = bytearray()
+        for start in range(0, len(entries), leaf_size):
+            end = start + leaf_size
+            chunk = entries[start:end]
+            leaf = encode_directory(chunk)
+            root_entries.append((chunk[0][0], 0, len(leaf), len(leaves)))
+            leaves += leaf
+        root = encode_directory(root_entries)
+        if len(root) <= ROOT_MAX:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+def export(
+    layer_dir: str | pathlib.Path,
+    layout: str,
+    mimetype: str,
+    path: str | pathlib.Path,
+    bounds: tuple[float, float, float, float] = (-180, -85.0511, 180, 85.0511),
+    metadata: dict | None = None,
+) -> tuple[int, int]:
+    """Write layer file cache into PMTiles archive, identical tiles stored once.
+
+    Tiles are read in tile id order and written sequentially, so only tile
+    ids and content digests are kept in memory.
+
+    >>> root = pathlib.Path(tempfile.mkdtemp())
+    >>> for z, x, y in ((0, 0, 0), (1, 0, 0), (1, 0, 1), (1, 1, 1)):
+    ...     path = root / f"{twms.layouts.tile_path('tms', z, x, y)}.png"
+    ...     path.parent.mkdir(parents=True, exist_ok=True)
+    ...     _ = path.write_bytes(b"sea" if z else b"world")
+    >>> export(root, "tms", "image/png", root / "out.pmtiles")
+    (4, 2)
+    >>> archive = Archive(root / "out.pmtiles")
+    >>> bytes(archive.get(0, 0, 0)), bytes(archive.get(1, 1, 1)), archive.get(1, 1, 0)
+    (b'world', b'sea', None)
+
+    Returns:
+        Number of tiles and unique tile contents.
+    """
+    path = pathlib.Path(path)
+    ext = mimetypes.guess_extension(mimetype)
+    tile_ids = array.array("Q")
+    for z, x, y, _, _ in twms.layouts.walk(layer_dir, layout, (ext,)):
+        tile_ids.append(zxy_to_tileid(z, x, y))
+    tile_ids = array.array("Q", sorted(tile_ids))
+
+    # [tile_id, run_length, length, offset], consecutive duplicates merged
+    entries: list[list[int]] = list()
+    contents: dict[bytes, tuple[int, int]] = dict()  # {sha256: (offset, length)}
+    addressed = 0
+    min_zoom = max_zoom = None
+    data_size = 0
+    with tempfile.TemporaryFile(dir=path.parent) as data:
+        for tile_id in tile_ids:
+            z, x, y = tileid_to_zxy(tile_id)
+            tile_path = twms.layouts.tile_path(layout, z, x, y)
+            try:
+                blob = (pathlib.Path(layer_dir) / f"{tile_path}{ext}").read_bytes()
+            except FileNotFoundError:
+                continue  # Removed meanwhile
+            digest = hashlib.sha256(blob).digest()
+            if digest not in contents:
+                contents[digest] = (data_size, len(blob))
+                data.write(blob)
+                data_size += len(blob)
+            offset, length = contents[digest]
+            last = entries[-1] if entries else None
+            if last and last[3] == offset and last[0] + last[1] == tile_id:
+                last[1] += 1
+            else:
+                entries.append([tile_id, 1, length, offset])
+            addressed += 1
+            min_zoom = z if min_zoom is None else min(min_zoom, z)
+            max_zoom = z if max_zoom is None else max(max_zoom, z)
+
+        root, leaves = _build_directories([tuple(e) for e in entries])
+        meta = zlib.compressobj(wbits=31)
+        meta = (
+            meta.compress(json.dumps(metadata or dict(), ensure_ascii=False).encode())
+            + meta.flush()
+        )
+        e7 = [round(v * 10**7) for v in bounds]
+        values = dict(
+            magic=b"PMTiles",
+            version=3,
+            root_offset=HEADER.size,
+            root_length=len(root),
+            metadata_offset=HEADER.size + len(root),
+            metadata_length=len(meta),
+            leaf_offset=HEADER.size + len(root) + len(meta),
+            leaf_length=len(leaves),
+            data_offset=HEADER.size + len(root) + len(meta) + len(leaves),
+            data_length=data_size,
+            addressed_tiles=addressed,
+            tile_entries=len(entries),
+            tile_contents=len(contents),
+            clustered=1,  # Data follows tile id order
+            internal_compression=COMPRESSION_GZIP,
+            tile_compression=COMPRESSION_NONE,  # Raster tiles are compressed already
+            tile_type=TILE_TYPES.get(mimetype, 0),
+            min_zoom=min_zoom or 0,
+            max_zoom=max_zoom or 0,
+            min_lon_e7=e7[0],
+            min_lat_e7=e7[1],
+            max_lon_e7=e7[2],
+            max_lat_e7=e7[3],
+            center_zoom=min_zoom or 0,
+            center_lon_e7=(e7[0] + e7[2]) // 2,
+            center_lat_e7=(e7[1] + e7[3]) // 2,
+        )
+        tmp = path.with_name(f".{path.name}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(HEADER.pack(*(values[field] for field in HEADER_FIELDS)))
+                f.write(root)
+                f.write(meta)
+                f.write(leaves)
+                data.seek(0)
+                while chunk := data.read(1024 * 1024):
+                    f.write(chunk)
+            os.replace(tmp, path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+    logger.info(f"{path}: {addressed} tiles, {len(contents)} unique")
+    return addressed, len(contents)
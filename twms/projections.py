@@ -1,10 +1,21 @@
 import collections.abc
+import functools
 import math
 from typing import NewType
 
 import twms.bbox
 import twms.config
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
 EPSG = NewType("EPSG", str)  # Like pyproj.CRS
 
 projs: dict[str, dict[str, str | twms.bbox.Bbox]] = {
@@ -174,6 +185,84 @@ pure_python_transformers = {
 }
 
 
+def _a4326t3857(t1, t2, lon: "np.ndarray", lat: "np.ndarray"):
+    """NumPy 4326 -> 3857 transform of coordinate arrays."""
+    maxbounds = 6378137 * math.pi
+    lat_rad = np.radians(lat)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / math.pi * maxbounds
+    # Limit lat, otherwise log(0) is infinite
+    y = np.where(np.abs(lat) <= 85.0511287798, y, np.copysign(maxbounds, lat))
+    return maxbounds / 180 * lon, y
+
+
+def _a3857t4326(t1, t2, lon: "np.ndarray", lat: "np.ndarray"):
+    """NumPy 3857 -> 4326 transform of coordinate arrays."""
+    x = lon / 111319.49079327358
+    y = np.degrees(np.arcsin(np.tanh(lat / 20037508.342789244 * math.pi)))
+    return x, y
+
+
+def _a4326t3395(t1, t2, lon: "np.ndarray", lat: "np.ndarray"):
+    """NumPy 4326 -> 3395 transform of coordinate arrays."""
+    E = 0.0818191908426
+    lat_rad = np.radians(lat)
+    tmp = np.tan(math.pi / 4 + lat_rad / 2.0)
+    pow_tmp = np.power(np.tan(math.pi / 4 + np.arcsin(E * np.sin(lat_rad)) / 2.0), E)
+    return lon * 111319.49079327358, 6378137.0 * np.log(tmp / pow_tmp)
+
+
+def _a3395t4326(t1, t2, lon: "np.ndarray", lat: "np.ndarray"):
+    """NumPy 3395 -> 4326 transform of coordinate arrays, iterates for all points at once."""
+    r_major = 6378137.000
+    temp = 6356752.3142 / 6378137.000
+    eccent = math.sqrt(1.0 - (temp * temp))
+    ts = np.exp(-lat / r_major)
+    HALFPI = math.pi / 2
+    eccnth = 0.5 * eccent
+    Phi = HALFPI - 2.0 * np.arctan(ts)
+    for _ in range(15):
+        con = eccent * np.sin(Phi)
+        dphi = (
+            HALFPI - 2.0 * np.arctan(ts * ((1.0 - con) / (1.0 + con)) ** eccnth) - Phi
+        )
+        Phi += dphi
+        if not np.any(np.abs(dphi) > 1e-7):
+            break
+    return lon / 111319.49079327358, np.degrees(Phi)
+
+
+numpy_transformers = {
+    (EPSG("EPSG:4326"), EPSG("EPSG:3857")): _a4326t3857,
+    (EPSG("EPSG:3857"), EPSG("EPSG:4326")): _a3857t4326,
+    (EPSG("EPSG:4326"), EPSG("EPSG:3395")): _a4326t3395,
+    (EPSG("EPSG:3395"), EPSG("EPSG:4326")): _a3395t4326,
+}
+
+
+@functools.lru_cache(maxsize=64)
+def pyproj_transformer(srs1: EPSG, srs2: EPSG) -> "pyproj.Transformer":
+    """Return shared pyproj transformer for projections without pure python one.
+
+    Transformer construction takes milliseconds, so it's done once per pair.
+    Axis order is always (lon, lat) / (x, y), like in pure python transformers.
+
+    Args:
+        srs1: source projection, from `projs` or any EPSG code known to PROJ
+        srs2: destination projection
+
+    Raises:
+        NotImplementedError if pyproj isn't installed
+    """
+    if pyproj is None:
+        raise NotImplementedError(f"{srs1} -> {srs2} transform requires pyproj")
+    return pyproj.Transformer.from_crs(
+        projs[srs1]["proj"] if srs1 in projs else srs1,
+        projs[srs2]["proj"] if srs2 in projs else srs2,
+        always_xy=True,
+    )
+
+
 def tile_by_bbox(bbox: twms.bbox.Bbox, zoom: int, srs: EPSG = EPSG("EPSG:3857")):
     """Convert bbox from EPSG:4326 format to tile numbers of given zoom level, with correct wraping around 180th meridian."""
     a1, a2 = tile_by_coords((bbox[0], bbox[1]), zoom, srs)
@@ -183,13 +272,18 @@ def tile_by_bbox(bbox: twms.bbox.Bbox, zoom: int, srs: EPSG = EPSG("EPSG:3857"))
     return a1, a2, b1, b2
 
 
+@functools.lru_cache(maxsize=4096)
 def bbox_by_tile(
     z: int, x: int, y: int, srs: EPSG = EPSG("EPSG:3857")
 ) -> twms.bbox.Bbox:
-    """Convert tile number to EPSG:4326 bbox of srs-projected tile."""
-    a1, a2 = coords_by_tile(z, x, y, srs)
-    b1, b2 = coords_by_tile(z, x + 1, y + 1, srs)
-    return a1, b2, b1, a2
+    """Convert tile number to EPSG:4326 bbox of srs-projected tile.
+
+    Memoized, as the same tiles are requested for every overlapping bbox.
+
+    >>> bbox_by_tile(10, 595, 327)
+    (29.179687500000004, 54.16243396805151, 29.531249999999996, 54.36775852405212)
+    """
+    return grid(srs).bbox_by_tile(z, x, y)
 
 
 def zoom_for_bbox(
@@ -200,38 +294,21 @@ def zoom_for_bbox(
     max_zoom: int = 18,
     max_size: tuple[int, int] = (10000, 10000),
 ) -> int:
-    """Calculate a best-fit zoom level."""
-    h, w = size
-    for i in range(min_zoom, max_zoom):
-        cx1, cy1, cx2, cy2 = tile_by_bbox(bbox, i, twms.config.layers[layer_id]["proj"])
-        if w != 0:
-            if (cx2 - cx1) * 256 >= w * 0.9:
-                return i
-        if h != 0:
-            if (cy1 - cy2) * 256 >= h * 0.9:
-                return i
-        if (cy1 - cy2) * 256 >= max_size[0] / 2:
-            return i
-        if (cx2 - cx1) * 256 >= max_size[1] / 2:
-            return i
-    return max_zoom
+    """Calculate a best-fit zoom level.
+
+    >>> zoom_for_bbox((27.4, 53.8, 27.7, 54.0), (1024, 768), "osmmapMapnik")
+    12
+    """
+    return grid(twms.config.layers[layer_id]["proj"]).zoom_for_bbox(
+        bbox, size, min_zoom, max_zoom, max_size
+    )
 
 
 def coords_by_tile(
     z: int, x: int, y: int, srs: EPSG = EPSG("EPSG:3857")
 ) -> twms.bbox.Point:
     """Convert (z,x,y) to coordinates of corner of srs-projected tile."""
-    normalized_tile = x / (2.0**z), 1.0 - (y / (2.0**z))
-    projected_bounds = from4326(projs[proj_alias.get(srs, srs)]["bounds"], srs)
-    maxp = [
-        projected_bounds[2] - projected_bounds[0],
-        projected_bounds[3] - projected_bounds[1],
-    ]
-    projected_coords = [
-        (normalized_tile[0] * maxp[0]) + projected_bounds[0],
-        (normalized_tile[1] * maxp[1]) + projected_bounds[1],
-    ]
-    return to4326(projected_coords, srs)
+    return grid(srs).coords_by_tile(z, x, y)
 
 
 def tile_by_coords(xxx_todo_changeme, zoom: int, srs: EPSG = EPSG("EPSG:3857")):
@@ -242,19 +319,143 @@ def tile_by_coords(xxx_todo_changeme, zoom: int, srs: EPSG = EPSG("EPSG:3857")):
         zoom: zoomlevel of tile number
         srs: text string, specifying projection of tile pyramid
     """
-    (lon, lat) = xxx_todo_changeme
-    # zoom -= 1
-    projected_bounds = from4326(projs[proj_alias.get(srs, srs)]["bounds"], srs)
-    point = from4326((lon, lat), srs)
-    point = [point[0] - projected_bounds[0], point[1] - projected_bounds[1]]
-    # shifting (0,0)
-    maxp = [
-        projected_bounds[2] - projected_bounds[0],
-        projected_bounds[3] - projected_bounds[1],
-    ]
-    point = [1.0 * point[0] / maxp[0], 1.0 * point[1] / maxp[1]]
-    # normalizing
-    return point[0] * (2**zoom), (1 - point[1]) * (2**zoom)
+    return grid(srs).tile_by_coords(xxx_todo_changeme, zoom)
+
+
+class Grid:
+    """Tile pyramid of srs-projected tiles, origin north-west.
+
+    Projected bounds and extent are computed once per projection, so tile
+    geometry needs a single point transform.
+    """
+
+    def __init__(self, srs: EPSG):
+        """Precompute constants.
+
+        Raises:
+            NotImplementedError if there is no transformer for srs
+        """
+        self.srs = proj_alias.get(srs, srs)
+        self.bounds: twms.bbox.Bbox = projs[self.srs]["bounds"]
+        self.projected_bounds: twms.bbox.Bbox = tuple(from4326(self.bounds, self.srs))
+        self.extent = (
+            self.projected_bounds[2] - self.projected_bounds[0],
+            self.projected_bounds[3] - self.projected_bounds[1],
+        )
+        self._from4326 = self._point_transformer(EPSG("EPSG:4326"), self.srs)
+        self._to4326 = self._point_transformer(self.srs, EPSG("EPSG:4326"))
+
+    def _point_transformer(self, srs1: EPSG, srs2: EPSG):
+        if srs1 == srs2:
+            return lambda lon, lat: (lon, lat)
+        if (srs1, srs2) not in pure_python_transformers:
+            return pyproj_transformer(srs1, srs2).transform
+        func = pure_python_transformers[(srs1, srs2)]
+        pr1, pr2 = projs[srs1]["proj"], projs[srs2]["proj"]
+        return lambda lon, lat: func(pr1, pr2, lon, lat)
+
+    def coords_by_tile(self, z: int, x: int, y: int) -> twms.bbox.Point:
+        """Convert (z,x,y) to EPSG:4326 coordinates of tile north-west corner.
+
+        >>> grid("EPSG:3857").coords_by_tile(10, 595, 327)
+        [29.179687500000004, 54.36775852405212]
+        """
+        normalized_tile = x / (2.0**z), 1.0 - (y / (2.0**z))
+        return list(
+            self._to4326(
+                (normalized_tile[0] * self.extent[0]) + self.projected_bounds[0],
+                (normalized_tile[1] * self.extent[1]) + self.projected_bounds[1],
+            )
+        )
+
+    def tile_by_coords(self, point: twms.bbox.Point, zoom: int) -> tuple[float, float]:
+        """Convert EPSG:4326 point to fractional tile number.
+
+        >>> grid("EPSG:3857").tile_by_coords((27.6, 53.2), 10)
+        (590.5066666666667, 332.62239739464667)
+        """
+        px, py = self._from4326(point[0], point[1])
+        return (
+            1.0 * (px - self.projected_bounds[0]) / self.extent[0] * (2**zoom),
+            (1 - 1.0 * (py - self.projected_bounds[1]) / self.extent[1]) * (2**zoom),
+        )
+
+    def bbox_by_tile(self, z: int, x: int, y: int) -> twms.bbox.Bbox:
+        """Convert tile number to EPSG:4326 bbox."""
+        a1, a2 = self.coords_by_tile(z, x, y)
+        b1, b2 = self.coords_by_tile(z, x + 1, y + 1)
+        return a1, b2, b1, a2
+
+    def zoom_for_bbox(
+        self,
+        bbox: twms.bbox.Bbox,
+        size: tuple[int, int],
+        min_zoom: int = 1,
+        max_zoom: int = 18,
+        max_size: tuple[int, int] = (10000, 10000),
+    ) -> int:
+        """Calculate a best-fit zoom level.
+
+        Lowest zoom in `[min_zoom, max_zoom)` where bbox spans 90% of requested
+        size or half of `max_size` in pixels, `max_zoom` if none.
+
+        Tile numbers scale exactly by `2**zoom`, so bbox corners are projected
+        once and the zoom is estimated by log2 of the span ratio, instead of
+        scanning zoom levels with four transforms each.
+
+        >>> grid("EPSG:3857").zoom_for_bbox((27.4, 53.8, 27.7, 54.0), (1024, 768))
+        12
+        """
+        h, w = size
+        a1, a2 = self.tile_by_coords((bbox[0], bbox[1]), 0)
+        b1, b2 = self.tile_by_coords((bbox[2], bbox[3]), 0)
+
+        def fits(zoom: int) -> bool:
+            # Same as `tile_by_bbox()` at this zoom
+            scale = 2**zoom
+            cx1, cy1, cx2, cy2 = a1 * scale, a2 * scale, b1 * scale, b2 * scale
+            if cx2 < cx1:
+                cx2 += 2 ** (zoom - 1)
+            if w != 0:
+                if (cx2 - cx1) * 256 >= w * 0.9:
+                    return True
+            if h != 0:
+                if (cy1 - cy2) * 256 >= h * 0.9:
+                    return True
+            if (cy1 - cy2) * 256 >= max_size[0] / 2:
+                return True
+            if (cx2 - cx1) * 256 >= max_size[1] / 2:
+                return True
+            return False
+
+        # Pixel spans at zoom 0 and spans they have to reach
+        span_x = (b1 - a1 if b1 >= a1 else b1 + 0.5 - a1) * 256
+        span_y = (a2 - b2) * 256
+        targets = [(span_y, max_size[0] / 2), (span_x, max_size[1] / 2)]
+        if w != 0:
+            targets.append((span_x, w * 0.9))
+        if h != 0:
+            targets.append((span_y, h * 0.9))
+        zoom = max_zoom
+        for span, target in targets:
+            if target <= 0 <= span:
+                zoom = min_zoom
+            elif span > 0:
+                zoom = min(zoom, math.ceil(math.log2(target / span)))
+        zoom = min(max(zoom, min_zoom), max_zoom)
+
+        # Float rounding of log2 may be off by one near powers of two
+        while zoom > min_zoom and fits(zoom - 1):
+            zoom -= 1
+        while zoom < max_zoom and not fits(zoom):
+            zoom += 1
+        return zoom
+
+
+@functools.lru_cache(maxsize=None)
+def grid(srs: EPSG) -> Grid:
+    """Return shared tile grid of a projection."""
+    return Grid(srs)
 
 
 def to4326(line, srs: EPSG = EPSG("EPSG:3857")):
@@ -291,42 +492,56 @@ def from4326(line, srs: EPSG = EPSG("EPSG:3857")):
 
 
 def transform(
-    line: collections.abc.Sequence, srs1: EPSG, srs2: EPSG
-) -> collections.abc.Sequence:
+    line: "collections.abc.Sequence | np.ndarray", srs1: EPSG, srs2: EPSG
+) -> "collections.abc.Sequence | np.ndarray":
     """Convert bunch of coordinates from srs1 to srs2.
 
     Args:
-        line: [lat0,lon0,lat1,lon1,...] or [(lat0,lon0),(lat1,lon1),...]
+        line: [lat0,lon0,lat1,lon1,...] or [(lat0,lon0),(lat1,lon1),...],
+            or NumPy array of same layout (flat or N×2)
         srs1: source projection
         srs2: destination projection
+
+    Returns:
+        Same layout as `line`, NumPy array for array input.
+
+    >>> transform([27.6, 53.2, 27.6, 53.2], "EPSG:4326", "EPSG:3857")
+    [3072417.9458943508, 7020078.532642099, 3072417.9458943508, 7020078.532642099]
     """
     srs1 = proj_alias.get(srs1, srs1)
     srs2 = proj_alias.get(srs2, srs2)
     if srs1 == srs2:
         return line
-    if (srs1, srs2) in pure_python_transformers:
-        func = pure_python_transformers[(srs1, srs2)]
-    else:
-        # func = pyproj.transform
-        raise NotImplementedError
+    if np is not None and isinstance(line, np.ndarray):
+        return _transform_array(line, srs1, srs2)
     line = list(line)
     serial = False
     if not isinstance(line[0], collections.abc.Sequence):
         serial = True
-        l1 = list()
-        while line:
-            a = line.pop(0)
-            b = line.pop(0)
-            l1.append([a, b])
-        line = l1
-    ans: list[twms.bbox.Point | float] = list()
-    pr1 = projs[srs1]["proj"]
-    pr2 = projs[srs2]["proj"]
-    for point in line:
-        p = func(pr1, pr2, point[0], point[1])
-        if serial:
-            ans.append(p[0])
-            ans.append(p[1])
-        else:
-            ans.append(p)
-    return ans
+        line = list(zip(line[0::2], line[1::2]))
+    if (srs1, srs2) in pure_python_transformers:
+        func = pure_python_transformers[(srs1, srs2)]
+        pr1 = projs[srs1]["proj"]
+        pr2 = projs[srs2]["proj"]
+        points = [func(pr1, pr2, point[0], point[1]) for point in line]
+    else:
+        # All points in a single call
+        xx, yy = pyproj_transformer(srs1, srs2).transform(
+            [point[0] for point in line], [point[1] for point in line]
+        )
+        points = list(zip(xx, yy))
+    if serial:
+        return [c for point in points for c in point]
+    return points
+
+
+def _transform_array(line: "np.ndarray", srs1: EPSG, srs2: EPSG) -> "np.ndarray":
+    """Convert flat or N×2 coordinate array without per-point Python calls."""
+    points = np.asarray(line, dtype=np.float64).reshape(-1, 2)
+    if (srs1, srs2) in numpy_transformers:
+        x, y = numpy_transformers[(srs1, srs2)](
+            projs[srs1]["proj"], projs[srs2]["proj"], points[:, 0], points[:, 1]
+        )
+    else:
+        x, y = pyproj_transformer(srs1, srs2).transform(points[:, 0], points[:, 1])
+    return np.stack((x, y), axis=-1).reshape(line.shape)
@@ -0,0 +1,93 @@
+"""Request-scoped state shared by HTTP handler, renderer and fetchers.
+
+Rendering goes `wms_handler -> bbox_image -> tile_image -> TileFetcher.fetch`
+within a single handler thread, while `tile_image` is memoized by arguments.
+So request context is bound to the handler thread instead of being passed
+down the call chain.
+"""
+
+import contextlib
+import threading
+import time
+import typing
+
+
+class RequestCancelled(Exception):
+    """Client has gone or request deadline exceeded, nobody waits for result."""
+
+
+class RequestContext:
+    """Client identity and cancellation state of a single request."""
+
+    def __init__(
+        self,
+        client: str = "",
+        timeout: float | None = None,
+        is_disconnected: typing.Callable[[], bool] | None = None,
+    ):
+        """Create request context.
+
+        Args:
+            client: client identifier, e.g. IP address
+            timeout: seconds to serve request or None for no deadline
+            is_disconnected: callback to check if client closed connection
+        """
+        self.client = client
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.is_disconnected = is_disconnected
+        self.reason = ""
+
+    def is_cancelled(self) -> bool:
+        """Check whether somebody still needs the result.
+
+        >>> RequestContext(timeout=None).is_cancelled()
+        False
+        >>> RequestContext(timeout=-1).is_cancelled()
+        True
+        """
+        if not self.reason:
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                self.reason = "deadline exceeded"
+            elif self.is_disconnected and self.is_disconnected():
+                self.reason = "client disconnected"
+        return bool(self.reason)
+
+    def check(self) -> None:
+        """Raise `RequestCancelled` if request was cancelled.
+
+        >>> RequestContext(client="127.0.0.1", timeout=-1).check()
+        Traceback (most recent call last):
+        ...
+        twms.request.RequestCancelled: 127.0.0.1 deadline exceeded
+        """
+        if self.is_cancelled():
+            raise RequestCancelled(f"{self.client} {self.reason}")
+
+
+_local = threading.local()
+
+
+def current() -> RequestContext | None:
+    """Return context of a request served by current thread.
+
+    >>> current() is None
+    True
+    """
+    return getattr(_local, "context", None)
+
+
+@contextlib.contextmanager
+def scope(context: RequestContext) -> typing.Iterator[RequestContext]:
+    """Bind request context to current thread."""
+    previous = current()
+    _local.context = context
+    try:
+        yield context
+    finally:
+        _local.context = previous
+
+
+def check() -> None:
+    """Raise `RequestCancelled` if current request was cancelled."""
+    if context := current():
+        context.check()
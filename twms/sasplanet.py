@@ -0,0 +1,235 @@
+"""SAS.Planet SQLite cache storage.
+
+SAS.Planet "SQLite" cache type keeps tiles in many small databases instead
+of millions of files:
+
+    {layer}/z{z + 1}/{x >> 10}/{y >> 10}/{x >> 8}.{y >> 8}.sqlitedb
+
+with a single table `t`:
+
+    x, y  tile coordinates
+    v     tile version, 0 for unversioned maps
+    c     content type
+    s     tile size, 0 for TNE (tile not exists) marker
+    h     tile checksum
+    d     unix timestamp of download
+    b     tile image
+
+Databases are opened once and kept in a pool, as opening SQLite file costs
+far more than a primary key lookup. `sqlite3` caches prepared statements per
+connection, so repeated queries aren't parsed again.
+"""
+
+import collections
+import contextlib
+import logging
+import pathlib
+import sqlite3
+import threading
+import time
+import typing
+import zlib
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS t (
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    v INTEGER DEFAULT 0 NOT NULL,
+    c TEXT,
+    s INTEGER DEFAULT 0 NOT NULL,
+    h INTEGER DEFAULT 0 NOT NULL,
+    d INTEGER NOT NULL,
+    b BLOB,
+    CONSTRAINT PK_TB PRIMARY KEY (x, y, v)
+)
+"""
+
+
+def db_path(layer_dir: str | pathlib.Path, z: int, x: int, y: int) -> pathlib.Path:
+    """Locate database file with a tile.
+
+    >>> db_path("cache/sat", 12, 2400, 1300).as_posix()
+    'cache/sat/z13/2/1/9.5.sqlitedb'
+    """
+    return (
+        pathlib.Path(layer_dir)
+        / f"z{z + 1}/{x >> 10}/{y >> 10}/{x >> 8}.{y >> 8}.sqlitedb"
+    )
+
+
+class ConnectionPool:
+    """Idle SQLite connections per database file, least recently used closed."""
+
+    def __init__(self, max_files: int = 64):
+        self.max_files = max_files
+        self._idle: collections.OrderedDict[tuple, list[sqlite3.Connection]] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def _open(self, path: pathlib.Path, write: bool) -> sqlite3.Connection:
+        if write:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            con = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            con.execute(SCHEMA)
+            con.commit()
+        else:
+            # Don't create missing files, SAS.Planet may write meanwhile
+            con = sqlite3.connect(
+                f"{path.resolve().as_uri()}?mode=ro",
+                uri=True,
+                timeout=10,
+                check_same_thread=False,
+            )
+        return con
+
+    @contextlib.contextmanager
+    def connection(
+        self, path: pathlib.Path, write: bool = False
+    ) -> typing.Iterator[sqlite3.Connection]:
+        """Borrow connection to a database.
+
+        Raises:
+            sqlite3.OperationalError if read-only database doesn't exist
+        """
+        key = (path, write)
+        with self._lock:
+            idle = self._idle.get(key)
+            con = idle.pop() if idle else None
+        if con is None:
+            con = self._open(path, write)
+        try:
+            yield con
+        except BaseException:
+            con.close()
+            raise
+        with self._lock:
+            self._idle.setdefault(key, list()).append(con)
+            self._idle.move_to_end(key)
+            while len(self._idle) > self.max_files:
+                _, connections = self._idle.popitem(last=False)
+                for old in connections:
+                    old.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for connections in self._idle.values():
+                for con in connections:
+                    con.close()
+            self._idle.clear()
+
+
+pool = ConnectionPool()
+
+
+class SqliteTile:
+    """Tile in SAS.Planet SQLite cache, same interface as `fetchers.TileFile`."""
+
+    def __init__(
+        self,
+        cache_dir: str,
+        layer_id: str,
+        mimetype: str,
+        z: int,
+        x: int,
+        y: int,
+        ttl: int | None = None,
+    ):
+        """Tile storage "cache_dir/layer_id/z{z+1}/.../{x>>8}.{y>>8}.sqlitedb".
+
+        Args:
+            cache_dir: relative path to tile cache
+            layer_id: subdir for a single cache
+            mimetype: One mimetype for whole layer
+            z: tile coordinate (starts with zero)
+            x: tile coordinate
+            y: tile coordinate (positive)
+            ttl: time-to-live, seconds or None
+        """
+        self.mimetype = mimetype
+        self.ttl = ttl
+        self.z, self.x, self.y = int(z), int(x), int(y)
+        self.path = db_path(pathlib.Path(cache_dir) / layer_id, self.z, self.x, self.y)
+
+    def __str__(self):
+        return f"'{self.mimetype}' TTL: {self.ttl}, '{self.path}' x={self.x} y={self.y}"
+
+    def _row(self) -> tuple[int, int, bytes | None] | None:
+        """Return (size, timestamp, blob) of the latest tile version."""
+        try:
+            with pool.connection(self.path) as con:
+                return con.execute(
+                    "SELECT s, d, b FROM t WHERE x = ? AND y = ? ORDER BY v DESC LIMIT 1",
+                    (self.x, self.y),
+                ).fetchone()
+        except sqlite3.OperationalError:
+            return None  # No database yet
+
+    def read(self) -> bytes:
+        """Read tile image data.
+
+        Raises:
+            FileNotFoundError if tile doesn't exist
+        """
+        row = self._row()
+        if not row or not row[0] or row[2] is None:
+            raise FileNotFoundError(f"{self} not found")
+        logger.debug(f"Cache hit {self}")
+        return row[2]
+
+    def exists(self) -> bool:
+        row = self._row()
+        return bool(row and row[0])
+
+    def needs_fetch(self) -> bool:
+        """Not exists in cache or TTL has been reached.
+
+        >>> import tempfile
+        >>> tile = SqliteTile(tempfile.mkdtemp(), "sat", "image/png", 3, 2, 1)
+        >>> tile.needs_fetch()
+        True
+        >>> tile.set(b"PNG")
+        >>> tile.needs_fetch(), tile.read()
+        (False, b'PNG')
+        >>> tile.set()
+        >>> tile.needs_fetch(), tile.exists()
+        (False, False)
+        """
+        row = self._row()
+        if row is None:
+            return True
+        if self.ttl and self.ttl < (time.time() - row[1]):
+            logger.info(f"TTL reached: {self}")
+            return True
+        if not row[0]:
+            logger.info(f"TNE {self}")
+        return False
+
+    def set(self, blob: bytes | memoryview | None = None) -> None:
+        """Save tile, or TNE marker if blob is None."""
+        if not blob:
+            logger.warning(f"TILE NOT EXISTS {self}")
+        blob = bytes(blob) if blob else None
+        with pool.connection(self.path, write=True) as con:
+            with con:
+                con.execute(
+                    "INSERT OR REPLACE INTO t (x, y, v, c, s, h, d, b) VALUES (?, ?, 0, ?, ?, ?, ?, ?)",
+                    (
+                        self.x,
+                        self.y,
+                        self.mimetype,
+                        len(blob) if blob else 0,
+                        zlib.crc32(blob) if blob else 0,
+                        int(time.time()),
+                        blob,
+                    ),
+                )
+
+    def delete(self) -> None:
+        logger.info(f"Deleting {self}")
+        with contextlib.suppress(sqlite3.OperationalError):
+            with pool.connection(self.path, write=True) as con:
+                with con:
+                    con.execute("DELETE FROM t WHERE x = ? AND y = ?", (self.x, self.y))
@@ -0,0 +1,163 @@
+"""Incremental image encoding for streamed WMS responses.
+
+Large GetMap image is rendered in horizontal strips, each strip is encoded
+and sent to the client as soon as it is ready. So memory per request is
+bounded by strip size, not by image size, and the first bytes leave the
+server before the last tiles are fetched.
+
+Pillow encodes whole images only, so PNG is written here: rows are
+filtered with "Up" filter and fed to a single zlib stream, which is split
+into IDAT chunks. Other formats fall back to encoding of the whole image.
+
+Response status is sent before the first strip, so failure or cancellation
+after it can't be reported and the client gets a truncated image. Hence
+only images taller than `wms_strip_height` are streamed.
+"""
+
+import logging
+import struct
+import typing
+import zlib
+
+from PIL import Image, ImageChops
+
+import twms.config
+import twms.fetchers
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_TYPES = {"RGB": 2, "RGBA": 6}
+PNG_FILTER_UP = 2
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    """PNG chunk with length and CRC.
+
+    >>> png_chunk(b"IEND", b"")
+    b'\\x00\\x00\\x00\\x00IEND\\xaeB`\\x82'
+    """
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)))
+    )
+
+
+class PngWriter:
+    """PNG encoder fed with horizontal strips, top to bottom.
+
+    >>> import io
+    >>> im = Image.linear_gradient("L").convert("RGBA").resize((300, 200))
+    >>> writer = PngWriter(im.size)
+    >>> data = writer.header() + b"".join(
+    ...     writer.write(im.crop((0, top, 300, min(top + 64, 200))))
+    ...     for top in range(0, 200, 64)
+    ... ) + writer.finish()
+    >>> decoded = Image.open(io.BytesIO(data))
+    >>> decoded.mode, decoded.size, decoded.tobytes() == im.tobytes()
+    ('RGBA', (300, 200), True)
+    """
+
+    def __init__(
+        self,
+        size: tuple[int, int],
+        mode: str = "RGBA",
+        level: int = 6,
+        software: str | None = None,
+    ):
+        """Start image.
+
+        Args:
+            size: whole image (width, height)
+            mode: Pillow image mode, "RGB" or "RGBA"
+            level: zlib compression level
+            software: "Software" text chunk value
+        """
+        self.size = size
+        self.mode = mode
+        self.software = software
+        self._compressor = zlib.compressobj(level)
+        self._previous: Image.Image | None = None  # Last row of previous strip
+        self._rows = 0
+
+    def header(self) -> bytes:
+        """Signature, image header and metadata."""
+        data = PNG_SIGNATURE + png_chunk(
+            b"IHDR",
+            struct.pack(">IIBBBBB", *self.size, 8, PNG_COLOR_TYPES[self.mode], 0, 0, 0),
+        )
+        if self.software:
+            data += png_chunk(b"tEXt", b"Software\0" + self.software.encode("latin-1"))
+        return data
+
+    def write(self, strip: Image.Image) -> bytes:
+        """Encode next rows.
+
+        Returns:
+            IDAT chunk or nothing if zlib buffered all the data.
+        """
+        if strip.mode != self.mode:
+            strip = strip.convert(self.mode)
+        width, height = strip.size
+        if width != self.size[0] or self._rows + height > self.size[1]:
+            raise ValueError(f"Strip {strip.size} doesn't fit PNG {self.size}")
+        self._rows += height
+
+        # Up filter is a difference with the row above, computed in C
+        above = Image.new(self.mode, strip.size)
+        if self._previous:
+            above.paste(self._previous)
+        above.paste(strip.crop((0, 0, width, height - 1)), (0, 1))
+        self._previous = strip.crop((0, height - 1, width, height))
+        filtered = ImageChops.subtract_modulo(strip, above).tobytes()
+
+        # Prepend filter type byte to each row as a leftmost column
+        stride = len(filtered) // height
+        rows = Image.new("L", (stride + 1, height), PNG_FILTER_UP)
+        rows.paste(Image.frombytes("L", (stride, height), filtered), (1, 0))
+        data = self._compressor.compress(rows.tobytes())
+        return png_chunk(b"IDAT", data) if data else b""
+
+    def finish(self) -> bytes:
+        """Flush compressor and end image."""
+        if self._rows != self.size[1]:
+            raise ValueError(f"PNG {self.size} got {self._rows} rows only")
+        return png_chunk(b"IDAT", self._compressor.flush()) + png_chunk(b"IEND", b"")
+
+
+def encode(
+    strips: typing.Iterable[Image.Image], size: tuple[int, int], mimetype: str
+) -> typing.Iterator[bytes]:
+    """Encode image strips as they are rendered.
+
+    >>> strips = (Image.new("RGBA", (256, 100), "red") for _ in range(3))
+    >>> data = b"".join(encode(strips, (256, 300), "image/png"))
+    >>> data[:8] == PNG_SIGNATURE, data[-8:-4]
+    (True, b'IEND')
+
+    Args:
+        strips: full width images, top to bottom
+        size: whole image (width, height)
+        mimetype: output format
+
+    Yields:
+        Encoded image parts.
+    """
+    if mimetype != "image/png":
+        # No incremental encoder, so whole image is kept in memory
+        im = Image.new("RGBA", size)
+        top = 0
+        for strip in strips:
+            im.paste(strip, (0, top))
+            top += strip.height
+        yield twms.fetchers.im_convert(im, mimetype)
+        return
+
+    writer = PngWriter(size, software=twms.config.wms_name)
+    yield writer.header()
+    for strip in strips:
+        if data := writer.write(strip):
+            yield data
+    yield writer.finish()
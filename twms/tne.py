@@ -0,0 +1,474 @@
+"""Compact tile-not-exists (TNE) index.
+
+SAS.Planet marks missing tiles with empty `{z}/{x}/{y}.tne` files. Sparse
+layers produce millions of them, which are slow to stat, scan, backup and
+delete. `TneIndex` keeps the markers in RAM instead: per zoom level a sorted
+array of tile numbers with marker timestamps (12 bytes per marker), persisted
+into a single file inside layer cache directory. SAS.Planet `*.tne` files
+can be imported and exported on request.
+
+Changes go to a small dict first and are merged into the arrays by a
+background thread, so marking a tile on request path never waits for
+rebuilding of a large array.
+"""
+
+import array
+import bisect
+import logging
+import os
+import pathlib
+import struct
+import sys
+import threading
+import time
+
+import twms.config
+import twms.writer
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "tne.twms"
+MAGIC = b"TWMSTNE1"
+REMOVED = 0  # Timestamp of a removed marker in pending changes
+PRESENT = 0  # Learned time of a tile known to exist in `CoverageTree`
+
+
+def tile_key(z: int, x: int, y: int) -> int:
+    """Pack tile number into integer, sorted by x, then y.
+
+    >>> tile_key(2, 1, 3)
+    7
+    >>> tile_key(22, 2**22 - 1, 2**22 - 1) < 2**64
+    True
+    """
+    return (x << z) | y
+
+
+def merge_sorted(
+    keys: array.array, stamps: array.array | None, changes: dict[int, int]
+) -> tuple[array.array, array.array]:
+    """Apply changes to sorted keys, copying unchanged runs as slices.
+
+    >>> keys, stamps = merge_sorted(
+    ...     array.array("Q", [1, 3, 5]), array.array("I", [10, 30, 50]), {3: REMOVED, 4: 40}
+    ... )
+    >>> list(keys), list(stamps)
+    ([1, 4, 5], [10, 40, 50])
+
+    Args:
+        keys: sorted tile keys
+        stamps: timestamps of keys
+        changes: {key: timestamp or REMOVED}
+
+    Returns:
+        New keys and stamps arrays.
+    """
+    stamps = stamps if stamps is not None else array.array("I")
+    new_keys = array.array("Q")
+    new_stamps = array.array("I")
+    i = 0
+    for key in sorted(changes):
+        j = bisect.bisect_left(keys, key, i)
+        new_keys.extend(keys[i:j])
+        new_stamps.extend(stamps[i:j])
+        i = j + (j < len(keys) and keys[j] == key)
+        if changes[key] != REMOVED:
+            new_keys.append(key)
+            new_stamps.append(changes[key])
+    new_keys.extend(keys[i:])
+    new_stamps.extend(stamps[i:])
+    return new_keys, new_stamps
+
+
+class TneIndex:
+    """TNE markers of a single layer with timestamps for TTL."""
+
+    magic = MAGIC
+    name = INDEX_NAME  # File name in layer cache directory
+
+    def __init__(self, path: str | pathlib.Path | None = None, merge_every: int = 4096):
+        """Create empty index.
+
+        Args:
+            path: index file path or None for RAM-only index
+            merge_every: merge pending changes into sorted arrays after that count
+        """
+        self.path = pathlib.Path(path) if path else None
+        self.merge_every = merge_every
+        self.dirty = False
+        # Sorted tile keys with timestamps
+        self._keys: dict[int, array.array] = dict()
+        self._stamps: dict[int, array.array] = dict()
+        # Recent changes, merged into arrays in batches
+        self._pending: dict[int, dict[int, int]] = dict()
+        self._pending_count = 0
+        # Changes being merged, still visible to readers
+        self._merging: dict[int, dict[int, int]] = dict()
+        self._merger: threading.Thread | None = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()  # Single merger of arrays
+        self._save_lock = threading.Lock()  # Single writer of index file
+
+    def __len__(self) -> int:
+        self.merge()
+        with self._lock:
+            return self._size
+
+    def get(self, z: int, x: int, y: int) -> int | None:
+        """Return TNE marker timestamp or None if tile is not marked.
+
+        >>> index = TneIndex()
+        >>> index.add(10, 5, 7, timestamp=1700000000)
+        >>> index.get(10, 5, 7), index.get(10, 7, 5)
+        (1700000000, None)
+        """
+        key = tile_key(z, x, y)
+        with self._lock:
+            for changes in (self._pending, self._merging):
+                if (pending := changes.get(z)) and key in pending:
+                    return pending[key] or None
+            keys = self._keys.get(z)
+            if keys:
+                i = bisect.bisect_left(keys, key)
+                if i < len(keys) and keys[i] == key:
+                    return self._stamps[z][i]
+        return None
+
+    def add(self, z: int, x: int, y: int, timestamp: float | None = None) -> None:
+        """Mark tile as not existing."""
+        self._set(z, tile_key(z, x, y), int(timestamp or time.time()) or 1)
+
+    def remove(self, z: int, x: int, y: int) -> None:
+        """Unmark tile.
+
+        >>> index = TneIndex()
+        >>> index.add(3, 1, 1)
+        >>> index.remove(3, 1, 1)
+        >>> index.get(3, 1, 1), len(index)
+        (None, 0)
+        """
+        if self.get(z, x, y) is not None:
+            self._set(z, tile_key(z, x, y), REMOVED)
+
+    def _set(self, z: int, key: int, timestamp: int) -> None:
+        with self._lock:
+            self._pending.setdefault(z, dict())[key] = timestamp
+            self._pending_count += 1
+            self.dirty = True
+            # Amortize rebuilding of large arrays, off the request path
+            if self._pending_count >= max(self.merge_every, self._size // 8) and (
+                self._merger is None or not self._merger.is_alive()
+            ):
+                self._merger = threading.Thread(
+                    target=self.merge, name="tne_merge", daemon=True
+                )
+                self._merger.start()
+
+    def merge(self) -> None:
+        """Merge pending changes into sorted arrays.
+
+        Arrays are rebuilt without holding the index lock, readers see the
+        changes being merged meanwhile.
+        """
+        with self._merge_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._merging, self._pending = self._pending, dict()
+                self._pending_count = 0
+                arrays = {
+                    z: (self._keys.get(z, array.array("Q")), self._stamps.get(z))
+                    for z in self._merging
+                }
+            merged = {
+                z: merge_sorted(*arrays[z], changes)
+                for z, changes in self._merging.items()
+            }
+            with self._lock:
+                for z, (keys, stamps) in merged.items():
+                    self._keys[z] = keys
+                    self._stamps[z] = stamps
+                self._merging = dict()
+                self._size = sum(len(keys) for keys in self._keys.values())
+
+    def items(self):
+        """Iterate over (z, x, y, timestamp) of all markers.
+
+        >>> index = TneIndex()
+        >>> index.add(4, 3, 2, timestamp=1)
+        >>> list(index.items())
+        [(4, 3, 2, 1)]
+        """
+        self.merge()
+        with self._lock:
+            snapshot = [(z, self._keys[z], self._stamps[z]) for z in sorted(self._keys)]
+        for z, keys, stamps in snapshot:
+            mask = (1 << z) - 1
+            for key, stamp in zip(keys, stamps):
+                yield z, key >> z, key & mask, stamp
+
+    def load(self) -> None:
+        """Load index file if exists.
+
+        Raises:
+            ValueError: file is not an index or is truncated
+        """
+        if not self.path or not self.path.exists():
+            return
+        data = self.path.read_bytes()
+        if data[: len(self.magic)] != self.magic:
+            raise ValueError(f"'{self.path}' is not a {type(self).__name__} file")
+        offset = len(self.magic)
+        loaded = dict()
+        header = struct.calcsize("<BI")
+        while offset < len(data):
+            if offset + header > len(data):
+                raise ValueError(f"'{self.path}' is truncated")
+            z, count = struct.unpack_from("<BI", data, offset)
+            offset += header
+            keys = array.array("Q")
+            stamps = array.array("I")
+            end = offset + count * (keys.itemsize + stamps.itemsize)
+            if end > len(data):
+                raise ValueError(f"'{self.path}' is truncated")
+            middle = offset + count * keys.itemsize
+            keys.frombytes(data[offset:middle])
+            stamps.frombytes(data[middle:end])
+            offset = end
+            if sys.byteorder == "big":
+                keys.byteswap()
+                stamps.byteswap()
+            loaded[z] = keys, stamps
+        with self._merge_lock, self._lock:
+            for z, (keys, stamps) in loaded.items():
+                self._keys[z] = keys
+                self._stamps[z] = stamps
+            self._pending.clear()
+            self._pending_count = 0
+            self._size = sum(len(keys) for keys in self._keys.values())
+            self.dirty = False
+        logger.info(f"Loaded {len(self)} TNE markers from '{self.path}'")
+
+    def save(self) -> None:
+        """Write index file atomically.
+
+        Concurrent saves (periodic saver and shutdown) are serialized, so the
+        latest snapshot always wins. Index stays dirty if write fails.
+        """
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                # Changes made while writing set it again
+                self.dirty = False
+            self.merge()
+            with self._lock:
+                chunks = [self.magic]
+                for z in sorted(self._keys):
+                    keys = array.array("Q", self._keys[z])
+                    stamps = array.array("I", self._stamps[z])
+                    if sys.byteorder == "big":
+                        keys.byteswap()
+                        stamps.byteswap()
+                    chunks.append(struct.pack("<BI", z, len(keys)))
+                    chunks.append(keys.tobytes())
+                    chunks.append(stamps.tobytes())
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                twms.writer.write_atomic(self.path, b"".join(chunks))
+            except BaseException:
+                self.dirty = True
+                raise
+        logger.debug(f"Saved TNE index '{self.path}'")
+
+    def import_tne(self, layer_dir: str | pathlib.Path, remove: bool = False) -> int:
+        """Import SAS.Planet `{z}/{x}/{y}.tne` files.
+
+        Args:
+            layer_dir: layer cache directory
+            remove: delete imported files
+
+        Returns:
+            Number of imported markers.
+        """
+        count = 0
+        for z_entry in _scandir_numeric(layer_dir):
+            for x_entry in _scandir_numeric(z_entry.path):
+                with os.scandir(x_entry.path) as it:
+                    for entry in it:
+                        y, ext = os.path.splitext(entry.name)
+                        if ext != ".tne" or not y.isdigit():
+                            continue
+                        self.add(
+                            int(z_entry.name),
+                            int(x_entry.name),
+                            int(y),
+                            timestamp=entry.stat().st_mtime,
+                        )
+                        if remove:
+                            os.unlink(entry.path)
+                        count += 1
+        return count
+
+    def export_tne(self, layer_dir: str | pathlib.Path) -> int:
+        """Write markers as SAS.Planet `{z}/{x}/{y}.tne` files keeping timestamps.
+
+        Returns:
+            Number of exported markers.
+        """
+        count = 0
+        for z, x, y, stamp in self.items():
+            path = pathlib.Path(layer_dir) / f"{z}/{x}/{y}.tne"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+            os.utime(path, (stamp, stamp))
+            count += 1
+        return count
+
+
+def _scandir_numeric(path: str | pathlib.Path) -> list[os.DirEntry]:
+    """List `{z}` or `{x}` subdirectories."""
+    try:
+        with os.scandir(path) as it:
+            return [e for e in it if e.name.isdigit() and e.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+_indexes: dict[tuple[str, type], TneIndex] = dict()
+_indexes_lock = threading.Lock()
+
+
+def get_index(prefix: str, index_type: type[TneIndex] = TneIndex) -> TneIndex:
+    """Return TNE index of a layer cache, loading it on first use.
+
+    Args:
+        prefix: layer cache directory
+        index_type: `TneIndex` or its subclass, stored in `index_type.name`
+    """
+    with _indexes_lock:
+        if (prefix, index_type) not in _indexes:
+            index = index_type(
+                pathlib.Path(twms.config.tiles_cache) / prefix / index_type.name
+            )
+            try:
+                index.load()
+            except ValueError:
+                logger.exception(
+                    f"{prefix}: {index_type.name} is broken, starting anew"
+                )
+            _indexes[prefix, index_type] = index
+        return _indexes[prefix, index_type]
+
+
+def save_all() -> None:
+    """Persist all modified indexes."""
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        if index.dirty:
+            index.save()
+
+
+def start_saver(interval: float) -> threading.Thread:
+    """Persist modified indexes periodically in background."""
+
+    def saver():
+        while True:
+            time.sleep(interval)
+            try:
+                save_all()
+            except OSError:
+                logger.exception("Failed to save TNE index")
+
+    thread = threading.Thread(target=saver, name="tne_saver", daemon=True)
+    thread.start()
+    return thread
+
+
+class CoverageTree:
+    """Empty subtrees of a sparse layer learned from TNE results.
+
+    Children of a TNE tile are almost always empty too, so requests below a
+    known empty tile are refused without asking upstream. Once in `reprobe`
+    seconds a single child request is let through to check whether coverage
+    has appeared.
+
+    Markers of a `TneIndex` are looked up in place, not copied, so only
+    tiles learned or probed while running take RAM of the tree.
+    """
+
+    def __init__(self, reprobe: float, min_zoom: int = 0):
+        """Create empty model.
+
+        Args:
+            reprobe: seconds to trust learned empty tile
+            min_zoom: topmost zoom level to look for empty ancestors
+        """
+        self.reprobe = reprobe
+        self.min_zoom = min_zoom
+        self.index: TneIndex | None = None
+        # {z: {tile key: time learned empty or PRESENT}}, overrides index
+        self._empty: dict[int, dict[int, float]] = dict()
+        self._lock = threading.Lock()
+
+    def seed(self, index: TneIndex) -> None:
+        """Learn empty tiles from TNE markers which are still fresh."""
+        self.index = index
+
+    def _learned(self, z: int, x: int, y: int) -> tuple[float | None, bool]:
+        """Time tile was learned empty and whether from index. Call with lock held."""
+        if (empty := self._empty.get(z)) and (
+            learned := empty.get(tile_key(z, x, y))
+        ) is not None:
+            return learned or None, False
+        if self.index is not None:
+            return self.index.get(z, x, y), True
+        return None, False
+
+    def mark_empty(self, z: int, x: int, y: int, timestamp: float | None = None):
+        with self._lock:
+            self._empty.setdefault(z, dict())[tile_key(z, x, y)] = (
+                timestamp or time.time()
+            )
+
+    def mark_present(self, z: int, x: int, y: int) -> None:
+        """Forget empty ancestors of existing tile."""
+        with self._lock:
+            for pz in range(z, self.min_zoom - 1, -1):
+                px, py = x >> (z - pz), y >> (z - pz)
+                if self._learned(pz, px, py)[0] is not None:
+                    self._empty.setdefault(pz, dict())[tile_key(pz, px, py)] = PRESENT
+
+    def empty_ancestor(self, z: int, x: int, y: int) -> tuple[int, int, int] | None:
+        """Find known empty ancestor of a tile.
+
+        >>> tree = CoverageTree(reprobe=3600)
+        >>> tree.mark_empty(8, 10, 20)
+        >>> tree.empty_ancestor(10, 42, 81)
+        (8, 10, 20)
+        >>> tree.empty_ancestor(10, 44, 81) is None
+        True
+        >>> tree.mark_present(11, 84, 162)
+        >>> tree.empty_ancestor(10, 42, 81) is None
+        True
+
+        Returns:
+            Ancestor (z, x, y) or None if tile should be fetched.
+        """
+        now = time.time()
+        with self._lock:
+            for pz in range(z - 1, self.min_zoom - 1, -1):
+                px, py = x >> (z - pz), y >> (z - pz)
+                learned, indexed = self._learned(pz, px, py)
+                if learned is None:
+                    continue
+                if now - learned < self.reprobe:
+                    return pz, px, py
+                if indexed:
+                    continue  # Stale marker of previous runs teaches nothing
+                # Let this request probe upstream, keep refusing others
+                self._empty[pz][tile_key(pz, px, py)] = now
+                return None
+        return None
@@ -1,7 +1,9 @@
+import contextlib
 import functools
 import logging
+import math
 import mimetypes
-import os
+import typing
 from http import HTTPStatus
 
 from PIL import Image, ImageColor, ImageOps
@@ -9,8 +11,12 @@ from PIL import Image, ImageColor, ImageOps
 import twms.api
 import twms.bbox
 import twms.config
+import twms.coverage
 import twms.fetchers
+import twms.janitor
 import twms.projections
+import twms.request
+import twms.stream
 
 # from PIL import ImageFile
 # ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -18,6 +24,145 @@ import twms.projections
 logger = logging.getLogger(__name__)
 
 
+class RenderPlan(typing.NamedTuple):
+    """Pixel-independent geometry of a WMS bbox render."""
+
+    zoom: int
+    tiles: tuple[int, int, int, int]  # from x, to y, to x, from y, inclusive
+    crop: tuple[int, int, int, int]  # box in canvas of whole tiles
+    size: tuple[int, int]  # output image
+    quad: tuple[int, ...] | None  # QUAD transform of cropped image if needed
+
+    def reduction(self) -> int:
+        """Power of two up to 8 that source tiles are at least reduced by.
+
+        >>> RenderPlan(12, (0, 0, 3, 3), (10, 20, 1034, 1020), (300, 250), None).reduction()
+        2
+        """
+        if 0 in self.size:
+            return 1
+        ratio = min(
+            (self.crop[2] - self.crop[0]) / self.size[0],
+            (self.crop[3] - self.crop[1]) / self.size[1],
+        )
+        scale = 1
+        while scale < 8 and scale * 2 <= ratio:
+            scale *= 2
+        return scale
+
+
+@functools.lru_cache(maxsize=twms.config.ram_cache_plans)
+def render_plan(
+    bbox: twms.bbox.Bbox,
+    request_proj: twms.projections.EPSG,
+    size: tuple[int, int],
+    proj: twms.projections.EPSG,
+    min_zoom: int,
+    max_zoom: int,
+    max_size: tuple[int, int],
+    noresize: bool,
+) -> RenderPlan:
+    """Compute render geometry, cached as JOSM requests same grid again and again.
+
+    Plan depends on layer projection and zoom limits only, so layers with same
+    ones share it.
+
+    >>> plan = render_plan(
+    ...     (27.5, 53.85, 27.6, 53.95), "EPSG:4326", (512, 512),
+    ...     "EPSG:3857", 0, 19, (2048, 2048), False,
+    ... )
+    >>> plan.zoom, plan.tiles, plan.size
+    (12, (2360, 1316, 2362, 1318), (512, 512))
+    """
+    # Making 4-corner maximal bbox
+    bbox_p = twms.projections.from4326(bbox, request_proj)
+    bbox_p = twms.projections.to4326(
+        (bbox_p[2], bbox_p[1], bbox_p[0], bbox_p[3]), request_proj
+    )
+
+    bbox_4: twms.bbox.Bbox4 = (
+        (bbox_p[2], bbox_p[3]),
+        (bbox[0], bbox[1]),
+        (bbox_p[0], bbox_p[1]),
+        (bbox[2], bbox[3]),
+    )
+    bbox = twms.bbox.expand_to_point(bbox, bbox_4)
+    H, W = size
+
+    tile_grid = twms.projections.grid(proj)
+    zoom = tile_grid.zoom_for_bbox(bbox, size, min_zoom, max_zoom, max_size)
+    from_tile_x, from_tile_y, to_tile_x, to_tile_y = twms.projections.tile_by_bbox(
+        bbox, zoom, proj
+    )
+    cut_from_x = int(256 * (from_tile_x - int(from_tile_x)))
+    cut_from_y = int(256 * (from_tile_y - int(from_tile_y)))
+    cut_to_x = int(256 * (to_tile_x - int(to_tile_x)))
+    cut_to_y = int(256 * (to_tile_y - int(to_tile_y)))
+
+    from_tile_x, from_tile_y = int(from_tile_x), int(from_tile_y)
+    to_tile_x, to_tile_y = int(to_tile_x), int(to_tile_y)
+    crop = (
+        cut_from_x,
+        cut_to_y,
+        256 * (to_tile_x - from_tile_x) + cut_to_x,
+        256 * (from_tile_y - to_tile_y) + cut_from_y,
+    )
+    out_size = (crop[2] - crop[0], crop[3] - crop[1])  # After crop
+    if not noresize:
+        if (H == W) and (H == 0):
+            W, H = out_size
+        if H == 0:
+            H = out_size[1] * W // out_size[0]
+        if W == 0:
+            W = out_size[0] * H // out_size[1]
+
+    quad = list()
+    trans_needed = False
+    for point in bbox_4:
+        x = (point[0] - bbox[0]) / (bbox[2] - bbox[0]) * (out_size[0])
+        y = (1 - (point[1] - bbox[1]) / (bbox[3] - bbox[1])) * (out_size[1])
+        x = int(round(x))
+        y = int(round(y))
+        if (x != 0 and x != out_size[0]) or (y != 0 and y != out_size[1]):
+            trans_needed = True
+        quad.append(x)
+        quad.append(y)
+
+    return RenderPlan(
+        zoom=zoom,
+        tiles=(from_tile_x, to_tile_y, to_tile_x, from_tile_y),
+        crop=crop,
+        size=(W, H),
+        quad=tuple(quad) if trans_needed else None,
+    )
+
+
+def strip_quad(
+    quad: tuple[int, ...], height: int, top: int, bottom: int
+) -> tuple[float, ...]:
+    """QUAD transform of image rows from `top` to `bottom`.
+
+    Bilinear QUAD mapping restricted to a strip is a QUAD too, with corners
+    interpolated along the left and right edges.
+
+    >>> strip_quad((0, 0, 10, 100, 110, 90, 100, -10), 100, 0, 100)
+    (0.0, 0.0, 10.0, 100.0, 110.0, 90.0, 100.0, -10.0)
+    >>> strip_quad((0, 0, 10, 100, 110, 90, 100, -10), 100, 50, 100)
+    (5.0, 50.0, 10.0, 100.0, 110.0, 90.0, 105.0, 40.0)
+    """
+    nw, sw, se, ne = quad[0:2], quad[2:4], quad[4:6], quad[6:8]
+
+    def lerp(a, b, row):
+        return tuple(float(a[i] + (b[i] - a[i]) * row / height) for i in range(2))
+
+    return (
+        *lerp(nw, sw, top),
+        *lerp(nw, sw, bottom),
+        *lerp(ne, se, bottom),
+        *lerp(ne, se, top),
+    )
+
+
 class TWMSMain:
     """Inside TWMS, only EPSG:4326 latlon should be used for transmitting coordinates.
 
@@ -34,8 +179,16 @@ class TWMSMain:
 
     def __init__(self):
         self.fetchers_pool = dict()
+        self.coverage = {
+            layer_id: twms.coverage.CoverageMask.for_layer(
+                layer, twms.config.coverage_max_zoom
+            )
+            for layer_id, layer in twms.config.layers.items()
+        }
 
-    def wms_handler(self, data: dict) -> tuple[HTTPStatus, str, bytes | str]:
+    def wms_handler(
+        self, data: dict
+    ) -> tuple[HTTPStatus, str, bytes | str | typing.Iterator[bytes]]:
         """Do main TWMS work.
 
         http://127.0.0.1:8080/wms?request=GetCapabilities&
@@ -44,7 +197,8 @@ class TWMSMain:
             data: url params
 
         Returns:
-            (http.HTTPStatus, content_type, resp)
+            (http.HTTPStatus, content_type, resp), large PNG response is
+            an iterator of encoded parts
         """
         # WMS request keys must be case-insensitive, values must not
         data = {k.casefold(): v for k, v in data.items()}
@@ -72,6 +226,13 @@ class TWMSMain:
         if force:
             force = force.split(",")
         force = tuple(force)
+        quality = data.get("quality", None)  # Overrides layer "quality"
+        if quality not in (None, "best", "fast"):
+            return (
+                HTTPStatus.BAD_REQUEST,
+                "text/plain",
+                f"Invalid quality '{quality}' requested, must be 'best' or 'fast'",
+            )
 
         # Serving imagery
         # Get requested content type from standard WMS 'format' parameter,
@@ -106,26 +267,19 @@ class TWMSMain:
                     not force,
                 )
             ):
-                content_type = twms.config.layers[layers_list[0]]["mimetype"]
-                tile_path = (
-                    twms.config.tiles_cache
-                    + twms.config.layers[layers_list[0]]["prefix"]
-                    + "/{:.0f}/{:.0f}/{:.0f}{}".format(
-                        z,
-                        x,
-                        y,
-                        mimetypes.guess_extension(content_type),
-                    )
-                )
-                logger.debug(f"{layers_list[0]} z{z}/x{x}/y{y} query cache {tile_path}")
-                if os.path.exists(tile_path):
+                layer = twms.config.layers[layers_list[0]]
+                content_type = layer["mimetype"]
+                tile = twms.fetchers.tile_storage(layer, z, x, y)
+                logger.debug(f"{layers_list[0]} z{z}/x{x}/y{y} query cache {tile.path}")
+                if tile.exists():
                     # Not returning HTTP 404
                     logger.info(
-                        f"{layers_list[0]} z{z}/x{x}/y{y} wms_handler cache hit {tile_path}"
+                        f"{layers_list[0]} z{z}/x{x}/y{y} wms_handler cache hit {tile.path}"
                     )
-                    with open(tile_path, "rb") as f:
+                    twms.janitor.touch(layer, z, x, y)
+                    with contextlib.suppress(FileNotFoundError):
                         # Note: image file validation performed only in TileFetcher
-                        return HTTPStatus.OK, content_type, f.read()
+                        return HTTPStatus.OK, content_type, tile.read()
 
         req_bbox = twms.projections.from4326(
             twms.projections.bbox_by_tile(z, x, y, srs), srs
@@ -153,19 +307,31 @@ class TWMSMain:
                 wkt = "," + wkt
             srs = twms.config.layers[ll]["proj"]
 
+        if not layers_list and ll in twms.config.layers and content_type == "image/png":
+            plan = self.layer_plan(box, srs, (height, width), ll, force)
+            if plan.size[1] > twms.config.wms_strip_height > 0:
+                # Single layer is encoded while rendered, no blending needed
+                strips = self.bbox_strips(ll, plan, flip_h, quality)
+                return (
+                    HTTPStatus.OK,
+                    content_type,
+                    twms.stream.encode(strips, plan.size, content_type),
+                )
+
         try:
-            result_img = self.bbox_image(box, srs, (height, width), ll, force)
+            result_img = self.bbox_image(box, srs, (height, width), ll, force, quality)
         except KeyError:
             result_img = Image.new("RGBA", (width, height))
 
         for ll in layers_list:
+            twms.request.check()
             if ll[-2:] == "!c":
                 ll = ll[:-2]
                 if wkt:
                     wkt = "," + wkt
                 srs = twms.config.layers[ll]["proj"]
 
-            im2 = self.bbox_image(box, srs, (height, width), ll, force)
+            im2 = self.bbox_image(box, srs, (height, width), ll, force, quality)
             if "empty_color" in twms.config.layers[ll]:
                 ec = ImageColor.getcolor(twms.config.layers[ll]["empty_color"], "RGBA")
                 sec = set(ec)
@@ -213,6 +379,8 @@ class TWMSMain:
     ) -> tuple[HTTPStatus, str, bytes | str]:
         """Serve tiles as is, without reprojection.
 
+        "{layer_id}@2x" gives 512 px tiles of the same grid.
+
         Args:
             z, x, y: tile coordinates in cache.
             mimetype: required image mimetype.
@@ -222,15 +390,86 @@ class TWMSMain:
         """
         logger.debug(f"{layer_id} z{z}/x{x}/y{y}")
         z, x, y = int(z), int(x), int(y)
-        im = self.tile_image(layer_id, z, x, y, real=True)
-        if im:
-            return (
-                HTTPStatus.OK,
-                mimetype,
-                twms.fetchers.im_convert(im, mimetype),
-            )
+        if layer_id.endswith("@2x") and layer_id[:-3] in twms.config.layers:
+            tile = self.hidpi_tile(layer_id[:-3], z, x, y)
+        else:
+            tile = self.tile_image(layer_id, z, x, y, real=True)
+        if tile:
+            with contextlib.suppress(OSError):  # Broken tile
+                return HTTPStatus.OK, mimetype, tile.encode(mimetype)
         return HTTPStatus.NOT_FOUND, "text/plain", "404 Not Found"
 
+    def hidpi_tile(
+        self, layer_id: str, z: int, x: int, y: int
+    ) -> twms.fetchers.TileImage | None:
+        """Get 512 px tile composed of four z+1 tiles.
+
+        High-DPI client gets the same detail with a quarter of requests.
+        Tile is cached in "{prefix}@2x" if all four subtiles exist, until
+        one of them is fetched again. Subtiles are read from disk cache,
+        not from `tile_image` RAM cache, not to compose outdated ones.
+
+        Returns:
+            Tile image or None if there are no subtiles.
+        """
+        layer = twms.config.layers[layer_id]
+        x = x % (2**z)
+        storage = twms.fetchers.hidpi_storage(layer, z, x, y)
+        if not storage.needs_fetch():
+            with contextlib.suppress(OSError):  # TNE, broken file
+                tile = twms.fetchers.TileImage.from_bytes(
+                    storage.read(), size=(512, 512)
+                )
+                twms.janitor.touch(twms.fetchers.hidpi_layer(layer), z, x, y)
+                return tile
+
+        # Bypass RAM cache, it may hold subtiles fetched again since
+        tile_image = type(self).tile_image.__wrapped__
+        subtiles = []
+        for dy in (0, 1):
+            for dx in (0, 1):
+                tile = tile_image(
+                    self, layer_id, z + 1, 2 * x + dx, 2 * y + dy, real=True
+                )
+                try:
+                    subtiles.append(tile.image() if tile else None)
+                except OSError:
+                    subtiles.append(None)  # Broken tile
+        if not any(subtiles):
+            return None
+        ec = ImageColor.getcolor(layer["empty_color"], "RGBA")
+        im = Image.new("RGBA", (512, 512), (ec[0], ec[1], ec[2], 0))
+        for i, subtile in enumerate(subtiles):
+            if subtile:
+                im.paste(subtile, (256 * (i % 2), 256 * (i // 2)))
+        tile = twms.fetchers.TileImage(
+            twms.fetchers.im_convert(im, layer["mimetype"]), layer["mimetype"], im
+        )
+        if all(subtiles):
+            storage.set(tile.data)
+        return tile
+
+    def layer_plan(
+        self,
+        bbox: twms.bbox.Bbox,
+        request_proj: twms.projections.EPSG,
+        size: tuple[int, int],
+        layer_id: str,
+        force,
+    ) -> RenderPlan:
+        """Render geometry of a bbox for a layer."""
+        layer = twms.config.layers[layer_id]
+        return render_plan(
+            tuple(bbox),
+            request_proj,
+            tuple(size),
+            layer["proj"],
+            layer["min_zoom"],
+            layer["max_zoom"],
+            (twms.config.max_height, twms.config.max_width),
+            "noresize" in force,
+        )
+
     def bbox_image(
         self,
         bbox: twms.bbox.Bbox,
@@ -238,90 +477,137 @@ class TWMSMain:
         size: tuple[int, int],
         layer_id: str,
         force,
+        quality: str | None = None,
     ) -> Image.Image:
-        """Get tile by a given bbox."""
-        # Making 4-corner maximal bbox
-        bbox_p = twms.projections.from4326(bbox, request_proj)
-        bbox_p = twms.projections.to4326(
-            (bbox_p[2], bbox_p[1], bbox_p[0], bbox_p[3]), request_proj
-        )
+        """Get tile by a given bbox.
 
-        bbox_4: twms.bbox.Bbox4 = (
-            (bbox_p[2], bbox_p[3]),
-            (bbox[0], bbox[1]),
-            (bbox_p[0], bbox_p[1]),
-            (bbox[2], bbox[3]),
-        )
-        bbox = twms.bbox.expand_to_point(bbox, bbox_4)
-        H, W = size
-
-        zoom = twms.projections.zoom_for_bbox(
-            bbox,
-            size,
-            layer_id,
-            twms.config.layers[layer_id]["min_zoom"],
-            twms.config.layers[layer_id]["max_zoom"],
-            (twms.config.max_height, twms.config.max_width),
-        )
-        from_tile_x, from_tile_y, to_tile_x, to_tile_y = twms.projections.tile_by_bbox(
-            bbox,
-            zoom,
-            twms.config.layers[layer_id]["proj"],
-        )
-        cut_from_x = int(256 * (from_tile_x - int(from_tile_x)))
-        cut_from_y = int(256 * (from_tile_y - int(from_tile_y)))
-        cut_to_x = int(256 * (to_tile_x - int(to_tile_x)))
-        cut_to_y = int(256 * (to_tile_y - int(to_tile_y)))
-
-        from_tile_x, from_tile_y = int(from_tile_x), int(from_tile_y)
-        to_tile_x, to_tile_y = int(to_tile_x), int(to_tile_y)
-        bbox_im = (
-            cut_from_x,
-            cut_to_y,
-            256 * (to_tile_x - from_tile_x) + cut_to_x,
-            256 * (from_tile_y - to_tile_y) + cut_from_y,
-        )
-        x = 256 * (to_tile_x - from_tile_x + 1)
-        y = 256 * (from_tile_y - to_tile_y + 1)
+        Args:
+            quality: "best" or "fast", layer "quality" by default
+        """
+        plan = self.layer_plan(bbox, request_proj, size, layer_id, force)
+        quality = quality or twms.config.layers[layer_id]["quality"]
+        return self.strip_image(layer_id, plan, 0, plan.size[1], quality)
 
-        out = Image.new("RGBA", (x, y))
-        for x in range(from_tile_x, to_tile_x + 1):
-            for y in range(to_tile_y, from_tile_y + 1):
-                im1 = self.tile_image(layer_id, zoom, x, y, real=True)
-                if not im1:
-                    ec = ImageColor.getcolor(
-                        twms.config.layers[layer_id]["empty_color"],
-                        "RGBA",
+    def bbox_strips(
+        self,
+        layer_id: str,
+        plan: RenderPlan,
+        flip: bool = False,
+        quality: str | None = None,
+    ) -> typing.Iterator[Image.Image]:
+        """Render image top to bottom in strips of `wms_strip_height` rows."""
+        quality = quality or twms.config.layers[layer_id]["quality"]
+        height = plan.size[1]
+        step = twms.config.wms_strip_height or height
+        for top in range(0, height, step):
+            bottom = min(top + step, height)
+            if flip:
+                yield ImageOps.flip(
+                    self.strip_image(
+                        layer_id, plan, height - bottom, height - top, quality
                     )
-                    im1 = Image.new("RGBA", (256, 256), ec)
-                out.paste(im1, ((x - from_tile_x) * 256, (-to_tile_y + y) * 256))
-
-        # TODO: We could drop this crop in case user doesn't need it.
-        out = out.crop(bbox_im)
-        if "noresize" not in force:
-            if (H == W) and (H == 0):
-                W, H = out.size
-            if H == 0:
-                H = out.size[1] * W // out.size[0]
-            if W == 0:
-                W = out.size[0] * H // out.size[1]
-
-        quad = list()
-        trans_needed = False
-        for point in bbox_4:
-            x = (point[0] - bbox[0]) / (bbox[2] - bbox[0]) * (out.size[0])
-            y = (1 - (point[1] - bbox[1]) / (bbox[3] - bbox[1])) * (out.size[1])
-            x = int(round(x))
-            y = int(round(y))
-            if (x != 0 and x != out.size[0]) or (y != 0 and y != out.size[1]):
-                trans_needed = True
-            quad.append(x)
-            quad.append(y)
-
-        if trans_needed:
-            out = out.transform((W, H), Image.QUAD, tuple(quad), Image.BICUBIC)
-        elif (W != out.size[0]) or (H != out.size[1]):
-            out = out.resize((W, H), Image.LANCZOS)
+                )
+            else:
+                yield self.strip_image(layer_id, plan, top, bottom, quality)
+
+    def strip_image(
+        self,
+        layer_id: str,
+        plan: RenderPlan,
+        top: int,
+        bottom: int,
+        quality: str = "best",
+    ) -> Image.Image:
+        """Render output image rows from `top` to `bottom`.
+
+        Only tile rows under the strip are fetched and pasted. Source rows are
+        widened by resampling filter support, so strips join seamlessly.
+
+        Args:
+            quality: "fast" to decode tiles at reduced scale if output is
+                at least twice smaller than them
+        """
+        layer = twms.config.layers[layer_id]
+        from_tile_x, to_tile_y, to_tile_x, from_tile_y = plan.tiles
+        crop_left, crop_top, crop_right, crop_bottom = plan.crop
+        width, height = plan.size
+        src_height = crop_bottom - crop_top
+        scale = plan.reduction() if quality == "fast" else 1
+
+        # Source rows of cropped image, which strip is made of
+        if plan.quad:
+            quad = strip_quad(plan.quad, height, top, bottom)
+            src_top = math.floor(min(quad[1::2])) - 3 * scale  # Bicubic neighbours
+            src_bottom = math.ceil(max(quad[1::2])) + 3 * scale
+        elif plan.size != (crop_right - crop_left, src_height):
+            box_top = top * src_height / height
+            box_bottom = bottom * src_height / height
+            support = (3 * max(src_height / height / scale, 1) + 1) * scale  # Lanczos
+            src_top = math.floor(box_top - support)
+            src_bottom = math.ceil(box_bottom + support)
+        else:
+            src_top, src_bottom = top, bottom
+        src_top, src_bottom = max(src_top, 0), min(src_bottom, src_height)
+        if src_top >= src_bottom:
+            return Image.new("RGBA", (width, bottom - top))  # Outside of source
+
+        first_row = (crop_top + src_top) // 256
+        last_row = (crop_top + src_bottom - 1) // 256
+        tile_size = 256 // scale
+        out = Image.new(
+            "RGBA",
+            (
+                tile_size * (to_tile_x - from_tile_x + 1),
+                tile_size * (last_row - first_row + 1),
+            ),
+        )
+        for x in range(from_tile_x, to_tile_x + 1):
+            for y in range(to_tile_y + first_row, to_tile_y + last_row + 1):
+                twms.request.check()
+                tile = self.tile_image(layer_id, plan.zoom, x, y, real=True)
+                im1 = None
+                if tile:
+                    with contextlib.suppress(OSError):  # Broken tile is empty
+                        im1 = tile.image(scale)
+                if im1 is None:
+                    ec = ImageColor.getcolor(layer["empty_color"], "RGBA")
+                    im1 = Image.new("RGBA", (tile_size, tile_size), ec)
+                out.paste(
+                    im1,
+                    (
+                        (x - from_tile_x) * tile_size,
+                        (y - to_tile_y - first_row) * tile_size,
+                    ),
+                )
+
+        # Crop source window, rounded outwards to reduced pixels. Cropped image
+        # coordinates of the plan map to `(v + shift) / scale` in it
+        offset = crop_top - 256 * first_row
+        box = (
+            crop_left // scale,
+            (offset + src_top) // scale,
+            -(-crop_right // scale),
+            -(-(offset + src_bottom) // scale),
+        )
+        shift_x, shift_y = crop_left - box[0] * scale, offset - box[1] * scale
+        out = out.crop(box)
+        if plan.quad:
+            quad = [
+                (v + shift_y) / scale if i % 2 else (v + shift_x) / scale
+                for i, v in enumerate(quad)
+            ]
+            out = out.transform((width, bottom - top), Image.QUAD, quad, Image.BICUBIC)
+        elif plan.size != (crop_right - crop_left, src_height):
+            out = out.resize(
+                (width, bottom - top),
+                Image.LANCZOS,
+                box=(
+                    shift_x / scale,
+                    (box_top + shift_y) / scale,
+                    (crop_right - crop_left + shift_x) / scale,
+                    (box_bottom + shift_y) / scale,
+                ),
+            )
         return out
 
     @functools.lru_cache(maxsize=twms.config.ram_cache_tiles)
@@ -333,7 +619,7 @@ class TWMSMain:
         y: int,
         trybetter=True,
         real=False,
-    ) -> Image.Image | None:
+    ) -> twms.fetchers.TileImage | None:
         """Get tile by Slippy map coordinates: download or construct from cached.
 
         Args:
@@ -342,7 +628,7 @@ class TWMSMain:
 
         Returns:
             Tile image (from cache, fetcher, or recursively rescaled) or
-            None if image is invalid or unavailable.
+            None if image is invalid or unavailable. Decoded on demand.
         """
         # Limit zoom and coordinates in fetchers, not here, as it can reconstruct tiles
         x = x % (2**z)
@@ -350,16 +636,7 @@ class TWMSMain:
             logger.warning(f"{layer_id}/z{z}/x{x}/y{y} impossible tile coordinates")
             return None
 
-        if not twms.bbox.bbox_is_in(
-            twms.projections.bbox_by_tile(
-                z,
-                x,
-                y,
-                twms.config.layers[layer_id]["proj"],
-            ),
-            twms.config.layers[layer_id]["bounds"],
-            fully=False,
-        ):
+        if not self.coverage[layer_id].contains(z, x, y):
             logger.debug(
                 f"{layer_id}/z{z}/x{x}/y{y} ignoring request for a tile outside configured bounds"
             )
@@ -381,6 +658,7 @@ class TWMSMain:
                     "RGBA",
                 )
                 empty_color = (ec[0], ec[1], ec[2], 0)
+                fast = twms.config.layers[layer_id]["quality"] == "fast"
                 im = Image.new("RGBA", (512, 512), empty_color)
                 im1 = self.tile_image(layer_id, z + 1, x * 2, y * 2)
                 if im1:
@@ -389,12 +667,25 @@ class TWMSMain:
                         im3 = self.tile_image(layer_id, z + 1, x * 2, y * 2 + 1)
                         if im3:
                             im4 = self.tile_image(layer_id, z + 1, x * 2 + 1, y * 2 + 1)
-                            if im4:
-                                im.paste(im1, (0, 0))
-                                im.paste(im2, (256, 0))
-                                im.paste(im3, (0, 256))
-                                im.paste(im4, (256, 256))
-                                tile = im.resize((256, 256), Image.LANCZOS)
+                            try:
+                                if im4 and fast:
+                                    # Subtiles decoded at half scale, no resampling
+                                    im = Image.new("RGBA", (256, 256), empty_color)
+                                    im.paste(im1.image(2), (0, 0))
+                                    im.paste(im2.image(2), (128, 0))
+                                    im.paste(im3.image(2), (0, 128))
+                                    im.paste(im4.image(2), (128, 128))
+                                    tile = twms.fetchers.TileImage.from_image(im)
+                                elif im4:
+                                    im.paste(im1.image(), (0, 0))
+                                    im.paste(im2.image(), (256, 0))
+                                    im.paste(im3.image(), (0, 256))
+                                    im.paste(im4.image(), (256, 256))
+                                    tile = twms.fetchers.TileImage.from_image(
+                                        im.resize((256, 256), Image.LANCZOS)
+                                    )
+                            except OSError:
+                                pass  # Broken subtile, try upscaling
 
             if real:
                 logger.info(f"{layer_id}/z{z}/x{x}/y{y} upscaling from top tile")
@@ -406,6 +697,11 @@ class TWMSMain:
                     trybetter=False,
                     real=True,
                 )
+                if im:
+                    try:
+                        im = im.image()
+                    except OSError:
+                        im = None  # Broken tile
                 if im:
                     im = im.crop(
                         (
@@ -415,5 +711,7 @@ class TWMSMain:
                             128 * (y % 2) + 128,
                         )
                     )
-                    tile = im.resize((256, 256), Image.BILINEAR)
+                    tile = twms.fetchers.TileImage.from_image(
+                        im.resize((256, 256), Image.BILINEAR)
+                    )
         return tile
@@ -0,0 +1,190 @@
+"""Write-behind persistence of fetched tiles.
+
+Fetched tile is returned to the client at once, while writing it to disk is
+left to background threads. Until written, the tile is served from memory.
+
+Writers take queued tiles in batches, create each missing directory once
+and write files atomically via temporary file and rename, so concurrent
+readers (including SAS.Planet) never see partially written tiles.
+"""
+
+import collections
+import logging
+import os
+import pathlib
+import threading
+
+import twms.config
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """Bounded queue of cache writes served by writer threads."""
+
+    def __init__(self, threads: int = 2, max_pending: int = 1024, batch: int = 64):
+        """Create queue, threads are started on first write.
+
+        Args:
+            threads: writer threads
+            max_pending: writes waiting for disk, producers block above that
+            batch: writes taken by a writer at once
+        """
+        self.threads = threads
+        self.max_pending = max_pending
+        self.batch = batch
+        # {tile path: (TileFile, blob)}, latest state to write
+        self._pending: dict[pathlib.Path, tuple] = dict()
+        self._queue: collections.deque[pathlib.Path] = collections.deque()
+        self._writing: set[pathlib.Path] = set()  # Taken by writers
+        self._known_dirs: set[pathlib.Path] = set()
+        self._workers: list[threading.Thread] = list()
+        self._cond = threading.Condition()
+
+    def submit(self, tile, blob: bytes | memoryview | None) -> None:
+        """Queue `TileFile.write(blob)`, newer write of the same tile replaces queued one.
+
+        Blocks while queue is full.
+        """
+        with self._cond:
+            while (
+                len(self._pending) >= self.max_pending
+                and tile.path not in self._pending
+            ):
+                self._cond.wait()
+            if tile.path not in self._pending and tile.path not in self._writing:
+                # Path being written is queued again by its writer
+                self._queue.append(tile.path)
+            self._pending[tile.path] = (tile, blob)
+            # Replace writers died unexpectedly
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            if len(self._workers) < self.threads:
+                worker = threading.Thread(
+                    target=self._worker,
+                    name=f"writer_{len(self._workers)}",
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+            self._cond.notify_all()
+
+    def pending(self, path: pathlib.Path) -> tuple[bool, bytes | memoryview | None]:
+        """Look up a write not yet on disk.
+
+        Returns:
+            (True, blob) if write is pending, blob is None for TNE.
+        """
+        with self._cond:
+            if entry := self._pending.get(path):
+                return True, entry[1]
+        return False, None
+
+    def discard(self, path: pathlib.Path) -> None:
+        """Cancel pending write, e.g. when tile is deleted.
+
+        Waits for a write already in progress, so the file can be deleted
+        after return.
+        """
+        with self._cond:
+            if self._pending.pop(path, None) and path not in self._writing:
+                self._queue.remove(path)
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: path not in self._writing)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until all pending writes are on disk.
+
+        Returns:
+            False on timeout.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout)
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue)
+                paths = [
+                    self._queue.popleft()
+                    for _ in range(min(self.batch, len(self._queue)))
+                ]
+                # Skip paths discarded meanwhile
+                batch = [
+                    (path, entry)
+                    for path in paths
+                    if (entry := self._pending.get(path)) is not None
+                ]
+                paths = [path for path, _ in batch]
+                self._writing.update(paths)
+            # Create each directory once per batch, skip known ones
+            for parent in {path.parent for path, _ in batch}:
+                if parent not in self._known_dirs:
+                    try:
+                        parent.mkdir(parents=True, exist_ok=True)
+                        self._known_dirs.add(parent)
+                    except OSError:
+                        logger.exception(f"Failed to create '{parent}'")
+            for path, entry in batch:
+                tile, blob = entry
+                try:
+                    try:
+                        tile.write(blob, mkdir=False)
+                    except FileNotFoundError:
+                        # Directory was removed meanwhile
+                        tile.write(blob)
+                except Exception:
+                    # Keep the writer alive, lost tile is fetched again
+                    logger.exception(f"Failed to write '{path}'")
+                with self._cond:
+                    self._writing.discard(path)
+                    if (current := self._pending.get(path)) is entry:
+                        del self._pending[path]
+                    elif current is not None:
+                        # Newer version arrived while writing
+                        self._queue.append(path)
+                    # Otherwise discarded while writing
+                    self._cond.notify_all()
+
+
+def write_atomic(path: pathlib.Path, blob: bytes | memoryview) -> None:
+    """Write file via temporary file and rename.
+
+    Temporary name starts with dot and doesn't look like a tile for SAS.Planet.
+
+    >>> import tempfile
+    >>> path = pathlib.Path(tempfile.mkdtemp()) / "1.png"
+    >>> write_atomic(path, b"PNG")
+    >>> path.read_bytes(), len(list(path.parent.iterdir()))
+    (b'PNG', 1)
+    """
+    tmp = path.with_name(f".{path.name}.{threading.get_native_id()}.tmp")
+    try:
+        tmp.write_bytes(blob)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+_writer: WriteBehind | None = None
+_writer_lock = threading.Lock()
+
+
+def default() -> WriteBehind | None:
+    """Return shared writer or None if write-behind is disabled."""
+    global _writer
+    if not twms.config.write_behind_threads:
+        return None
+    with _writer_lock:
+        if _writer is None:
+            _writer = WriteBehind(
+                twms.config.write_behind_threads, twms.config.write_behind_queue
+            )
+        return _writer
+
+
+def flush() -> None:
+    """Write all pending tiles, e.g. on shutdown."""
+    if _writer is not None:
+        logger.info("Flushing write-behind queue")
+        _writer.flush()